@@ -0,0 +1,345 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs inference over all existing MG instances of a DICOM store.
+
+The inference module only processes instances that are announced on Pub/Sub
+after it started. This script instead finds all MG instances that are already
+in a DICOM store, e.g. to score them with a newly deployed model:
+
+1) Pages through the MG studies of --source_dicom_store_path with QIDO-RS,
+   and through the MG series and instances of each study.
+
+2) Retrieves each instance as JPEG with WADO-RS, runs prediction, and stores
+   the prediction as a DICOM structured report in --dicom_store_path, exactly
+   as inference.py does. Up to --fetch_concurrency instances are processed
+   concurrently, and their predictions are batched with
+   --prediction_batch_size.
+
+3) Records each processed instance, and each study once all its instances are
+   processed, in the SQLite database --checkpoint_path. When the script is run
+   again, the recorded studies and instances are skipped, so an interrupted
+   run resumes where it stopped. The same database can be passed as
+   --processed_journal_path to inference.py, so that neither processes an
+   instance the other already processed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import logging
+import os
+import sys
+import threading
+
+from concurrent import futures
+import dedup
+import dicomweb
+import inference
+from oauth2client.client import GoogleCredentials
+import tags
+
+_logger = logging.getLogger(__name__)
+_logger.addHandler(logging.StreamHandler(sys.stdout))
+_logger.setLevel(logging.INFO)
+
+FLAGS = None
+
+# OAuth2 scope used to access Cloud Healthcare API.
+_CLOUD_PLATFORM_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
+
+# Modality of the instances that inference is run on.
+_MAMMOGRAPHY_MODALITY = 'MG'
+
+# Number of processed keys kept in memory. Older ones are read back from the
+# checkpoint database.
+_CHECKPOINT_MEMORY_SIZE = 100000
+
+
+def _GetValue(dataset, tag):
+  # type: (Dict, tags.DicomTag) -> Optional[str]
+  """Returns the first value of tag in a DICOM JSON dataset, or None."""
+  return dataset.get(tag.number, {}).get('Value', [None])[0]
+
+
+class _Backfill(object):
+  """Runs inference over the MG instances of a DICOM store.
+
+  Args:
+    dicomweb_client: DicomWebClient used for all DICOMweb requests.
+    predictor: Predictor used to get prediction results.
+    stow_writer: StowRsWriter used to store structured reports.
+    source_dicom_store_path: DICOM store whose instances are processed.
+    dicom_store_path: DICOM store the structured reports are stored in.
+    model_version: Identifies the model that predictions are made with.
+    checkpoint: dedup.ProcessedSet recording the processed instances and
+      studies.
+    page_size: Number of results requested per QIDO-RS request.
+    fetch_concurrency: Maximum number of instances processed concurrently.
+  """
+
+  def __init__(self, dicomweb_client, predictor, stow_writer,
+               source_dicom_store_path, dicom_store_path, model_version,
+               checkpoint, page_size, fetch_concurrency):
+    self._dicomweb_client = dicomweb_client
+    self._predictor = predictor
+    self._stow_writer = stow_writer
+    self._source_dicomweb_path = os.path.join(source_dicom_store_path,
+                                              'dicomWeb')
+    self._study_path = os.path.join(dicom_store_path, 'dicomWeb', 'studies')
+    self._model_version = model_version
+    self._checkpoint = checkpoint
+    self._page_size = page_size
+    self._executor = futures.ThreadPoolExecutor(max_workers=fetch_concurrency)
+    # Bounds the number of instances submitted to the executor, so that the
+    # studies are listed only as fast as their instances are processed.
+    self._slots = threading.BoundedSemaphore(fetch_concurrency * 2)
+    self._counts_lock = threading.Lock()
+    self._counts = {'stored': 0, 'skipped': 0, 'failed': 0}
+
+  def _Qido(self, path):
+    # type: str -> Iterator[Dict]
+    """Yields all results of a QIDO-RS search, one page at a time.
+
+    Args:
+      path: QIDO-RS path relative to the source DICOMweb service, including
+        the query parameters.
+
+    Yields:
+      DICOM JSON of each result.
+    """
+    offset = 0
+    while True:
+      qido_url = '%s/%s/%s&limit=%d&offset=%d' % (
+          self._dicomweb_client.url_prefix, self._source_dicomweb_path, path,
+          self._page_size, offset)
+      page = self._dicomweb_client.QidoRs(qido_url)
+      for result in page:
+        yield result
+      if len(page) < self._page_size:
+        return
+      offset += len(page)
+
+  def _Count(self, outcome):
+    # type: str -> None
+    with self._counts_lock:
+      self._counts[outcome] += 1
+
+  def Run(self):
+    # type: None -> Dict[str, int]
+    """Processes all MG instances of the source DICOM store.
+
+    Returns:
+      Number of instances stored, skipped because they were already
+      processed, and failed.
+    """
+    for study_json in self._Qido('studies?ModalitiesInStudy=%s&'
+                                 'includefield=all' % _MAMMOGRAPHY_MODALITY):
+      study_uid = _GetValue(study_json, tags.STUDY_INSTANCE_UID)
+      study_key = inference.ProcessedKey(
+          '%s/studies/%s' % (self._source_dicomweb_path, study_uid),
+          self._model_version)
+      if study_key in self._checkpoint:
+        continue
+      _logger.info('Processing study: %s', study_uid)
+      study_futures = []
+      for series_json in self._Qido('studies/%s/series?Modality=%s' %
+                                    (study_uid, _MAMMOGRAPHY_MODALITY)):
+        series_uid = _GetValue(series_json, tags.SERIES_INSTANCE_UID)
+        for instance_json in self._Qido(
+            'studies/%s/series/%s/instances?includefield=%s' %
+            (study_uid, series_uid, tags.SOP_INSTANCE_UID.number)):
+          image_instance_path = '%s/studies/%s/series/%s/instances/%s' % (
+              self._source_dicomweb_path, study_uid, series_uid,
+              _GetValue(instance_json, tags.SOP_INSTANCE_UID))
+          self._slots.acquire()
+          future = self._executor.submit(self._ProcessInstance,
+                                         image_instance_path, study_json)
+          future.add_done_callback(lambda _: self._slots.release())
+          study_futures.append(future)
+      self._CheckpointStudyWhenDone(study_key, study_futures)
+    self._executor.shutdown()
+    self._stow_writer.Flush()
+    return dict(self._counts)
+
+  def _CheckpointStudyWhenDone(self, study_key, study_futures):
+    # type: (str, List[futures.Future]) -> None
+    """Records the study once all its instances were processed."""
+    remaining = [len(study_futures)]
+    lock = threading.Lock()
+
+    def _OnInstanceDone(future):
+      if future.exception() is not None or not future.result():
+        return
+      with lock:
+        remaining[0] -= 1
+        if remaining[0] == 0:
+          self._checkpoint.Add(study_key)
+
+    if not study_futures:
+      self._checkpoint.Add(study_key)
+    for future in study_futures:
+      future.add_done_callback(_OnInstanceDone)
+
+  def _ProcessInstance(self, image_instance_path, study_json):
+    # type: (str, Dict) -> bool
+    """Runs inference on one instance, and stores its structured report.
+
+    Args:
+      image_instance_path: Path of the instance.
+      study_json: DICOM JSON of the instance's study.
+
+    Returns:
+      True if the instance was processed, now or before.
+    """
+    processed_key = inference.ProcessedKey(image_instance_path,
+                                           self._model_version)
+    if processed_key in self._checkpoint:
+      self._Count('skipped')
+      return True
+    try:
+      image_jpeg_bytes = self._dicomweb_client.WadoRs(image_instance_path)
+      predicted_class, predicted_score = self._predictor.Predict(
+          image_jpeg_bytes)
+      _, sr_instance_uid, dicom_sr = inference.BuildPredictionSR(
+          image_instance_path, processed_key,
+          [(None, predicted_class, predicted_score)], copy.deepcopy(study_json))
+      self._stow_writer.Write(self._study_path, sr_instance_uid,
+                              dicom_sr).result()
+    except Exception as e:  # pylint: disable=broad-except
+      _logger.error('Failed to process instance %s: %s', image_instance_path,
+                    e)
+      self._Count('failed')
+      return False
+    self._checkpoint.Add(processed_key)
+    self._Count('stored')
+    return True
+
+
+def main():
+  model_version = FLAGS.model_version or FLAGS.model_path
+  predictor = inference.CreatePredictor(
+      FLAGS.prediction_service,
+      FLAGS.model_path,
+      model_version=model_version,
+      batch_size=FLAGS.prediction_batch_size,
+      batch_latency_secs=FLAGS.prediction_batch_latency_ms / 1000)
+  predictor.WarmUp()
+
+  credentials = GoogleCredentials.get_application_default().create_scoped(
+      [_CLOUD_PLATFORM_SCOPE])
+  dicomweb_client = dicomweb.DicomWebClient(
+      credentials, max_connections=FLAGS.max_dicomweb_connections)
+  backfill = _Backfill(
+      dicomweb_client,
+      predictor,
+      dicomweb.StowRsWriter(
+          dicomweb_client,
+          max_batch_size=FLAGS.stow_batch_size,
+          max_concurrency=FLAGS.stow_concurrency),
+      FLAGS.source_dicom_store_path,
+      FLAGS.dicom_store_path or FLAGS.source_dicom_store_path,
+      model_version,
+      dedup.ProcessedSet(_CHECKPOINT_MEMORY_SIZE, FLAGS.checkpoint_path),
+      FLAGS.page_size,
+      FLAGS.fetch_concurrency)
+  counts = backfill.Run()
+  _logger.info('Backfill done: %d stored, %d already processed, %d failed',
+               counts['stored'], counts['skipped'], counts['failed'])
+  if counts['failed']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--source_dicom_store_path',
+      type=str,
+      required=True,
+      help='DICOM store whose MG instances are processed, e.g. '
+      'projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/'
+      'dicomStores/{DICOM_STORE_ID}.')
+  parser.add_argument(
+      '--dicom_store_path',
+      type=str,
+      default=None,
+      help='DICOM store used to store inference results. Defaults to '
+      '--source_dicom_store_path.')
+  parser.add_argument(
+      '--checkpoint_path',
+      type=str,
+      required=True,
+      help='Path of a SQLite database recording the processed instances and '
+      'studies. A run that was interrupted resumes from it.')
+  parser.add_argument(
+      '--model_path',
+      type=str,
+      required=True,
+      help='Path of model used for inference.')
+  parser.add_argument(
+      '--model_version',
+      type=str,
+      default=None,
+      help='Version of the model, used to recognize instances that were '
+      'already processed with the same model. Defaults to --model_path.')
+  parser.add_argument(
+      '--prediction_service',
+      type=str,
+      default='CMLE',
+      choices=['CMLE', 'AutoML', 'Local'],
+      help='Service to call for prediction, either "CMLE", "AutoML" or '
+      '"Local".')
+  parser.add_argument(
+      '--prediction_batch_size',
+      type=int,
+      default=8,
+      help='Maximum number of images sent to the prediction service in one '
+      'request. Batching is disabled if 1.')
+  parser.add_argument(
+      '--prediction_batch_latency_ms',
+      type=int,
+      default=50,
+      help='Maximum number of milliseconds an image waits for its prediction '
+      'batch to fill up.')
+  parser.add_argument(
+      '--page_size',
+      type=int,
+      default=100,
+      help='Number of results requested per QIDO-RS request.')
+  parser.add_argument(
+      '--fetch_concurrency',
+      type=int,
+      default=16,
+      help='Maximum number of instances processed concurrently. Should be at '
+      'least --prediction_batch_size for batches to fill up.')
+  parser.add_argument(
+      '--stow_batch_size',
+      type=int,
+      default=16,
+      help='Maximum number of structured reports stored with one STOW-RS '
+      'request.')
+  parser.add_argument(
+      '--stow_concurrency',
+      type=int,
+      default=4,
+      help='Maximum number of concurrent STOW-RS requests.')
+  parser.add_argument(
+      '--max_dicomweb_connections',
+      type=int,
+      default=20,
+      help='Maximum number of concurrent connections to the Healthcare API.')
+  FLAGS = parser.parse_args()
+  main()
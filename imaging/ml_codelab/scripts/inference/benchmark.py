@@ -0,0 +1,589 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Offline load test of the inference module.
+
+Runs PubsubMessageHandler against local fakes instead of Cloud Pub/Sub, the
+Cloud Healthcare API and a prediction service:
+
+1) A fake DICOMweb server that serves QIDO-RS, WADO-RS and STOW-RS from a
+   directory of images laid out as <image_dir>/<STUDY_UID>/<SERIES_UID>/
+   <INSTANCE_UID>.<ext>. The files are served as they are, so JPEG images are
+   expected, although any file works with the stub predictor. All instances
+   are reported as MG, and STOW-RS requests are read and discarded. The
+   rendered resource of the instances scales the images to the requested
+   viewport with Pillow.
+
+2) A fake Pub/Sub feed that replays instance paths at a fixed rate, with the
+   same callback thread pool and flow control as the Pub/Sub subscriber.
+
+3) A stub predictor that sleeps for a configurable time.
+
+The feed is replayed once per concurrency setting, and the throughput,
+end-to-end latency (from publication to ack or nack), memory use and bytes
+transferred are reported for each run, e.g.:
+
+  python benchmark.py --image_dir=/tmp/images --rate=50 \
+      --concurrency=1,4,16 --predict_latency_ms=100
+
+Passing --rendered_viewport or --downscale_size measures the transfer of
+scaled images instead of full resolution ones.
+
+Memory use is the resident set size of the process when a run starts, and
+how much it grew at its peak and at the end of the run. Memory is not given
+back to the OS between runs, so a run mostly grows by what it needs beyond
+the previous runs; list the concurrency settings in increasing order, or run
+one setting per process, to compare them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import collections
+import io
+import json
+import os
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+from concurrent import futures
+import dicomweb
+import inference
+import metrics
+import prometheus_client
+import tags
+
+FLAGS = None
+
+# DICOM store whose paths are used in the replayed messages.
+_DICOM_STORE_PATH = 'projects/p/locations/l/datasets/d/dicomStores/s'
+
+_INSTANCE_PATH_REGEXP = (r'/%s/dicomWeb/studies/([^/]+)/series/([^/]+)/'
+                         r'instances/([^/]+)/?$' % _DICOM_STORE_PATH)
+_RENDERED_PATH_REGEXP = (r'/%s/dicomWeb/studies/([^/]+)/series/([^/]+)/'
+                         r'instances/([^/]+)/rendered$' % _DICOM_STORE_PATH)
+_STUDIES_PATH_REGEXP = r'/%s/dicomWeb/studies/?$' % _DICOM_STORE_PATH
+_SERIES_INSTANCES_PATH_REGEXP = (r'/%s/dicomWeb/studies/([^/]+)/series/'
+                                 r'([^/]+)/instances/?$' % _DICOM_STORE_PATH)
+
+# Number of seconds the feed waits for the last messages to be acked.
+_DRAIN_TIMEOUT_SECS = 600
+
+# Number of seconds between two samples of the resident set size.
+_RSS_SAMPLING_INTERVAL_SECS = 0.01
+
+
+def _DicomJsonValue(tag, value):
+  # type: (tags.DicomTag, str) -> Dict
+  """Returns the DICOM JSON of a single valued attribute."""
+  return {'vr': tag.vr, 'Value': [value]}
+
+
+class _FakeDicomWebServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+  """DICOMweb server backed by a directory of images.
+
+  Args:
+    image_dir: Directory of <STUDY_UID>/<SERIES_UID>/<INSTANCE_UID>.<ext>
+      files.
+    latency_secs: Number of seconds added to the handling of each request.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, image_dir, latency_secs):
+    BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                       _FakeDicomWebRequestHandler)
+    self.image_dir = image_dir
+    self.latency_secs = latency_secs
+    self._lock = threading.Lock()
+    self._bytes_sent = 0
+    self._bytes_received = 0
+
+  @property
+  def url_prefix(self):
+    # type: None -> str
+    return 'http://localhost:%d' % self.server_address[1]
+
+  def CountBytes(self, sent, received):
+    # type: (int, int) -> None
+    with self._lock:
+      self._bytes_sent += sent
+      self._bytes_received += received
+
+  def ResetByteCounts(self):
+    # type: None -> (int, int)
+    """Returns the number of bytes sent and received, and resets them."""
+    with self._lock:
+      counts = (self._bytes_sent, self._bytes_received)
+      self._bytes_sent = 0
+      self._bytes_received = 0
+    return counts
+
+
+class _FakeDicomWebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handles the DICOMweb requests made by PubsubMessageHandler."""
+
+  # Keep connections alive, as the Healthcare API does.
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    pass
+
+  def _Send(self, status, body, content_type):
+    # type: (int, str, str) -> None
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.CountBytes(len(body), 0)
+
+  def _SendJson(self, dicom_json):
+    # type: List[Dict] -> None
+    self._Send(200, json.dumps(dicom_json), 'application/dicom+json')
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    time.sleep(self.server.latency_secs)
+    url = urlparse.urlparse(self.path)
+    query = urlparse.parse_qs(url.query)
+
+    match = re.match(_INSTANCE_PATH_REGEXP, url.path)
+    if match:
+      self._WadoRs(*match.groups())
+      return
+    match = re.match(_RENDERED_PATH_REGEXP, url.path)
+    if match:
+      self._Rendered(query.get('viewport', [None])[0], *match.groups())
+      return
+    match = re.match(_SERIES_INSTANCES_PATH_REGEXP, url.path)
+    if match:
+      # Instance-level QIDO-RS, used to find the modality.
+      self._SendJson([{
+          tags.MODALITY_TAG.number: _DicomJsonValue(tags.MODALITY_TAG, 'MG')
+      }])
+      return
+    if re.match(_STUDIES_PATH_REGEXP, url.path):
+      study_uid = query.get('StudyInstanceUID', [''])[0]
+      self._SendJson([{
+          tags.STUDY_INSTANCE_UID.number:
+              _DicomJsonValue(tags.STUDY_INSTANCE_UID, study_uid),
+          tags.MODALITIES_IN_STUDY.number:
+              _DicomJsonValue(tags.MODALITIES_IN_STUDY, 'MG'),
+      }])
+      return
+    self._Send(404, 'Not found: %s' % url.path, 'text/plain')
+
+  def _ReadImage(self, study_uid, series_uid, instance_uid):
+    # type: (str, str, str) -> Optional[str]
+    """Returns the image file of an instance, or None if there is none."""
+    series_dir = os.path.join(self.server.image_dir, study_uid, series_uid)
+    if os.path.isdir(series_dir):
+      for filename in os.listdir(series_dir):
+        if os.path.splitext(filename)[0] == instance_uid:
+          with open(os.path.join(series_dir, filename), 'rb') as f:
+            return f.read()
+    return None
+
+  def _WadoRs(self, study_uid, series_uid, instance_uid):
+    # type: (str, str, str) -> None
+    image = self._ReadImage(study_uid, series_uid, instance_uid)
+    if image is None:
+      self._Send(404, 'Instance not found: %s' % instance_uid, 'text/plain')
+      return
+    body, content_type = dicomweb._EncodeMultipartRelated(  # pylint: disable=protected-access
+        [image], 'image/jpeg')
+    self._Send(200, body, content_type)
+
+  def _Rendered(self, viewport, study_uid, series_uid, instance_uid):
+    # type: (Optional[str], str, str, str) -> None
+    image = self._ReadImage(study_uid, series_uid, instance_uid)
+    if image is None:
+      self._Send(404, 'Instance not found: %s' % instance_uid, 'text/plain')
+      return
+    if viewport:
+      # Pillow is only needed to benchmark the rendered resource.
+      from PIL import Image
+      rendered = Image.open(io.BytesIO(image))
+      rendered.thumbnail([int(size) for size in viewport.split(',')])
+      output = io.BytesIO()
+      rendered.save(output, 'JPEG')
+      image = output.getvalue()
+    self._Send(200, image, 'image/jpeg')
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    time.sleep(self.server.latency_secs)
+    length = int(self.headers.get('Content-Length', 0))
+    self.rfile.read(length)
+    self.server.CountBytes(0, length)
+    if not re.match(_STUDIES_PATH_REGEXP, urlparse.urlparse(self.path).path):
+      self._Send(404, 'Not found: %s' % self.path, 'text/plain')
+      return
+    self._SendJson({})
+
+
+class _StubPredictor(inference.Predictor):
+  """Predictor that returns a fixed prediction after a delay.
+
+  Args:
+    latency_secs: Number of seconds each prediction request takes.
+  """
+
+  def __init__(self, latency_secs):
+    self._latency_secs = latency_secs
+
+  def Predict(self, image_jpeg_bytes):
+    return self.PredictBatch([image_jpeg_bytes])[0]
+
+  def PredictBatch(self, images_jpeg_bytes):
+    time.sleep(self._latency_secs)
+    return [('2', 1.0)] * len(images_jpeg_bytes)
+
+
+class _UnrecordedProcessedSet(object):
+  """ProcessedSet that records nothing.
+
+  The same instance paths are replayed by every run, and with --repeat, within
+  a run. A ProcessedSet would ack them as duplicates without processing them.
+  """
+
+  def __contains__(self, key):
+    return False
+
+  def Add(self, key):
+    pass
+
+
+class _FakeMessage(object):
+  """Pub/Sub message whose ack or nack is reported to a _FakeFeed."""
+
+  def __init__(self, feed, data, publish_time):
+    self.data = data
+    self.attributes = {}
+    self._feed = feed
+    self._publish_time = publish_time
+
+  def ack(self):  # pylint: disable=invalid-name
+    self._feed.Done(self, 'ack', self._publish_time)
+
+  def nack(self):  # pylint: disable=invalid-name
+    self._feed.Done(self, 'nack', self._publish_time)
+
+
+class _FakeFeed(object):
+  """Replays instance paths to a Pub/Sub callback.
+
+  As in the Pub/Sub subscriber, the callback runs on a bounded thread pool,
+  and no more messages are delivered while max_outstanding messages are
+  neither acked nor nacked.
+
+  Args:
+    instance_paths: Instance paths to publish, in order.
+    rate: Number of messages published per second. Unlimited if 0.
+    callback_threads: Number of threads running the callback.
+    max_outstanding: Maximum number of messages delivered but not acked or
+      nacked.
+  """
+
+  def __init__(self, instance_paths, rate, callback_threads, max_outstanding):
+    self._instance_paths = instance_paths
+    self._rate = rate
+    self._callback_threads = callback_threads
+    self._outstanding = threading.Semaphore(max_outstanding)
+    self._lock = threading.Lock()
+    self._all_done = threading.Event()
+    self._latencies = []
+    self._outcomes = collections.Counter()
+
+  def Done(self, message, outcome, publish_time):
+    # type: (_FakeMessage, str, float) -> None
+    """Records the ack or nack of a message."""
+    del message  # Unused.
+    with self._lock:
+      self._latencies.append(time.time() - publish_time)
+      self._outcomes[outcome] += 1
+      if len(self._latencies) == len(self._instance_paths):
+        self._all_done.set()
+    self._outstanding.release()
+
+  def Run(self, callback):
+    # type: (Callable[[_FakeMessage], None]) -> (List[float], Counter)
+    """Publishes all messages, and waits until they are acked or nacked.
+
+    Args:
+      callback: Function called with each message.
+
+    Returns:
+      (latencies, outcomes) tuple, the end-to-end latency in seconds of each
+      message and the number of messages by outcome.
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=self._callback_threads)
+    start_time = time.time()
+    for i, instance_path in enumerate(self._instance_paths):
+      if self._rate:
+        time.sleep(max(0, start_time + i / self._rate - time.time()))
+      # Time spent waiting for flow control counts towards the latency.
+      publish_time = time.time()
+      self._outstanding.acquire()
+      executor.submit(callback, _FakeMessage(self, instance_path, publish_time))
+    if not self._all_done.wait(_DRAIN_TIMEOUT_SECS):
+      raise RuntimeError('Messages were not acked within %d seconds' %
+                         _DRAIN_TIMEOUT_SECS)
+    executor.shutdown()
+    return self._latencies, self._outcomes
+
+
+def _GetRss():
+  # type: () -> int
+  """Returns the current resident set size of the process, in bytes."""
+  with open('/proc/self/statm') as f:
+    resident_pages = int(f.read().split()[1])
+  return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class _RssSampler(object):
+  """Samples the resident set size of the process on a background thread.
+
+  Unlike ru_maxrss, which is the peak over the lifetime of the process, this
+  measures the peak during one run only, so that a run is not charged for the
+  memory used by a previous run with a higher concurrency.
+  """
+
+  def __init__(self):
+    self.start_rss = _GetRss()
+    self.peak_rss = self.start_rss
+    self.end_rss = self.start_rss
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._Sample)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Sample(self):
+    while not self._stopped.wait(_RSS_SAMPLING_INTERVAL_SECS):
+      self.peak_rss = max(self.peak_rss, _GetRss())
+
+  def Stop(self):
+    # type: () -> None
+    """Stops sampling, and takes the last sample."""
+    self._stopped.set()
+    self._thread.join()
+    self.end_rss = _GetRss()
+    self.peak_rss = max(self.peak_rss, self.end_rss)
+
+
+def _ListInstancePaths(image_dir):
+  # type: str -> List[str]
+  """Returns the instance paths of all images in image_dir."""
+  instance_paths = []
+  for study_uid in sorted(os.listdir(image_dir)):
+    study_dir = os.path.join(image_dir, study_uid)
+    if not os.path.isdir(study_dir):
+      continue
+    for series_uid in sorted(os.listdir(study_dir)):
+      series_dir = os.path.join(study_dir, series_uid)
+      for filename in sorted(os.listdir(series_dir)):
+        instance_uid = os.path.splitext(filename)[0]
+        instance_paths.append(
+            '%s/dicomWeb/studies/%s/series/%s/instances/%s' %
+            (_DICOM_STORE_PATH, study_uid, series_uid, instance_uid))
+  return instance_paths
+
+
+def _Percentile(values, percentile):
+  # type: (List[float], float) -> float
+  """Returns the nearest-rank percentile of values."""
+  values = sorted(values)
+  index = max(0, int(round(percentile / 100 * len(values))) - 1)
+  return values[index]
+
+
+def _GetMessageCount(outcome):
+  # type: str -> float
+  """Returns the number of messages with outcome handled in this process."""
+  return prometheus_client.REGISTRY.get_sample_value(
+      'inference_messages_total', {'outcome': outcome}) or 0
+
+
+def _RunBenchmark(server, instance_paths, concurrency):
+  # type: (_FakeDicomWebServer, List[str], int) -> None
+  """Replays instance_paths through a new PubsubMessageHandler, and reports.
+
+  Args:
+    server: Fake DICOMweb server the handler sends requests to.
+    instance_paths: Instance paths to replay.
+    concurrency: Number of callback threads, and maximum concurrency of each
+      pipeline stage.
+  """
+  dicomweb_client = dicomweb.DicomWebClient(
+      None, url_prefix=server.url_prefix, max_connections=concurrency)
+  predictor = _StubPredictor(FLAGS.predict_latency_ms / 1000)
+  if FLAGS.prediction_batch_size > 1:
+    predictor = inference.BatchingPredictor(
+        predictor, FLAGS.prediction_batch_size,
+        FLAGS.prediction_batch_latency_ms / 1000)
+  handler = inference.PubsubMessageHandler(
+      predictor,
+      _DICOM_STORE_PATH,
+      dicomweb_client,
+      fetch_concurrency=concurrency,
+      predict_concurrency=concurrency,
+      stow_writer=dicomweb.StowRsWriter(
+          dicomweb_client,
+          max_batch_size=FLAGS.stow_batch_size,
+          max_concurrency=concurrency),
+      rendered_viewport=FLAGS.rendered_viewport,
+      downscale_size=FLAGS.downscale_size,
+      processed_set=_UnrecordedProcessedSet())
+  feed = _FakeFeed(instance_paths, FLAGS.rate, concurrency,
+                   FLAGS.max_outstanding_messages)
+
+  server.ResetByteCounts()
+  duplicates = _GetMessageCount(metrics.DUPLICATE_OUTCOME)
+  rss_sampler = _RssSampler()
+  start_time = time.time()
+  latencies, outcomes = feed.Run(handler.PubsubCallback)
+  elapsed_secs = time.time() - start_time
+  rss_sampler.Stop()
+  predictor.Close()
+  bytes_sent, bytes_received = server.ResetByteCounts()
+  duplicates = _GetMessageCount(metrics.DUPLICATE_OUTCOME) - duplicates
+  if duplicates:
+    raise RuntimeError('%d messages were acked as duplicates without being '
+                       'processed' % duplicates)
+
+  print('concurrency=%d messages=%d %s' %
+        (concurrency, len(latencies), ' '.join(
+            '%s=%d' % item for item in sorted(outcomes.items()))))
+  print('  throughput: %.1f messages/s' % (len(latencies) / elapsed_secs))
+  print('  latency: p50=%.1f ms p99=%.1f ms max=%.1f ms' %
+        (_Percentile(latencies, 50) * 1000, _Percentile(latencies, 99) * 1000,
+         max(latencies) * 1000))
+  mib = 1024 * 1024
+  print('  RSS: start=%.1f MiB peak=%+.1f MiB end=%+.1f MiB' %
+        (rss_sampler.start_rss / mib,
+         (rss_sampler.peak_rss - rss_sampler.start_rss) / mib,
+         (rss_sampler.end_rss - rss_sampler.start_rss) / mib))
+  print('  DICOMweb bytes: sent=%d received=%d' % (bytes_sent, bytes_received))
+  sys.stdout.flush()
+
+
+def main():
+  if FLAGS.instance_paths_file:
+    with open(FLAGS.instance_paths_file) as f:
+      instance_paths = [line.strip() for line in f if line.strip()]
+  else:
+    instance_paths = _ListInstancePaths(FLAGS.image_dir)
+  instance_paths *= FLAGS.repeat
+  if not instance_paths:
+    raise ValueError('No instances to replay in %s' % FLAGS.image_dir)
+
+  server = _FakeDicomWebServer(FLAGS.image_dir,
+                               FLAGS.dicomweb_latency_ms / 1000)
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  try:
+    for concurrency in FLAGS.concurrency.split(','):
+      _RunBenchmark(server, instance_paths, int(concurrency))
+  finally:
+    server.shutdown()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--image_dir',
+      type=str,
+      required=True,
+      help='Directory of images served by the fake DICOMweb server, laid out '
+      'as <STUDY_UID>/<SERIES_UID>/<INSTANCE_UID>.jpg.')
+  parser.add_argument(
+      '--instance_paths_file',
+      type=str,
+      default=None,
+      help='File of recorded Pub/Sub message payloads to replay, one instance '
+      'path per line. The paths must be under %s. If not set, every image in '
+      '--image_dir is replayed.' % _DICOM_STORE_PATH)
+  parser.add_argument(
+      '--repeat',
+      type=int,
+      default=1,
+      help='Number of times the instance paths are replayed in each run.')
+  parser.add_argument(
+      '--rate',
+      type=float,
+      default=0,
+      help='Number of messages published per second. If 0, messages are '
+      'published as fast as flow control allows.')
+  parser.add_argument(
+      '--concurrency',
+      type=str,
+      default='1,4,16',
+      help='Comma separated concurrency settings to run. Each sets the number '
+      'of callback threads, and the maximum concurrency of the fetch, predict '
+      'and STOW-RS stages.')
+  parser.add_argument(
+      '--max_outstanding_messages',
+      type=int,
+      default=100,
+      help='Maximum number of messages delivered but not acked or nacked, as '
+      'in the flow control of the Pub/Sub subscriber.')
+  parser.add_argument(
+      '--predict_latency_ms',
+      type=int,
+      default=100,
+      help='Number of milliseconds each request to the stub predictor takes.')
+  parser.add_argument(
+      '--prediction_batch_size',
+      type=int,
+      default=1,
+      help='Maximum number of images in a prediction request.')
+  parser.add_argument(
+      '--prediction_batch_latency_ms',
+      type=int,
+      default=50,
+      help='Maximum number of milliseconds an image waits for its prediction '
+      'batch to fill up.')
+  parser.add_argument(
+      '--stow_batch_size',
+      type=int,
+      default=dicomweb.DEFAULT_STOW_BATCH_SIZE,
+      help='Maximum number of structured reports stored with one STOW-RS '
+      'request.')
+  parser.add_argument(
+      '--rendered_viewport',
+      type=str,
+      default=None,
+      help='If set, e.g. "299,299", images are retrieved from the rendered '
+      'resource, scaled by the server to fit in this viewport.')
+  parser.add_argument(
+      '--downscale_size',
+      type=int,
+      default=None,
+      help='If set, e.g. 299, images are scaled down by the handler after '
+      'being retrieved, keeping their smaller side at least this many pixels.')
+  parser.add_argument(
+      '--dicomweb_latency_ms',
+      type=int,
+      default=0,
+      help='Number of milliseconds added to each request by the fake DICOMweb '
+      'server, to emulate the round trip to the Healthcare API.')
+  FLAGS = parser.parse_args()
+  main()
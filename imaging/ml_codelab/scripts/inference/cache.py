@@ -0,0 +1,125 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-memory caches used by the inference module."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+from concurrent import futures
+
+# Marks a missing cache entry, since None is a valid cached value.
+_MISSING = object()
+
+
+class LruCache(object):
+  """Thread-safe LRU cache whose entries can expire.
+
+  Args:
+    max_size: Maximum number of entries. When full, the least recently used
+      entry is evicted. Nothing is cached if max_size is 0.
+    ttl_secs: Number of seconds after which an entry expires. If None, entries
+      only leave the cache when evicted.
+  """
+
+  def __init__(self, max_size, ttl_secs=None):
+    self._max_size = max_size
+    self._ttl_secs = ttl_secs
+    self._lock = threading.Lock()
+    # Maps key -> (expiry time, value), from least to most recently used.
+    self._entries = collections.OrderedDict()
+    # Maps key -> Future of the computation in progress for the key.
+    self._pending = {}
+
+  def _GetLocked(self, key):
+    # type: Hashable -> Any
+    """Returns the fresh value for key, or _MISSING. Requires self._lock."""
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return _MISSING
+    expiry, value = entry
+    if expiry is not None and expiry < time.time():
+      return _MISSING
+    # Re-insert to mark the entry as most recently used.
+    self._entries[key] = entry
+    return value
+
+  def _PutLocked(self, key, value):
+    # type: (Hashable, Any) -> None
+    """Stores value for key, evicting old entries. Requires self._lock."""
+    if self._max_size <= 0:
+      return
+    expiry = None
+    if self._ttl_secs is not None:
+      expiry = time.time() + self._ttl_secs
+    self._entries.pop(key, None)
+    self._entries[key] = (expiry, value)
+    while len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+
+  def Get(self, key, default=None):
+    # type: (Hashable, Any) -> Any
+    """Returns the cached value for key, or default if there is none."""
+    with self._lock:
+      value = self._GetLocked(key)
+    return default if value is _MISSING else value
+
+  def Put(self, key, value):
+    # type: (Hashable, Any) -> None
+    """Caches value for key."""
+    with self._lock:
+      self._PutLocked(key, value)
+
+  def GetOrCompute(self, key, compute_fn):
+    # type: (Hashable, Callable[[], Any]) -> Any
+    """Returns the cached value for key, computing and caching it if missing.
+
+    Concurrent calls for the same missing key share a single call to
+    compute_fn. If compute_fn raises, the exception is raised in every waiting
+    caller and nothing is cached.
+
+    Args:
+      key: Cache key.
+      compute_fn: Function without arguments that returns the value for key.
+
+    Returns:
+      The cached or computed value.
+    """
+    with self._lock:
+      value = self._GetLocked(key)
+      if value is not _MISSING:
+        return value
+      pending = self._pending.get(key)
+      if pending is None:
+        future = futures.Future()
+        self._pending[key] = future
+    if pending is not None:
+      return pending.result()
+
+    try:
+      value = compute_fn()
+    except Exception as e:  # pylint: disable=broad-except
+      with self._lock:
+        del self._pending[key]
+      future.set_exception(e)
+      raise
+    with self._lock:
+      self._PutLocked(key, value)
+      del self._pending[key]
+    future.set_result(value)
+    return value
@@ -0,0 +1,173 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for cache.LruCache.
+
+Run from this directory with: python -m unittest cache_test
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import unittest
+
+import cache
+
+# Number of seconds a test waits for a thread before failing.
+_TIMEOUT_SECS = 10
+
+
+class _FakeClock(object):
+  """Stands in for the time module of cache. Time only moves on demand."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):  # pylint: disable=invalid-name
+    return self.now
+
+
+class LruCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._clock = _FakeClock()
+    self._time = cache.time
+    cache.time = self._clock
+
+  def tearDown(self):
+    cache.time = self._time
+
+  def test_get_and_put(self):
+    lru_cache = cache.LruCache(10)
+
+    lru_cache.Put('a', 1)
+
+    self.assertEqual(lru_cache.Get('a'), 1)
+    self.assertIsNone(lru_cache.Get('b'))
+    self.assertEqual(lru_cache.Get('b', default=2), 2)
+
+  def test_caches_none(self):
+    lru_cache = cache.LruCache(10)
+
+    lru_cache.Put('a', None)
+
+    self.assertIsNone(lru_cache.Get('a', default=1))
+
+  def test_evicts_least_recently_used_entries(self):
+    lru_cache = cache.LruCache(2)
+
+    lru_cache.Put('a', 1)
+    lru_cache.Put('b', 2)
+    lru_cache.Get('a')
+    lru_cache.Put('c', 3)
+
+    self.assertEqual(lru_cache.Get('a'), 1)
+    self.assertIsNone(lru_cache.Get('b'))
+    self.assertEqual(lru_cache.Get('c'), 3)
+
+  def test_caches_nothing_without_size(self):
+    lru_cache = cache.LruCache(0)
+
+    lru_cache.Put('a', 1)
+
+    self.assertIsNone(lru_cache.Get('a'))
+
+  def test_entries_expire(self):
+    lru_cache = cache.LruCache(10, ttl_secs=60)
+    lru_cache.Put('a', 1)
+
+    self._clock.now += 60
+    self.assertEqual(lru_cache.Get('a'), 1)
+    self._clock.now += 1
+    self.assertIsNone(lru_cache.Get('a'))
+
+  def test_put_renews_expiry(self):
+    lru_cache = cache.LruCache(10, ttl_secs=60)
+    lru_cache.Put('a', 1)
+
+    self._clock.now += 50
+    lru_cache.Put('a', 2)
+    self._clock.now += 50
+
+    self.assertEqual(lru_cache.Get('a'), 2)
+
+  def test_get_or_compute_caches_value(self):
+    lru_cache = cache.LruCache(10)
+    calls = []
+
+    def _Compute():
+      calls.append(1)
+      return 'value'
+
+    values = [lru_cache.GetOrCompute('a', _Compute) for _ in range(3)]
+
+    self.assertEqual(values, ['value'] * 3)
+    self.assertEqual(len(calls), 1)
+
+  def test_get_or_compute_recomputes_expired_value(self):
+    lru_cache = cache.LruCache(10, ttl_secs=60)
+    values = iter([1, 2])
+    lru_cache.GetOrCompute('a', lambda: next(values))
+
+    self._clock.now += 61
+
+    self.assertEqual(lru_cache.GetOrCompute('a', lambda: next(values)), 2)
+
+  def test_get_or_compute_is_single_flight(self):
+    lru_cache = cache.LruCache(10)
+    started = threading.Event()
+    gate = threading.Event()
+    calls = []
+
+    def _Compute():
+      calls.append(1)
+      started.set()
+      gate.wait(_TIMEOUT_SECS)
+      return 'value'
+
+    values = []
+    threads = [
+        threading.Thread(
+            target=lambda: values.append(lru_cache.GetOrCompute('a', _Compute)))
+        for _ in range(5)
+    ]
+    threads[0].start()
+    started.wait(_TIMEOUT_SECS)
+    # The computation is in progress until the gate opens, so the other calls
+    # wait for it instead of computing the value again.
+    for thread in threads[1:]:
+      thread.start()
+    gate.set()
+    for thread in threads:
+      thread.join(_TIMEOUT_SECS)
+
+    self.assertEqual(values, ['value'] * 5)
+    self.assertEqual(len(calls), 1)
+
+  def test_get_or_compute_does_not_cache_exception(self):
+    lru_cache = cache.LruCache(10)
+
+    def _Fail():
+      raise RuntimeError('Failed')
+
+    with self.assertRaises(RuntimeError):
+      lru_cache.GetOrCompute('a', _Fail)
+
+    self.assertIsNone(lru_cache.Get('a'))
+    self.assertEqual(lru_cache.GetOrCompute('a', lambda: 'value'), 'value')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,86 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record of the Pub/Sub messages already processed by the inference module.
+
+Pub/Sub delivers each message at least once, so the same instance may be
+received again, e.g. after the subscriber restarted before its acks were sent.
+The ProcessedSet remembers which instances were processed, so that redelivered
+messages can be acked without being processed again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sqlite3
+import threading
+import time
+
+import cache
+
+# Pub/Sub does not retain messages for longer than 7 days, so older journal
+# entries can not match a redelivered message.
+_JOURNAL_RETENTION_SECS = 7 * 24 * 60 * 60
+
+
+class ProcessedSet(object):
+  """Thread-safe set of processed keys, optionally journaled to disk.
+
+  The most recently added keys are kept in memory. If a journal path is given,
+  all keys are also written to a SQLite database, so that they are remembered
+  across restarts of the subscriber.
+
+  Args:
+    max_size: Maximum number of keys kept in memory.
+    journal_path: Path of the SQLite database journaling the keys. If None,
+      keys are only kept in memory.
+  """
+
+  def __init__(self, max_size, journal_path=None):
+    self._keys = cache.LruCache(max_size)
+    self._journal = None
+    self._journal_lock = threading.Lock()
+    if journal_path:
+      self._journal = sqlite3.connect(journal_path, check_same_thread=False)
+      with self._journal:
+        self._journal.execute('CREATE TABLE IF NOT EXISTS processed '
+                              '(key TEXT PRIMARY KEY, time REAL NOT NULL)')
+        self._journal.execute('DELETE FROM processed WHERE time < ?',
+                              (time.time() - _JOURNAL_RETENTION_SECS,))
+
+  def __contains__(self, key):
+    # type: str -> bool
+    if self._keys.Get(key, False):
+      return True
+    if self._journal is None:
+      return False
+    with self._journal_lock:
+      row = self._journal.execute('SELECT 1 FROM processed WHERE key = ?',
+                                  (key,)).fetchone()
+    if row is None:
+      return False
+    self._keys.Put(key, True)
+    return True
+
+  def Add(self, key):
+    # type: str -> None
+    """Records key as processed."""
+    self._keys.Put(key, True)
+    if self._journal is None:
+      return
+    with self._journal_lock:
+      with self._journal:
+        self._journal.execute(
+            'INSERT OR REPLACE INTO processed (key, time) VALUES (?, ?)',
+            (key, time.time()))
@@ -0,0 +1,94 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for dedup.ProcessedSet.
+
+Run from this directory with: python -m unittest dedup_test
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import dedup
+
+
+class ProcessedSetTest(unittest.TestCase):
+
+  def setUp(self):
+    self._temp_dir = tempfile.mkdtemp()
+    self._journal_path = os.path.join(self._temp_dir, 'processed.db')
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def test_add(self):
+    processed_set = dedup.ProcessedSet(10)
+
+    processed_set.Add('a')
+
+    self.assertIn('a', processed_set)
+    self.assertNotIn('b', processed_set)
+
+  def test_evicts_least_recently_used_keys(self):
+    processed_set = dedup.ProcessedSet(2)
+
+    processed_set.Add('a')
+    processed_set.Add('b')
+    self.assertIn('a', processed_set)
+    processed_set.Add('c')
+
+    self.assertIn('a', processed_set)
+    self.assertNotIn('b', processed_set)
+    self.assertIn('c', processed_set)
+
+  def test_journal_keeps_evicted_keys(self):
+    processed_set = dedup.ProcessedSet(1, self._journal_path)
+
+    processed_set.Add('a')
+    processed_set.Add('b')
+
+    self.assertIn('a', processed_set)
+    self.assertIn('b', processed_set)
+
+  def test_journal_reloaded_after_restart(self):
+    dedup.ProcessedSet(10, self._journal_path).Add('a')
+
+    processed_set = dedup.ProcessedSet(10, self._journal_path)
+
+    self.assertIn('a', processed_set)
+    self.assertNotIn('b', processed_set)
+
+  def test_journal_drops_keys_past_retention(self):
+    dedup.ProcessedSet(10, self._journal_path).Add('recent')
+    journal = sqlite3.connect(self._journal_path)
+    with journal:
+      journal.execute('INSERT INTO processed (key, time) VALUES (?, ?)',
+                      ('old', time.time() - dedup._JOURNAL_RETENTION_SECS - 1))
+    journal.close()
+
+    processed_set = dedup.ProcessedSet(10, self._journal_path)
+
+    self.assertIn('recent', processed_set)
+    self.assertNotIn('old', processed_set)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,642 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""DICOMweb client for the Cloud Healthcare API.
+
+All DICOMweb requests made by the inference module go through a single
+DicomWebClient. The client keeps a bounded pool of keep-alive connections that
+is shared by all threads, so that consecutive WADO-RS, QIDO-RS and STOW-RS
+requests do not each pay for a new TLS handshake. The OAuth2 access token is
+refreshed proactively shortly before it expires, rather than after a request
+has been rejected.
+
+WADO-RS responses are decoded while they are being received. Each part of the
+multipart response is written to a spooled buffer, so no full copy of the
+response body is held in memory next to the decoded parts.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cgi
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent import futures
+import httplib2
+import requests
+from requests import adapters
+import tags
+
+# Prefix for Cloud Healthcare API.
+HEALTHCARE_API_URL_PREFIX = 'https://healthcare.googleapis.com/v1beta1'
+
+# Maximum number of connections kept open to the Healthcare API.
+_DEFAULT_MAX_CONNECTIONS = 10
+
+# Number of seconds to wait for the server before giving up on a request.
+_DEFAULT_TIMEOUT_SECS = 60
+
+# Access tokens are refreshed once they are this close to expiring.
+_TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# HTTP status returned when the access token was rejected.
+_UNAUTHORIZED_STATUS = 401
+
+# Number of bytes read from the network at a time when streaming a response.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Parts of a WADO-RS response larger than this are spooled to disk.
+_DEFAULT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+# Headers for receiving DICOM in JPEG Baseline format.
+_JPEG_ACCEPT_HEADER = ('multipart/related; type="image/jpeg"; '
+                       'transfer-syntax=1.2.840.10008.1.2.4.50')
+
+# Media type of the images returned by the rendered resources.
+_JPEG_TYPE = 'image/jpeg'
+
+# Media type of DICOM JSON instances and STOW-RS responses.
+_DICOM_JSON_TYPE = 'application/dicom+json'
+
+# STOW-RS statuses whose response lists the instances that failed.
+_STOW_PARTIAL_FAILURE_STATUSES = (202, 409)
+
+# STOW-RS failure reason of an instance whose SOP Instance UID is already
+# stored (PS3.7 "Duplicate SOP instance").
+_DUPLICATE_SOP_INSTANCE_REASON = 0x0111
+
+# Default limits of a batched STOW-RS request.
+DEFAULT_STOW_BATCH_SIZE = 1
+DEFAULT_STOW_BATCH_BYTES = 8 * 1024 * 1024
+DEFAULT_STOW_BATCH_LATENCY_SECS = 0.1
+DEFAULT_STOW_CONCURRENCY = 4
+
+
+def _EncodeMultipartRelated(parts, content_type):
+  # type: (List[str], str) -> (str, str)
+  """Serializes parts into a multipart/related body.
+
+  Args:
+    parts: List of part bodies.
+    content_type: Content type of every part.
+
+  Returns:
+    (body, content_type) tuple, where content_type is the Content-Type header
+    of the request, including the boundary.
+  """
+  boundary = uuid.uuid4().hex
+  delimiter = '--%s\r\n' % boundary
+  part_headers = 'Content-Type: %s\r\n\r\n' % content_type
+  chunks = []
+  for part in parts:
+    chunks.extend((delimiter, part_headers, part, '\r\n'))
+  chunks.append('--%s--\r\n' % boundary)
+  return ''.join(chunks), ('multipart/related; type="%s"; boundary=%s' %
+                           (content_type, boundary))
+
+
+def _ParseStowFailures(content):
+  # type: str -> Dict[str, int]
+  """Returns the failed instances listed in a STOW-RS response.
+
+  Args:
+    content: DICOM JSON body of the STOW-RS response.
+
+  Returns:
+    Dict mapping SOP Instance UID to failure reason, or None if the response
+    can not be parsed.
+  """
+  try:
+    response = json.loads(content)
+  except ValueError:
+    return None
+  # The response is a single dataset, which some servers wrap in a list.
+  if isinstance(response, list):
+    response = response[0] if response else {}
+  failures = {}
+  failed_sops = response.get(tags.FAILED_SOP_SEQUENCE.number, {})
+  for failed_sop in failed_sops.get('Value', []):
+    uid = failed_sop.get(tags.REFERENCED_SOP_INSTANCE_UID.number,
+                         {}).get('Value', [None])[0]
+    reason = failed_sop.get(tags.FAILURE_REASON.number,
+                            {}).get('Value', [None])[0]
+    failures[uid] = reason
+  return failures
+
+
+def _IterMultipartParts(chunks, boundary, spool_max_bytes):
+  # type: (Iterable[str], str, int) -> Iterator[(Dict[str, str], file)]
+  """Decodes a multipart body while it is being received.
+
+  Only the current chunk and a delimiter's worth of bytes are kept in memory.
+  Each part body is written to a SpooledTemporaryFile, which moves to disk once
+  it grows beyond spool_max_bytes.
+
+  Args:
+    chunks: Iterable over the chunks of the multipart body.
+    boundary: Multipart boundary from the Content-Type header.
+    spool_max_bytes: Size above which a part body is spooled to disk.
+
+  Yields:
+    (headers, body) tuples. headers maps lowercase header names to values.
+    body is a file object positioned at the start of the part body. It is only
+    valid until the next part is requested.
+
+  Raises:
+    RuntimeError: If the body is not a well-formed multipart body.
+  """
+  # Prepending CRLF lets the first delimiter match like all the others.
+  delimiter = b'\r\n--' + boundary
+  buf = bytearray(b'\r\n')
+  chunks = iter(chunks)
+
+  def _Fill():
+    # type: None -> bool
+    """Appends the next chunk to buf. Returns False at the end of the body."""
+    for chunk in chunks:
+      if chunk:
+        buf.extend(chunk)
+        return True
+    return False
+
+  # Skip the preamble up to the first delimiter.
+  while True:
+    idx = buf.find(delimiter)
+    if idx != -1:
+      del buf[:idx + len(delimiter)]
+      break
+    del buf[:max(0, len(buf) - len(delimiter))]
+    if not _Fill():
+      raise RuntimeError('Multipart body has no boundary %s' % boundary)
+
+  while True:
+    # After a delimiter: "--" closes the body, otherwise headers follow.
+    while len(buf) < 2 and _Fill():
+      pass
+    if buf[:2] == b'--':
+      return
+    headers_end = buf.find(b'\r\n\r\n')
+    while headers_end == -1:
+      if not _Fill():
+        raise RuntimeError('Truncated multipart part headers')
+      headers_end = buf.find(b'\r\n\r\n')
+    headers = {}
+    for line in bytes(buf[:headers_end]).split(b'\r\n'):
+      if b':' in line:
+        name, value = line.split(b':', 1)
+        headers[name.strip().lower()] = value.strip()
+    del buf[:headers_end + 4]
+
+    body = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+    while True:
+      idx = buf.find(delimiter)
+      if idx != -1:
+        body.write(buf[:idx])
+        del buf[:idx + len(delimiter)]
+        break
+      # Keep a possible partial delimiter at the end of the buffer.
+      keep = len(delimiter) - 1
+      if len(buf) > keep:
+        body.write(buf[:len(buf) - keep])
+        del buf[:len(buf) - keep]
+      if not _Fill():
+        raise RuntimeError('Multipart body ended without closing boundary')
+    body.seek(0)
+    yield headers, body
+    body.close()
+
+
+class DicomWebClient(object):
+  """Thread-safe DICOMweb client backed by a pool of keep-alive connections.
+
+  Attributes:
+    url_prefix: Prefix of the DICOMweb service, e.g. HEALTHCARE_API_URL_PREFIX.
+
+  Args:
+    credentials: oauth2client credentials used to authorize requests. If None,
+      requests are sent without an Authorization header.
+    url_prefix: Prefix of the DICOMweb service.
+    max_connections: Maximum number of concurrently open connections. Requests
+      block until a connection is available once this limit is reached.
+    timeout: Number of seconds to wait for the server on each request.
+    spool_max_bytes: WADO-RS response parts larger than this are spooled to
+      disk while they are received.
+  """
+
+  def __init__(self,
+               credentials,
+               url_prefix=HEALTHCARE_API_URL_PREFIX,
+               max_connections=_DEFAULT_MAX_CONNECTIONS,
+               timeout=_DEFAULT_TIMEOUT_SECS,
+               spool_max_bytes=_DEFAULT_SPOOL_MAX_BYTES):
+    self.url_prefix = url_prefix
+    self._credentials = credentials
+    self._timeout = timeout
+    self._spool_max_bytes = spool_max_bytes
+    self._token_lock = threading.Lock()
+    self._session = requests.Session()
+    adapter = adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+    self._session.mount('https://', adapter)
+    self._session.mount('http://', adapter)
+
+  def _RefreshToken(self, force=False):
+    # type: bool -> None
+    """Refreshes the access token if it is missing or about to expire."""
+    credentials = self._credentials
+    with self._token_lock:
+      expiry = credentials.token_expiry
+      if not (force or credentials.access_token is None or credentials.invalid
+              or (expiry is not None and
+                  expiry - datetime.datetime.utcnow() < _TOKEN_REFRESH_MARGIN)):
+        return
+      # oauth2client only knows how to refresh through httplib2.
+      credentials.refresh(httplib2.Http())
+
+  def _AuthorizationHeaders(self, force_refresh=False):
+    # type: bool -> Dict[str, str]
+    """Returns the headers needed to authorize a request."""
+    headers = {}
+    if self._credentials is None:
+      return headers
+    self._RefreshToken(force_refresh)
+    self._credentials.apply(headers)
+    return headers
+
+  def _Request(self, method, url, headers=None, data=None, stream=False):
+    # type: (str, str, Dict[str, str], str, bool) -> requests.Response
+    """Sends an authorized request over a pooled connection.
+
+    If the access token is rejected (e.g. it was revoked before its expiry),
+    the token is refreshed and the request is retried once.
+
+    If stream is True, the body is not read, and the caller must close the
+    response to return its connection to the pool.
+
+    Raises:
+      RuntimeError: If the request could not be sent or its response could not
+        be received, e.g. on a connection error or timeout.
+    """
+    request_headers = dict(headers or {})
+    request_headers.update(self._AuthorizationHeaders())
+    try:
+      resp = self._session.request(
+          method,
+          url,
+          headers=request_headers,
+          data=data,
+          timeout=self._timeout,
+          stream=stream)
+      if resp.status_code == _UNAUTHORIZED_STATUS and self._credentials:
+        resp.close()
+        request_headers.update(self._AuthorizationHeaders(force_refresh=True))
+        resp = self._session.request(
+            method,
+            url,
+            headers=request_headers,
+            data=data,
+            timeout=self._timeout,
+            stream=stream)
+    except requests.exceptions.RequestException as e:
+      # Callers only handle the RuntimeError raised for failed requests.
+      raise RuntimeError('%s request to %s failed: %s' % (method, url, e))
+    return resp
+
+  def IterWadoRsParts(self, path, accept=_JPEG_ACCEPT_HEADER):
+    # type: (str, str) -> Iterator[(Dict[str, str], file)]
+    """Streams the parts of a multipart WADO-RS response.
+
+    This works for any multipart WADO-RS resource, e.g. the frames of a
+    multi-frame instance or all instances of a series.
+
+    Args:
+      path: Path of the WADO-RS resource, relative to url_prefix.
+      accept: Accept header of the request.
+
+    Yields:
+      (headers, body) tuples, see _IterMultipartParts.
+
+    Raises:
+      RuntimeError: If failed to retrieve or decode the response.
+    """
+    wado_url = os.path.join(self.url_prefix, path)
+    resp = self._Request('GET', wado_url, headers={'Accept': accept},
+                         stream=True)
+    try:
+      if resp.status_code != 200:
+        raise RuntimeError('Failed to retrieve DICOM instance: (%s, %s)' %
+                           (resp.status_code, resp.content))
+      content_type, params = cgi.parse_header(resp.headers['content-type'])
+      if not content_type.startswith('multipart/') or 'boundary' not in params:
+        raise RuntimeError(
+            'WADO-RS response is not multipart: %s' % content_type)
+      for part in _IterMultipartParts(
+          resp.iter_content(chunk_size=_STREAM_CHUNK_SIZE), params['boundary'],
+          self._spool_max_bytes):
+        yield part
+    except requests.exceptions.RequestException as e:
+      raise RuntimeError('Failed to receive WADO-RS response: %s' % e)
+    finally:
+      resp.close()
+
+  def WadoRs(self, instance_path):
+    # type: str -> str
+    """Receives instance in JPEG format using WADO-RS protocol.
+
+    WADO-RS is one of the standard protocols specified by DICOMWeb protocol. It
+    allows clients to retrieve instances in various formats. In this case we
+    will retrieve the instance in JPEG format, from the DICOMweb service
+    specified by url_prefix.
+
+    Args:
+      instance_path: Path of DICOM instance. This is found in the contents of
+        the Pubsub message. This should be formatted as follows:
+          projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
+          dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_UID}/series/
+          {SERIES_UID}/instances/{INSTANCE_UID}
+
+    Returns:
+      content: The bytes for the JPEG image.
+
+    Raises:
+      RuntimeError: If failed to retrieve or process instance.
+    """
+    content = None
+    num_parts = 0
+    for _, body in self.IterWadoRsParts(instance_path):
+      num_parts += 1
+      if num_parts > 1:
+        # Stop downloading as soon as the response is known to be invalid.
+        break
+      content = body.read()
+    if num_parts != 1:
+      raise RuntimeError(
+          'Invalid number of WADO-RS response parts (need 1): %s' %
+          (str(num_parts)))
+    return content
+
+  def RenderedRs(self, instance_path, viewport=None):
+    # type: (str, Optional[str]) -> str
+    """Receives a rendered JPEG image of an instance.
+
+    Unlike WadoRs, the image is rendered by the server from the rendered
+    resource of the instance, and can be scaled down by the server before it
+    is sent, which saves transferring pixels that would be discarded anyway.
+
+    Args:
+      instance_path: Path of DICOM instance, see WadoRs.
+      viewport: If set, "width,height" of the viewport the image is scaled to
+        fit in.
+
+    Returns:
+      content: The bytes for the JPEG image.
+
+    Raises:
+      RuntimeError: If failed to retrieve the image.
+    """
+    rendered_url = os.path.join(self.url_prefix, instance_path, 'rendered')
+    if viewport:
+      rendered_url += '?viewport=%s' % viewport
+    resp = self._Request('GET', rendered_url, headers={'Accept': _JPEG_TYPE})
+    if resp.status_code != 200:
+      raise RuntimeError('Failed to retrieve rendered instance: (%s, %s)' %
+                         (resp.status_code, resp.content))
+    return resp.content
+
+  def StowRs(self, study_path, jsonstrs):
+    # type: (str, List[str]) -> Dict[str, int]
+    """Stores instances in Cloud Healthcare API using STOW-RS protocol.
+
+    STOW-RS is one of the standard protocols specified by DICOMWeb protocol. It
+    allows clients to store DICOM instances. In this case we will store the
+    instances in the DICOMweb service specified by url_prefix, all with one
+    multipart/related request.
+
+    Args:
+      study_path: Path of DICOM study. This should be formatted as follows:
+        projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
+        dicomStores/{DICOM_STORE_ID}/dicomWeb/studies
+      jsonstrs: List of JSON representations of DICOM instance(s) to store.
+        Each one is sent as a separate part of the request.
+
+    Returns:
+      Dict mapping the SOP Instance UID of each instance that failed to be
+      stored to its failure reason. Empty if all instances were stored.
+
+    Raises:
+      RuntimeError: If the request failed as a whole.
+    """
+    stow_url = os.path.join(self.url_prefix, study_path)
+    body, content_type = _EncodeMultipartRelated(jsonstrs, _DICOM_JSON_TYPE)
+    headers = {'content-type': content_type, 'accept': _DICOM_JSON_TYPE}
+
+    resp = self._Request('POST', stow_url, headers=headers, data=body)
+    if resp.status_code == 200:
+      return {}
+    if resp.status_code in _STOW_PARTIAL_FAILURE_STATUSES:
+      failures = _ParseStowFailures(resp.content)
+      # A 202 response without failed instances only carries warnings.
+      if failures or (failures is not None and resp.status_code == 202):
+        return failures
+    raise RuntimeError(
+        'Failed to store DICOM instance in Healthcare API: (%s, %s)' %
+        (resp.status_code, resp.content))
+
+  def QidoRs(self, qido_url):
+    # type: str -> List
+    """Performs the request, and returns the parsed JSON response.
+
+    QIDO-RS is one of the standard protocols specified by DICOMWeb protocol. It
+    allows clients to query metadata for DICOM instances.
+
+    Args:
+      qido_url: URL for the QIDO request.
+
+    Returns:
+      The parsed JSON response content.
+
+    Raises:
+      RuntimeError: if the response status was not 200.
+    """
+    resp = self._Request('GET', qido_url)
+    if resp.status_code != 200:
+      raise RuntimeError(
+          'QidoRs error. Response Status: %d,\nURL: %s,\nContent: %s.' %
+          (resp.status_code, qido_url, resp.content))
+    return json.loads(resp.content)
+
+
+class _PendingStowBatch(object):
+  """Instances waiting to be stored with one STOW-RS request.
+
+  Attributes:
+    instances: List of (SOP Instance UID, JSON string, Future) tuples.
+    num_bytes: Total size of the JSON strings.
+    deadline: Time at which the batch is sent, even if it is not full.
+  """
+
+  def __init__(self, deadline):
+    self.instances = []
+    self.num_bytes = 0
+    self.deadline = deadline
+
+
+class StowRsWriter(object):
+  """Buffers DICOM JSON instances and stores them with batched STOW-RS.
+
+  Instances written for the same study path (i.e. the same DICOM store) are
+  sent together in one multipart/related request, once max_batch_size instances
+  or max_batch_bytes bytes are buffered, or max_latency_secs after the first
+  instance of the batch was written. Each instance gets its own future, so a
+  failure of one instance in the response only fails that instance.
+
+  Batches whose latency is up are sent by a single flusher thread, started
+  with the first batch that is not sent right away.
+
+  An instance that is rejected because its SOP Instance UID is already stored
+  counts as stored. Callers that derive the UIDs from their input can thus
+  safely retry writes.
+
+  Args:
+    client: DicomWebClient used to send the requests.
+    max_batch_size: Maximum number of instances per request.
+    max_batch_bytes: Maximum total size of the instances in a request.
+    max_latency_secs: Maximum time an instance waits for its batch to fill up.
+    max_concurrency: Maximum number of concurrent STOW-RS requests.
+  """
+
+  def __init__(self,
+               client,
+               max_batch_size=DEFAULT_STOW_BATCH_SIZE,
+               max_batch_bytes=DEFAULT_STOW_BATCH_BYTES,
+               max_latency_secs=DEFAULT_STOW_BATCH_LATENCY_SECS,
+               max_concurrency=DEFAULT_STOW_CONCURRENCY):
+    self._client = client
+    self._max_batch_size = max_batch_size
+    self._max_batch_bytes = max_batch_bytes
+    self._max_latency_secs = max_latency_secs
+    self._executor = futures.ThreadPoolExecutor(max_workers=max_concurrency)
+    # Reentrant, since a done callback runs right away if the request already
+    # completed when it is added.
+    self._lock = threading.RLock()
+    # Notified when a batch is added to self._pending.
+    self._batch_added = threading.Condition(self._lock)
+    self._flusher = None
+    # Maps study path -> _PendingStowBatch being filled for it.
+    self._pending = {}
+    # Futures of the requests that have been sent but not completed.
+    self._in_flight = set()
+
+  def Write(self, study_path, sop_instance_uid, jsonstr):
+    # type: (str, str, str) -> futures.Future
+    """Buffers an instance to be stored.
+
+    Args:
+      study_path: Path of DICOM study, see DicomWebClient.StowRs.
+      sop_instance_uid: SOP Instance UID of the instance.
+      jsonstr: JSON representation of the instance.
+
+    Returns:
+      Future that completes with None once the instance is stored, or with a
+      RuntimeError if it could not be stored.
+    """
+    future = futures.Future()
+    with self._lock:
+      batch = self._pending.get(study_path)
+      if batch is None:
+        batch = _PendingStowBatch(time.time() + self._max_latency_secs)
+        self._pending[study_path] = batch
+      batch.instances.append((sop_instance_uid, jsonstr, future))
+      batch.num_bytes += len(jsonstr)
+      if (len(batch.instances) >= self._max_batch_size or
+          batch.num_bytes >= self._max_batch_bytes):
+        self._SendLocked(study_path)
+      elif len(batch.instances) == 1:
+        if self._flusher is None:
+          self._flusher = threading.Thread(target=self._FlushExpiredBatches)
+          self._flusher.daemon = True
+          self._flusher.start()
+        self._batch_added.notify()
+    return future
+
+  def Flush(self, timeout=None):
+    # type: float -> bool
+    """Sends all buffered instances and waits for the requests to complete.
+
+    Args:
+      timeout: Maximum number of seconds to wait. Waits indefinitely if None.
+
+    Returns:
+      True if all requests completed within the timeout.
+    """
+    with self._lock:
+      for study_path in list(self._pending):
+        self._SendLocked(study_path)
+      in_flight = list(self._in_flight)
+    _, not_done = futures.wait(in_flight, timeout=timeout)
+    return not not_done
+
+  def _FlushExpiredBatches(self):
+    # type: () -> None
+    """Sends each pending batch when its latency is up. Runs on the flusher."""
+    with self._lock:
+      while True:
+        now = time.time()
+        for study_path, batch in self._pending.items():
+          if batch.deadline <= now:
+            self._SendLocked(study_path)
+        timeout = None
+        if self._pending:
+          timeout = min(
+              batch.deadline for batch in self._pending.itervalues()) - now
+        self._batch_added.wait(timeout)
+
+  def _SendLocked(self, study_path):
+    # type: str -> None
+    """Sends the pending batch of study_path. Requires self._lock."""
+    batch = self._pending.pop(study_path)
+    request = self._executor.submit(self._Store, study_path, batch)
+    self._in_flight.add(request)
+    request.add_done_callback(self._RequestDone)
+
+  def _RequestDone(self, request):
+    # type: futures.Future -> None
+    """Forgets a completed request."""
+    with self._lock:
+      self._in_flight.discard(request)
+
+  def _Store(self, study_path, batch):
+    # type: (str, _PendingStowBatch) -> None
+    """Stores a batch and completes the future of each of its instances."""
+    try:
+      failures = self._client.StowRs(
+          study_path, [jsonstr for _, jsonstr, _ in batch.instances])
+    except Exception as e:  # pylint: disable=broad-except
+      for _, _, future in batch.instances:
+        future.set_exception(e)
+      return
+    for sop_instance_uid, _, future in batch.instances:
+      if (sop_instance_uid in failures and
+          failures[sop_instance_uid] != _DUPLICATE_SOP_INSTANCE_REASON):
+        future.set_exception(
+            RuntimeError('STOW-RS failed for instance %s, failure reason: %s' %
+                         (sop_instance_uid, failures[sop_instance_uid])))
+      else:
+        future.set_result(None)
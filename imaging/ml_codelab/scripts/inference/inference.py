@@ -60,29 +60,39 @@ from __future__ import print_function
 import abc
 import argparse
 import base64
-from email import encoders
-from email.mime import application
-from email.mime import multipart
+import copy
+import functools
+import hashlib
+import io
 import json
 import logging
-import mimetools
 import os
+import Queue
 import re
+import signal
 import sys
+import tempfile
+import threading
+import time
 import traceback
 import uuid
 
 import attr
+import cache
+from concurrent import futures
+import dedup
+import dicomweb
 import googleapiclient.discovery
 import httplib2
+import metrics
 from oauth2client.client import GoogleCredentials
-from requests_toolbelt.multipart import decoder
 import tags
 
 from google.api_core.exceptions import InvalidArgument
 from google.api_core.exceptions import PermissionDenied
 from google.cloud import automl_v1beta1
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber import scheduler
 # Output this module's logs (INFO and above) to stdout.
 _logger = logging.getLogger(__name__)
 _logger.addHandler(logging.StreamHandler(sys.stdout))
@@ -90,12 +100,8 @@ _logger.setLevel(logging.INFO)
 
 FLAGS = None
 
-# Prefix for Cloud Healthcare API.
-_HEALTHCARE_API_URL_PREFIX = 'https://healthcare.googleapis.com/v1beta1'
-
-# Credentails used to access Cloud Healthcare API.
-_CREDENTIALS = GoogleCredentials.get_application_default().create_scoped(
-    ['https://www.googleapis.com/auth/cloud-platform'])
+# OAuth2 scope used to access Cloud Healthcare API.
+_CLOUD_PLATFORM_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 
 # SOP Class UID for Basic Text Structured Reports.
 _BASIC_TEXT_SR_CUID = '1.2.840.10008.5.1.4.1.1.88.11'
@@ -118,120 +124,25 @@ _CHARACTER_SET = 'ISO_IR 192'
 # Little Endian Transfer Syntax.
 _IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
 
+# Default number of concurrent tasks for each stage of the message pipeline.
+_DEFAULT_FETCH_CONCURRENCY = 10
+_DEFAULT_PREDICT_CONCURRENCY = 10
 
-def _WadoRs(instance_path):
-  # type: str -> str
-  """Receives instance in JPEG format using WADO-RS protocol.
-
-  WADO-RS is one of the standard protocols specified by DICOMWeb protocol. It
-  allows clients to retrieve instances in various formats. In this case we will
-  retrieve the instance in JPEG format, from the Cloud Healthcare API specified
-  by _HEALTHCARE_API_URL_PREFIX.
-
-  Args:
-    instance_path: Path of DICOM instance. This is found in the contents of the
-      Pubsub message. This should be formatted as follows:
-        projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
-        dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_UID}/series/
-        {SERIES_UID}/instances/{INSTANCE_UID}
-
-  Returns:
-    content: The bytes for the JPEG image.
-
-  Raises:
-    RuntimeError: If failed to retrieve or process instance.
-  """
-  wado_url = os.path.join(_HEALTHCARE_API_URL_PREFIX, instance_path)
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-
-  # Headers for receiving DICOM in JPEG Baseline format.
-  headers = {
-      'Accept': 'multipart/related; type="image/jpeg"; '
-                'transfer-syntax=1.2.840.10008.1.2.4.50'
-  }
-  resp, content = http.request(wado_url, 'GET', headers=headers)
-  if resp.status != 200:
-    raise RuntimeError(
-        'Failed to retrieve DICOM instance: (%s, %s)' % (resp, content))
-
-  multipart_data = decoder.MultipartDecoder(content, resp['content-type'])
-  if len(multipart_data.parts) != 1:
-    raise RuntimeError('Invalid number of WADO-RS response parts (need 1): %s' %
-                       (str(len(multipart_data.parts))))
-  return multipart_data.parts[0].content
-
-
-def _StowRs(study_path, jsonstr):
-  # type: (str, str) -> None
-  """Stores instance in Cloud Healthcare API using STOW-RS protocol.
-
-  STOW-RS is one of the standard protocols specified by DICOMWeb protocol. It
-  allows clients to store DICOM instances. In this case we will
-  store the instance in in the Cloud Healthcare API specified by
-  _HEALTHCARE_API_URL_PREFIX.
-
-  Args:
-    study_path: Path of DICOM study. This should be formatted as follows:
-      projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
-      dicomStores/{DICOM_STORE_ID}/dicomWeb/studies
-    jsonstr: JSON represenation of DICOM instance(s) to store.
+# Default size and expiry of the cache of study-level QIDO-RS responses.
+_DEFAULT_STUDY_CACHE_SIZE = 1000
+_DEFAULT_STUDY_CACHE_TTL_SECS = 300
 
-  Raises:
-    RuntimeError: If failed to store instance.
-  """
-  stow_url = os.path.join(_HEALTHCARE_API_URL_PREFIX, study_path)
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-  application_type = 'dicom+json'
-
-  root = multipart.MIMEMultipart(
-      subtype='related', boundary=mimetools.choose_boundary())
-  # root should not write out its own headers
-  setattr(root, '_write_headers', lambda self: None)
-  part = application.MIMEApplication(
-      jsonstr, application_type, _encoder=encoders.encode_noop)
-  root.attach(part)
-
-  boundary = root.get_boundary()
-  content_type = ('multipart/related; type="application/%s"; boundary="%s"') % (
-      application_type, boundary)
-  headers = {'content-type': content_type}
-
-  resp, content = http.request(
-      stow_url, method='POST', body=root.as_string(), headers=headers)
-  if resp.status != 200:
-    raise RuntimeError(
-        'Failed to store DICOM instance in Healthcare API: (%s, %s)' %
-        (resp.status, content))
-
-
-def _QidoRs(qido_url):
-  # type: str -> List
-  """Performs the request, and returns the parsed JSON response.
-
-  QIDO-RS is one of the standard protocols specified by DICOMWeb protocol. It
-  allows clients to query metadata for DICOM instances. In this case we will
-  store the instance in in the Cloud Healthcare API specified by
-  _HEALTHCARE_API_URL_PREFIX.
+# Default number of series whose modality is remembered.
+_DEFAULT_MODALITY_CACHE_SIZE = 10000
 
-  Args:
-    qido_url: URL for the QIDO request.
+# Quality of the JPEG images re-encoded after being scaled down.
+_DOWNSCALED_JPEG_QUALITY = 95
 
-  Returns:
-    The parsed JSON response content.
+# Default number of processed instances remembered in memory.
+_DEFAULT_PROCESSED_SET_SIZE = 100000
 
-  Raises:
-    RuntimeError: if the response status was not 200.
-  """
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-  resp, content = http.request(qido_url, 'GET')
-  if resp.status != 200:
-    raise RuntimeError(
-        'QidoRs error. Response Status: %d,\nURL: %s,\nContent: %s.' %
-        (resp.status, qido_url, content))
-  return json.loads(content)
+# Modality of the instances that inference is run on.
+_MAMMOGRAPHY_MODALITY = 'MG'
 
 
 class Predictor(object):
@@ -244,16 +155,94 @@ class Predictor(object):
     """Runs inference and returns predicted class and score."""
     raise NotImplementedError
 
+  def PredictBatch(self, images_jpeg_bytes):
+    # type: List[str] -> List[(str, str)]
+    """Runs inference on several images in one call.
+
+    The default implementation calls Predict once per image. Predictors whose
+    service accepts several instances per request should override this.
+
+    Args:
+      images_jpeg_bytes: List of JPEG image bytes.
+
+    Returns:
+      List of (class, score) tuples, in the same order as images_jpeg_bytes.
+    """
+    return [self.Predict(image) for image in images_jpeg_bytes]
+
+  def WarmUp(self):
+    # type: None -> None
+    """Prepares the predictor before the first Pub/Sub message arrives.
+
+    Predictors that create expensive clients override this so that the cost is
+    paid at startup instead of by the first message.
+    """
+    pass
+
+  def Close(self):
+    # type: None -> None
+    """Releases the resources of the predictor, e.g. its threads.
+
+    Predict must not be called afterwards.
+    """
+    pass
+
 
 class CMLEPredictor(Predictor):
   """Handler for CMLE predictor.
 
+  The Cloud ML Engine discovery document is fetched once and shared. The API
+  client built from it is not thread-safe, so one client is built lazily for
+  each Pub/Sub callback thread and reused for all of its predictions.
+
   Attributes:
     model_path: Path to model.
   """
 
   def __init__(self, model_path):
     self._model_path = model_path
+    self._discovery_doc = None
+    self._discovery_doc_lock = threading.Lock()
+    self._thread_local = threading.local()
+
+  def WarmUp(self):
+    # type: None -> None
+    """Fetches the discovery document and builds a client ahead of time."""
+    self._GetService()
+
+  def _GetDiscoveryDocument(self):
+    # type: None -> str
+    """Returns the Cloud ML Engine discovery document, fetching it once."""
+    with self._discovery_doc_lock:
+      if self._discovery_doc is None:
+        start_time = time.time()
+        discovery_url = googleapiclient.discovery.DISCOVERY_URI.format(
+            api='ml', apiVersion='v1')
+        resp, content = httplib2.Http().request(discovery_url, 'GET')
+        if resp.status != 200:
+          raise RuntimeError(
+              'Failed to fetch CMLE discovery document: (%s, %s)' %
+              (resp.status, content))
+        self._discovery_doc = content
+        _logger.info('Fetched CMLE discovery document in %.1f ms',
+                     (time.time() - start_time) * 1000)
+      return self._discovery_doc
+
+  def _GetService(self):
+    # type: None -> googleapiclient.discovery.Resource
+    """Returns the Cloud ML Engine client of the calling thread."""
+    service = getattr(self._thread_local, 'service', None)
+    if service is None:
+      discovery_doc = self._GetDiscoveryDocument()
+      start_time = time.time()
+      # Building from the fetched document also sidesteps the discovery cache
+      # issue: https://github.com/google/google-api-python-client/issues/299
+      service = googleapiclient.discovery.build_from_document(discovery_doc)
+      self._thread_local.service = service
+      _logger.info('Built CMLE client for thread %s in %.1f ms',
+                   threading.current_thread().name,
+                   (time.time() - start_time) * 1000)
+    return service
 
   def Predict(self, image_jpeg_bytes):
     # type: str -> (str, str)
@@ -271,6 +260,21 @@ class CMLEPredictor(Predictor):
       class is the predicted class.
       score is the predicted score.
 
+    Raises:
+      RuntimeError: if failed to get inference results.
+    """
+    return self.PredictBatch([image_jpeg_bytes])[0]
+
+  def PredictBatch(self, images_jpeg_bytes):
+    # type: List[str] -> List[(str, str)]
+    """Runs inference on several images with a single Cloud ML Engine request.
+
+    Args:
+      images_jpeg_bytes: List of JPEG image bytes.
+
+    Returns:
+      List of (class, score) tuples, in the same order as images_jpeg_bytes.
+
     Raises:
       RuntimeError: if failed to get inference results.
     """
@@ -282,33 +286,59 @@ class CMLEPredictor(Predictor):
             'inputs': {
                 'b64': base64.b64encode(image_jpeg_bytes)
             }
-        }]
+        } for image_jpeg_bytes in images_jpeg_bytes]
     }
-    # Disable cache discovery due to following issue:
-    # https://github.com/google/google-api-python-client/issues/299
-    service = googleapiclient.discovery.build('ml', 'v1', cache_discovery=False)
+    service = self._GetService()
+    start_time = time.time()
     response = service.projects().predict(
         name=self._model_path,
         body=input_data).execute(num_retries=_NUM_RETRIES_CMLE)
+    _logger.debug('CMLE prediction of %d images took %.1f ms',
+                  len(images_jpeg_bytes), (time.time() - start_time) * 1000)
 
     # Propagate the error.
     if 'error' in response:
       raise RuntimeError(response['error'])
 
     # Return the predictions.
-    prediction = response['predictions'][0]
-    return prediction['classes'], prediction['scores']
+    predictions = response['predictions']
+    if len(predictions) != len(images_jpeg_bytes):
+      raise RuntimeError('CMLE returned %d predictions for %d instances' %
+                         (len(predictions), len(images_jpeg_bytes)))
+    return [(prediction['classes'], prediction['scores'])
+            for prediction in predictions]
 
 
 class AutoMLPredictor(Predictor):
   """Handler for AutoML Vision predictor.
 
+  The gRPC PredictionServiceClient is thread-safe, so a single client (and its
+  channel) is created lazily and shared by all Pub/Sub callback threads.
+
   Attributes:
     model_path: Path to model.
   """
 
   def __init__(self, model_path):
     self._model_path = model_path
+    self._prediction_client = None
+    self._prediction_client_lock = threading.Lock()
+
+  def WarmUp(self):
+    # type: None -> None
+    """Creates the prediction client ahead of time."""
+    self._GetPredictionClient()
+
+  def _GetPredictionClient(self):
+    # type: None -> automl_v1beta1.PredictionServiceClient
+    """Returns the shared AutoML prediction client, creating it once."""
+    with self._prediction_client_lock:
+      if self._prediction_client is None:
+        start_time = time.time()
+        self._prediction_client = automl_v1beta1.PredictionServiceClient()
+        _logger.info('Created AutoML prediction client in %.1f ms',
+                     (time.time() - start_time) * 1000)
+      return self._prediction_client
 
   def Predict(self, image_jpeg_bytes):
     # type: str -> (str, str)
@@ -331,14 +361,339 @@ class AutoMLPredictor(Predictor):
     """
     payload = {'image': {'image_bytes': image_jpeg_bytes}}
     params = {}
-    prediction_client = automl_v1beta1.PredictionServiceClient()
+    prediction_client = self._GetPredictionClient()
+    start_time = time.time()
     response = prediction_client.predict(self._model_path, payload, params)
+    _logger.debug('AutoML prediction took %.1f ms',
+                  (time.time() - start_time) * 1000)
     if len(response.payload) != 1:
       raise RuntimeError('AutoML response payload size should be of size 1')
     result = response.payload[0]
     return result.display_name, result.classification.score
 
 
+class LocalSavedModelPredictor(Predictor):
+  """Runs the exported SavedModel in process with TensorFlow.
+
+  The SavedModel written by trainer/model.py is loaded once into a persistent
+  session that is shared by all Pub/Sub callback threads. This avoids a network
+  round trip per image and needs no Cloud ML Engine or AutoML endpoint.
+
+  Attributes:
+    model_path: Local or GCS path of the SavedModel directory.
+  """
+
+  def __init__(self, model_path):
+    # TensorFlow is only needed by this predictor, so it is not a dependency of
+    # the rest of the inference module.
+    import numpy as np
+    import tensorflow as tf
+    self._np = np
+    self._tf = tf
+    self._session = tf.Session(graph=tf.Graph())
+    meta_graph_def = tf.saved_model.loader.load(
+        self._session, [tf.saved_model.tag_constants.SERVING], model_path)
+    signature_def = meta_graph_def.signature_def[
+        tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+    self._inputs_tensor_name = signature_def.inputs[
+        tf.saved_model.signature_constants.CLASSIFY_INPUTS].name
+    self._classes_tensor_name = signature_def.outputs[
+        tf.saved_model.signature_constants.CLASSIFY_OUTPUT_CLASSES].name
+    self._scores_tensor_name = signature_def.outputs[
+        tf.saved_model.signature_constants.CLASSIFY_OUTPUT_SCORES].name
+
+  def WarmUp(self):
+    # type: None -> None
+    """Runs the model once on a blank image to initialize its kernels."""
+    with self._tf.Graph().as_default():
+      with self._tf.Session() as sess:
+        blank_jpeg = sess.run(
+            self._tf.image.encode_jpeg(
+                self._tf.zeros([1, 1, 3], dtype=self._tf.uint8)))
+    self.Predict(blank_jpeg)
+
+  def Predict(self, image_jpeg_bytes):
+    # type: str -> (str, str)
+    """Runs inference on image using the in-process SavedModel.
+
+    Args:
+      image_jpeg_bytes: Bytes of JPEG image.
+
+    Returns:
+      (class, score) tuple.
+
+      class is the predicted class.
+      score is the predicted score.
+    """
+    return self.PredictBatch([image_jpeg_bytes])[0]
+
+  def PredictBatch(self, images_jpeg_bytes):
+    # type: List[str] -> List[(str, str)]
+    """Runs inference on several images with a single session run.
+
+    Args:
+      images_jpeg_bytes: List of JPEG image bytes.
+
+    Returns:
+      List of (class, score) tuples, in the same order as images_jpeg_bytes.
+    """
+    classes, scores = self._session.run(
+        [self._classes_tensor_name, self._scores_tensor_name],
+        feed_dict={self._inputs_tensor_name: images_jpeg_bytes})
+    # Models exported before scores were batched return a scalar score.
+    scores = self._np.atleast_1d(scores)
+    return [(predicted_class, float(score))
+            for predicted_class, score in zip(classes, scores)]
+
+
+class BatchingPredictor(Predictor):
+  """Groups concurrent Predict calls into batched prediction requests.
+
+  Each Pub/Sub callback thread blocks in Predict while its image waits in a
+  queue. A collector thread takes up to max_batch_size queued images, waiting
+  at most max_latency_secs after the first one arrives, and sends them to the
+  wrapped predictor with a single PredictBatch call. Every caller then gets its
+  own result back, or the exception raised by the batch call, so the per-message
+  ack/nack handling is unchanged. Images queue up while a batch is in flight, so
+  batches grow with load.
+
+  Close sends the images already queued right away, and stops the collector.
+
+  Args:
+    predictor: Predictor used to run the batched predictions.
+    max_batch_size: Maximum number of images sent in one request.
+    max_latency_secs: Maximum time an image waits for its batch to fill up.
+  """
+
+  def __init__(self, predictor, max_batch_size, max_latency_secs):
+    self._predictor = predictor
+    self._max_batch_size = max_batch_size
+    self._max_latency_secs = max_latency_secs
+    # Holds (image bytes, Future) tuples, then None once closed.
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._closed = False
+    self._collector = threading.Thread(target=self._CollectBatches)
+    self._collector.daemon = True
+    self._collector.start()
+
+  def Predict(self, image_jpeg_bytes):
+    # type: str -> (str, str)
+    """Queues the image for the next batch and waits for its result.
+
+    Raises:
+      RuntimeError: If the predictor is closed.
+    """
+    future = futures.Future()
+    with self._lock:
+      if self._closed:
+        raise RuntimeError('BatchingPredictor is closed')
+      self._queue.put((image_jpeg_bytes, future))
+    return future.result()
+
+  def PredictBatch(self, images_jpeg_bytes):
+    # type: List[str] -> List[(str, str)]
+    """Sends an already assembled batch straight to the wrapped predictor."""
+    return self._predictor.PredictBatch(images_jpeg_bytes)
+
+  def WarmUp(self):
+    # type: None -> None
+    """Warms up the wrapped predictor."""
+    self._predictor.WarmUp()
+
+  def Close(self):
+    # type: None -> None
+    """Predicts the queued images, and closes the wrapped predictor."""
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      self._queue.put(None)
+    self._collector.join()
+    self._predictor.Close()
+
+  def _CollectBatches(self):
+    # type: None -> None
+    """Collects queued images into batches until the predictor is closed."""
+    closed = False
+    while not closed:
+      item = self._queue.get()
+      if item is None:
+        return
+      batch = [item]
+      deadline = time.time() + self._max_latency_secs
+      while len(batch) < self._max_batch_size:
+        remaining_secs = deadline - time.time()
+        if remaining_secs <= 0:
+          break
+        try:
+          item = self._queue.get(timeout=remaining_secs)
+        except Queue.Empty:
+          break
+        if item is None:
+          # Nothing is queued after None, so the batch is sent right away.
+          closed = True
+          break
+        batch.append(item)
+      self._RunBatch(batch)
+
+  def _RunBatch(self, batch):
+    # type: List[(str, futures.Future)] -> None
+    """Runs prediction for a batch and hands each result to its caller."""
+    images_jpeg_bytes = [image_jpeg_bytes for image_jpeg_bytes, _ in batch]
+    try:
+      results = self._predictor.PredictBatch(images_jpeg_bytes)
+    except Exception as e:  # pylint: disable=broad-except
+      # The error is re-raised in every waiting Pub/Sub callback thread.
+      for _, future in batch:
+        future.set_exception(e)
+      return
+    _logger.debug('Ran prediction for a batch of %d images', len(batch))
+    for (_, future), result in zip(batch, results):
+      future.set_result(result)
+
+
+class CachingPredictor(Predictor):
+  """Caches the predictions of another predictor by image content.
+
+  Predictions are keyed by the SHA-256 hash of the model version and the JPEG
+  bytes, so an image that was already predicted, e.g. after being imported
+  into another DICOM store, only costs the hashing. The most recently used
+  predictions are kept in memory, and all predictions can additionally be
+  written to a directory, which may be shared by several processes and kept
+  across restarts.
+
+  Args:
+    predictor: Predictor used for images not in the cache.
+    model_version: Identifies the model, so that predictions of another model
+      are not used.
+    max_size: Maximum number of predictions cached in memory.
+    cache_dir: If set, directory in which all predictions are cached.
+  """
+
+  def __init__(self, predictor, model_version, max_size, cache_dir=None):
+    self._predictor = predictor
+    self._model_version = model_version
+    self._memory_cache = cache.LruCache(max_size)
+    self._cache_dir = cache_dir
+
+  def _Key(self, image_jpeg_bytes):
+    # type: str -> str
+    """Returns the cache key of an image."""
+    sha256 = hashlib.sha256(self._model_version)
+    sha256.update('\0')
+    sha256.update(image_jpeg_bytes)
+    return sha256.hexdigest()
+
+  def _DiskPath(self, key):
+    # type: str -> str
+    """Returns the path of the file caching the prediction for key."""
+    return os.path.join(self._cache_dir, key[:2], key + '.json')
+
+  def _ReadDisk(self, key):
+    # type: str -> Optional[(str, str)]
+    """Returns the prediction cached on disk for key, or None."""
+    if not self._cache_dir:
+      return None
+    try:
+      with open(self._DiskPath(key)) as f:
+        return tuple(json.load(f))
+    except (IOError, ValueError):
+      return None
+
+  def _WriteDisk(self, key, prediction):
+    # type: (str, (str, str)) -> None
+    """Caches prediction for key on disk."""
+    if not self._cache_dir:
+      return
+    path = self._DiskPath(key)
+    try:
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+      pass  # Created concurrently.
+    try:
+      # Write to a temporary file first, so readers never see a partial file.
+      with tempfile.NamedTemporaryFile(
+          dir=os.path.dirname(path), delete=False) as f:
+        json.dump(list(prediction), f)
+      os.rename(f.name, path)
+    except (IOError, OSError) as e:
+      # The prediction is still returned, it is only not cached on disk.
+      _logger.warning('Failed to cache prediction in %s: %s', path, e)
+
+  def Predict(self, image_jpeg_bytes):
+    # type: str -> (str, str)
+    """Returns the cached prediction, running the prediction if missing."""
+    key = self._Key(image_jpeg_bytes)
+
+    def _Compute():
+      prediction = self._ReadDisk(key)
+      if prediction is None:
+        prediction = self._predictor.Predict(image_jpeg_bytes)
+        self._WriteDisk(key, prediction)
+      return prediction
+
+    return self._memory_cache.GetOrCompute(key, _Compute)
+
+  def PredictBatch(self, images_jpeg_bytes):
+    # type: List[str] -> List[(str, str)]
+    """Returns the predictions, predicting the uncached images in one batch."""
+    keys = [self._Key(image) for image in images_jpeg_bytes]
+    predictions = [self._memory_cache.Get(key) for key in keys]
+    for i, key in enumerate(keys):
+      if predictions[i] is None:
+        predictions[i] = self._ReadDisk(key)
+        if predictions[i] is not None:
+          self._memory_cache.Put(key, predictions[i])
+    missing = [i for i, prediction in enumerate(predictions) if not prediction]
+    if missing:
+      results = self._predictor.PredictBatch(
+          [images_jpeg_bytes[i] for i in missing])
+      for i, prediction in zip(missing, results):
+        predictions[i] = prediction
+        self._memory_cache.Put(keys[i], prediction)
+        self._WriteDisk(keys[i], prediction)
+    return predictions
+
+  def WarmUp(self):
+    # type: None -> None
+    """Warms up the wrapped predictor."""
+    self._predictor.WarmUp()
+
+  def Close(self):
+    # type: None -> None
+    """Closes the wrapped predictor."""
+    self._predictor.Close()
+
+
+def _AllDone(fs):
+  # type: List[futures.Future] -> futures.Future
+  """Returns a future that completes once all futures in fs are done.
+
+  It completes with the first exception raised by any of them, or with None.
+  """
+  all_done = futures.Future()
+  remaining = [len(fs)]
+  lock = threading.Lock()
+
+  def _OnDone(future):
+    with lock:
+      remaining[0] -= 1
+      if all_done.done():
+        return
+      if future.exception() is not None:
+        all_done.set_exception(future.exception())
+      elif remaining[0] == 0:
+        all_done.set_result(None)
+
+  if not fs:
+    all_done.set_result(None)
+  for future in fs:
+    future.add_done_callback(_OnDone)
+  return all_done
+
+
 def _InsertJSONTag(dataset, tag, value):
   # type: (Dict, tags.DicomTag, Any) -> None
   """Inserts a Dicom Tag into passed Dict.
@@ -388,17 +743,172 @@ def _BuildJSONSR(text, series_uid, instance_uid, study_json):
   return jsonstr
 
 
-def _GenerateUID(prefix=_UUID_INFERENCE_PREFIX):
-  # type: str -> str
-  """Generates a random Instance UID in the correct format.
+def _GenerateUID(prefix=_UUID_INFERENCE_PREFIX, name=None):
+  # type: (str, Optional[str]) -> str
+  """Generates an Instance UID in the correct format.
 
   Args:
     prefix: Text string that is the UUID prefix for the UUID.
+    name: If given, the UID is derived from name, so that the same name always
+      gives the same UID. Otherwise the UID is random.
 
   Returns:
     Unique UID with the provided prefix.
   """
-  return prefix + '.' + str(uuid.uuid4().int)
+  if name is None:
+    return prefix + '.' + str(uuid.uuid4().int)
+  return prefix + '.' + str(uuid.uuid5(uuid.NAMESPACE_URL, name).int)
+
+
+def _DownscaleJpeg(image_jpeg_bytes, min_size):
+  # type: (str, int) -> str
+  """Scales a JPEG image down while decoding it.
+
+  The image is decoded in draft mode, where the JPEG decoder scales the image
+  by 1/2, 1/4 or 1/8 in the DCT domain, which is much cheaper than decoding the
+  full image. The largest such scale that keeps the smaller side of the image
+  at least min_size pixels is used, and the image is encoded again.
+
+  Args:
+    image_jpeg_bytes: JPEG image.
+    min_size: Minimum size of the smaller side of the scaled image.
+
+  Returns:
+    The scaled JPEG image, or image_jpeg_bytes if it can not be scaled down.
+  """
+  # Pillow is only needed to scale images down, so it is not a dependency of
+  # the rest of the inference module.
+  from PIL import Image
+
+  image = Image.open(io.BytesIO(image_jpeg_bytes))
+  width, height = image.size
+  scale = min_size / min(width, height)
+  if scale > 0.5:
+    return image_jpeg_bytes
+  image.draft(image.mode, (int(width * scale), int(height * scale)))
+  if image.size == (width, height):
+    return image_jpeg_bytes
+  output = io.BytesIO()
+  image.save(output, 'JPEG', quality=_DOWNSCALED_JPEG_QUALITY)
+  return output.getvalue()
+
+
+def ProcessedKey(image_instance_path, model_version):
+  # type: (str, str) -> str
+  """Returns the key identifying the processing of an instance by a model."""
+  return '%s@%s' % (image_instance_path, model_version)
+
+
+def BuildPredictionSR(image_instance_path, processed_key, predictions,
+                      study_json):
+  # type: (str, str, List[(str, str, str)], Dict) -> (str, str, str)
+  """Builds the structured report storing the predictions for an instance.
+
+  The UIDs of the report are derived from processed_key, so that processing
+  the same instance with the same model(s) again gives the same report.
+
+  Args:
+    image_instance_path: Path of the instance the predictions were made for.
+    processed_key: ProcessedKey of the instance and model(s).
+    predictions: List of (model name, class, score) tuples, see
+      _PredictionText.
+    study_json: Dict of study level information to populate the SR. It is
+      modified by this function.
+
+  Returns:
+    (series_uid, instance_uid, jsonstr) tuple of the SR.
+  """
+  sr_instance_uid = _GenerateUID(name=processed_key + '/instance')
+  sr_series_uid = _GenerateUID(name=processed_key + '/series')
+  text = _PredictionText(image_instance_path, predictions)
+  dicom_sr = _BuildJSONSR(text, sr_series_uid, sr_instance_uid, study_json)
+  return sr_series_uid, sr_instance_uid, dicom_sr
+
+
+def _PredictionText(image_instance_path, predictions):
+  # type: (str, List[(str, str, str)]) -> str
+  """Returns the text describing the predictions for an instance.
+
+  Args:
+    image_instance_path: Path of the instance the predictions were made for.
+    predictions: List of (model name, class, score) tuples. The model name is
+      left out of the text if it is None.
+
+  Returns:
+    The text.
+  """
+  lines = ['Base path: %s' % image_instance_path]
+  for model_name, predicted_class, predicted_score in predictions:
+    if model_name is not None:
+      lines.append('Model: %s' % model_name)
+    lines.append('Predicted class: %s' % predicted_class)
+    lines.append('Predicted score: %s' % predicted_score)
+  return '\n'.join(lines)
+
+
+def CreatePredictor(prediction_service,
+                    model_path,
+                    model_version=None,
+                    batch_size=1,
+                    batch_latency_secs=0,
+                    cache_size=0,
+                    cache_dir=None):
+  # type: (str, str, str, int, float, int, str) -> Predictor
+  """Creates the predictor for a prediction service.
+
+  Args:
+    prediction_service: "CMLE", "AutoML" or "Local".
+    model_path: Path of model used for inference.
+    model_version: Identifies the model in the prediction cache. Required to
+      cache predictions, since a model redeployed under the same path would
+      otherwise be served the predictions of the previous model.
+    batch_size: Maximum number of images per prediction request. Batching is
+      disabled if 1.
+    batch_latency_secs: Maximum time an image waits for its batch to fill up.
+    cache_size: Maximum number of predictions cached in memory.
+    cache_dir: If set, directory in which all predictions are cached.
+
+  Returns:
+    The Predictor.
+
+  Raises:
+    ValueError: If prediction_service is unknown, or if caching is enabled
+      without a model_version.
+  """
+  if (cache_size > 0 or cache_dir) and not model_version:
+    raise ValueError('Caching predictions requires a model version.')
+  if prediction_service == 'CMLE':
+    predictor = CMLEPredictor(model_path)
+  elif prediction_service == 'AutoML':
+    predictor = AutoMLPredictor(model_path)
+  elif prediction_service == 'Local':
+    predictor = LocalSavedModelPredictor(model_path)
+  else:
+    raise ValueError('prediction_service must be CMLE, AutoML or Local.')
+  if batch_size > 1:
+    predictor = BatchingPredictor(predictor, batch_size, batch_latency_secs)
+  if cache_size > 0 or cache_dir:
+    predictor = CachingPredictor(predictor, model_version, cache_size,
+                                 cache_dir)
+  return predictor
+
+
+@attr.s
+class Model(object):
+  """A model that instances are scored with.
+
+  Attributes:
+    name: Name of the model in structured reports and metrics.
+    predictor: Predictor running the model.
+    version: Identifies the model, see ProcessedKey.
+    shadow: If True, the predictions of the model are recorded in their own
+      structured reports, which are not published, and failed predictions do
+      not fail the message. Used to evaluate a model on live traffic.
+  """
+  name = attr.ib()
+  predictor = attr.ib()
+  version = attr.ib()
+  shadow = attr.ib(default=False)
 
 
 @attr.s
@@ -408,33 +918,168 @@ class ParsedMessage(object):
   Attributes:
     dicomweb_url: The dicom URL.
     study_uid: Study UID.
+    series_uid: Series UID.
+    instance_uid: SOP Instance UID.
   """
   dicomweb_url = attr.ib()  # type: str
   study_uid = attr.ib()  # type: str
+  series_uid = attr.ib()  # type: str
+  instance_uid = attr.ib()  # type: str
+
+
+class _PipelineStage(object):
+  """Bounded thread pool running one stage of the message pipeline.
+
+  Tasks beyond max_concurrency wait in the pool's queue. Every queued task
+  belongs to a Pub/Sub message that has not been acked yet, so the subscriber's
+  flow control bounds the queue and stops pulling messages when a stage falls
+  behind.
+
+  Args:
+    name: Name of the stage.
+    max_concurrency: Maximum number of tasks of this stage running at once.
+  """
+
+  def __init__(self, name, max_concurrency):
+    self.name = name
+    self._executor = futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+  def Submit(self, fn, *args):
+    # type: (Callable, ...) -> futures.Future
+    """Schedules fn(*args) and returns its future."""
+    return self._executor.submit(fn, *args)
 
 
 class PubsubMessageHandler(object):
   """Handler for incoming Pubsub messages.
 
+  Each message runs through a pipeline of stages, each with its own bounded
+  thread pool. The WADO-RS retrieval and the study-level QIDO-RS run
+  concurrently in the fetch stage. The structured report is handed to a
+  StowRsWriter, which may batch it with other reports, and the callback thread
+  moves on to the next message. The message is acked or nacked once its report
+  has been stored.
+
+  Drain stops the processing of new messages, e.g. before the process exits,
+  and waits for the messages in flight to be acked or nacked. Messages
+  received while draining are held until then, so that the subscriber does
+  not pull more messages.
+
+  Each instance can be scored by several models: the image is retrieved once,
+  and handed to all models concurrently. The predictions of the live models
+  are stored in one combined structured report, or in one report per model.
+  Shadow models get a report of their own, which is not published.
+
+  Pub/Sub may deliver a message more than once. Instances that were already
+  processed with the same model versions are acked right away, while ignored
+  messages, e.g. of non-MG instances, are simply ignored again. The UIDs of the
+  structured report are derived from the instance and the model version, so
+  that processing an instance again does not store a second report.
+
   Attributes:
-    publisher: PublisherClient used to publish pubsub messages.
+    publisher: PublisherClient used to publish pubsub messages, or None if no
+      publisher_topic_path is given.
 
   Args:
-    predictor: Object used to get prediction results.
+    predictor: Object used to get prediction results of the primary model.
     dicom_store_path: DICOM store used to store inference results.
+    dicomweb_client: DicomWebClient shared by all DICOMweb requests.
+    publisher_topic_path: Pub/Sub topic that paths of structured reports are
+      published to. Nothing is published if None.
+    fetch_concurrency: Maximum number of concurrent WADO-RS and study QIDO-RS
+      requests.
+    predict_concurrency: Maximum number of concurrent predictions. When
+      predictions are batched, this bounds the size of a batch.
+    stow_writer: StowRsWriter used to store structured reports. If None, one
+      that stores each report with its own request is created.
+    study_cache_size: Maximum number of studies whose QIDO-RS response is
+      cached. A study usually has several instances (e.g. 4 mammography views),
+      which would otherwise each fetch the same study metadata.
+    study_cache_ttl_secs: Number of seconds a cached study response is used.
+    modality_cache_size: Maximum number of series whose modality is cached.
+      Modality is a series-level attribute, so only the first instance of a
+      series needs a QIDO-RS request to find it.
+    modality_attribute: If set, name of the Pub/Sub message attribute that
+      holds the instance's modality. Used instead of QIDO-RS when present.
+    modality_from_study: If True, the modality is first looked up in the
+      (cached) study-level QIDO-RS response, which lists the modalities in the
+      study. An instance QIDO-RS request is then only needed for studies that
+      contain MG instances.
+    model_version: Identifies the primary model, and names it if there are
+      several models. An instance is processed again after the version of any
+      model changed.
+    processed_set: dedup.ProcessedSet of the MG instances already processed.
+      If None, an in-memory one is created.
+    rendered_viewport: If set, images are retrieved from the rendered resource
+      of the instance instead of WADO-RS, scaled by the server to fit in this
+      "width,height" viewport.
+    downscale_size: If set, images are scaled down after being retrieved, with
+      the smaller side kept at least this many pixels, see _DownscaleJpeg.
+    additional_models: List of Model that instances are scored with, besides
+      the primary model.
+    per_model_reports: If True, the prediction of each live model is stored in
+      its own structured report. Otherwise, they are stored in one report.
   """
 
-  def __init__(self, predictor, dicom_store_path):
-    self._predictor = predictor
+  def __init__(self,
+               predictor,
+               dicom_store_path,
+               dicomweb_client,
+               publisher_topic_path=None,
+               fetch_concurrency=_DEFAULT_FETCH_CONCURRENCY,
+               predict_concurrency=_DEFAULT_PREDICT_CONCURRENCY,
+               stow_writer=None,
+               study_cache_size=_DEFAULT_STUDY_CACHE_SIZE,
+               study_cache_ttl_secs=_DEFAULT_STUDY_CACHE_TTL_SECS,
+               modality_cache_size=_DEFAULT_MODALITY_CACHE_SIZE,
+               modality_attribute=None,
+               modality_from_study=False,
+               model_version='',
+               processed_set=None,
+               rendered_viewport=None,
+               downscale_size=None,
+               additional_models=(),
+               per_model_reports=False):
+    self._models = [
+        Model(name=model_version or 'primary', predictor=predictor,
+              version=model_version)
+    ] + list(additional_models)
+    self._per_model_reports = per_model_reports
     self._dicom_store_path = dicom_store_path
+    self._dicomweb_client = dicomweb_client
+    self._fetch_stage = _PipelineStage('fetch', fetch_concurrency)
+    self._predict_stage = _PipelineStage('predict', predict_concurrency)
+    self._stow_writer = stow_writer or dicomweb.StowRsWriter(dicomweb_client)
+    self._study_cache = cache.LruCache(study_cache_size, study_cache_ttl_secs)
+    self._modality_cache = cache.LruCache(modality_cache_size)
+    self._modality_attribute = modality_attribute
+    self._modality_from_study = modality_from_study
+    self._models_version = '+'.join(model.version for model in self._models)
+    self._processed_set = processed_set or dedup.ProcessedSet(
+        _DEFAULT_PROCESSED_SET_SIZE)
+    self._rendered_viewport = rendered_viewport
+    self._downscale_size = downscale_size
     self._success_count = 0
-    self.publisher = pubsub_v1.PublisherClient()
+    self._success_count_lock = threading.Lock()
+    # Guards the messages in flight, and whether draining.
+    self._in_flight_condition = threading.Condition()
+    self._in_flight = 0
+    # Messages in flight that are neither acked nor nacked yet, by id.
+    self._unsettled = {}
+    # Messages received while draining, which are not processed.
+    self._held = []
+    self._draining = False
+    self._publisher_topic_path = publisher_topic_path
+    self.publisher = None
+    if publisher_topic_path:
+      self.publisher = pubsub_v1.PublisherClient()
 
   def _ParseMessage(self, message):
     # type: pubsub_v1.Message -> Optional[ParsedMessage]
     """Returns the parsed pubsub message and filters malformed/non-MG messages.
 
-    Checks that the path is valid. Also filters out non-MG modality.
+    Checks that the path is valid. Also filters out non-MG modality, see
+    _GetModality.
 
     Args:
       message: Pubsub message.
@@ -457,23 +1102,106 @@ class PubsubMessageHandler(object):
     series_uid = match.group(6)
     instance_uid = match.group(7)
     dicomweb_url = ('%s/projects/%s/locations/%s/datasets/%s/dicomStores/%s/'
-                    'dicomWeb' % (_HEALTHCARE_API_URL_PREFIX, project_id,
-                                  location_id, dataset_id, dicom_store_id))
+                    'dicomWeb' %
+                    (self._dicomweb_client.url_prefix, project_id, location_id,
+                     dataset_id, dicom_store_id))
+    parsed_message = ParsedMessage(
+        dicomweb_url=dicomweb_url,
+        study_uid=study_uid,
+        series_uid=series_uid,
+        instance_uid=instance_uid)
+    if self._GetModality(message, parsed_message) != _MAMMOGRAPHY_MODALITY:
+      return None
+    return parsed_message
+
+  def _GetModality(self, message, parsed_message):
+    # type: (pubsub_v1.Message, ParsedMessage) -> Optional[str]
+    """Returns the modality of the message's instance.
+
+    The modality is taken from the first source that knows it:
+    1) The Pub/Sub message attribute named by modality_attribute.
+    2) The cache of previously seen series.
+    3) The modalities of the study, if modality_from_study is set and MG is
+       not among them. The study may be cached from before other series, e.g.
+       the structured reports of this module, were added to it, so it is only
+       trusted to tell that an instance is not MG.
+    4) A QIDO-RS request for the instance.
+
+    Args:
+      message: Pubsub message.
+      parsed_message: ParsedMessage of the instance.
+
+    Returns:
+      The modality, or None if it is unknown.
+    """
+    if self._modality_attribute:
+      modality = message.attributes.get(self._modality_attribute)
+      if modality:
+        return modality
+
+    series_key = (parsed_message.dicomweb_url, parsed_message.series_uid)
+    modality = self._modality_cache.Get(series_key)
+    if modality is not None:
+      return modality
+
+    if self._modality_from_study:
+      study_json = self._GetCachedStudyJson(parsed_message)
+      study_modalities = study_json.get(tags.MODALITIES_IN_STUDY.number,
+                                        {}).get(_VALUE_TYPE, [])
+      if study_modalities and _MAMMOGRAPHY_MODALITY not in study_modalities:
+        # Not MG, though the exact modality of this series is unknown.
+        return study_modalities[0]
+
     qido_url = ('%s/studies/%s/series/%s/instances?SOPInstanceUID=%s&'
-                'includefield=%s' % (dicomweb_url, study_uid, series_uid,
-                                     instance_uid, tags.MODALITY_TAG.number))
-    parsed_content = _QidoRs(qido_url)[0]
+                'includefield=%s' %
+                (parsed_message.dicomweb_url, parsed_message.study_uid,
+                 parsed_message.series_uid, parsed_message.instance_uid,
+                 tags.MODALITY_TAG.number))
+    parsed_content = self._dicomweb_client.QidoRs(qido_url)[0]
     modality_dict = parsed_content.get(tags.MODALITY_TAG.number, {})
-    if modality_dict.get(_VALUE_TYPE, [None])[0] != 'MG':
-      return None
-    return ParsedMessage(study_uid=study_uid, dicomweb_url=dicomweb_url)
+    modality = modality_dict.get(_VALUE_TYPE, [None])[0]
+    if modality is not None:
+      self._modality_cache.Put(series_key, modality)
+    return modality
+
+  def _GetCachedStudyJson(self, parsed_message):
+    # type: ParsedMessage -> Dict
+    """Returns the cached study level information of the message's study.
+
+    The QIDO-RS response is cached per DICOM store and study, and concurrent
+    lookups for the same study share one request. The returned dict is shared
+    and must not be modified.
+
+    Args:
+      parsed_message: ParsedMessage of the instance.
+
+    Returns:
+      The study's DICOM JSON.
+    """
+    qido_study_url = ('%s/studies?StudyInstanceUID=%s&includefield=all' %
+                      (parsed_message.dicomweb_url, parsed_message.study_uid))
+    return self._study_cache.GetOrCompute(
+        (parsed_message.dicomweb_url, parsed_message.study_uid),
+        lambda: self._dicomweb_client.QidoRs(qido_study_url)[0])
+
+  def _GetImage(self, image_instance_path):
+    # type: str -> str
+    """Retrieves the instance as a JPEG image, scaled as configured."""
+    if self._rendered_viewport:
+      image_jpeg_bytes = self._dicomweb_client.RenderedRs(
+          image_instance_path, self._rendered_viewport)
+    else:
+      image_jpeg_bytes = self._dicomweb_client.WadoRs(image_instance_path)
+    if self._downscale_size:
+      image_jpeg_bytes = _DownscaleJpeg(image_jpeg_bytes, self._downscale_size)
+    return image_jpeg_bytes
 
   def _PublishInferenceResultsReady(self, image_instance_path):
     # type: str -> None
     """Publishes a results ready notification to the supplied Pubsub channel.
 
-    If the Inference Module is supplied FLAGS.publisher_topic_path flag, it will
-    attempt to publish any inference results to that channel.
+    If the handler is given a publisher_topic_path, it will attempt to publish
+    any inference results to that channel.
 
     Args:
       image_instance_path: Path of DICOM study. This should be formatted as
@@ -482,12 +1210,12 @@ class PubsubMessageHandler(object):
         dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_ID}/series/
         ${SERIES_ID}/instances/{INSTANCE_ID}
     """
-    if FLAGS.publisher_topic_path is None:
+    if not self._publisher_topic_path:
       return
 
     try:
-      self.publisher.publish(
-          FLAGS.publisher_topic_path, data=image_instance_path)
+      metrics.Timed(metrics.PUBLISH_STAGE, self.publisher.publish,
+                    self._publisher_topic_path, image_instance_path)
       _logger.info('Published inference results ready message')
     except TypeError as e:
       _logger.error('Invalid type sent to publish channel: %s', e.message)
@@ -502,6 +1230,16 @@ class PubsubMessageHandler(object):
     Args:
       message: pubsub_v1.Message being processed.
     """
+    with self._in_flight_condition:
+      if self._draining:
+        # Neither ack nor nack the message yet. It keeps its slot in the
+        # subscriber's flow control, so that no more messages are pulled,
+        # whereas a nacked message could be delivered right back.
+        self._held.append(message)
+        return
+      self._in_flight += 1
+      self._unsettled[id(message)] = message
+    metrics.MESSAGES_IN_FLIGHT.inc()
     try:
       self._PubsubCallback(message)
     except Exception as e:  # pylint: disable=broad-except
@@ -510,7 +1248,7 @@ class PubsubMessageHandler(object):
       _logger.error(e)
       traceback.print_exc()
       _logger.error('Unexpected exception...acking message')
-      message.ack()
+      self._Ack(message)
 
   def _PubsubCallback(self, message):
     # type: pubsub_v1.Message -> None
@@ -528,70 +1266,299 @@ class PubsubMessageHandler(object):
     """
     image_instance_path = message.data
     _logger.debug('Received instance in pubsub feed: %s', image_instance_path)
-    parsed_message = self._ParseMessage(message)
+    processed_key = ProcessedKey(image_instance_path, self._models_version)
+    if processed_key in self._processed_set:
+      _logger.info('Ignoring redelivered message: %s', image_instance_path)
+      self._Ack(message, metrics.DUPLICATE_OUTCOME)
+      return
+    parsed_message = metrics.Timed(metrics.PARSE_STAGE, self._ParseMessage,
+                                   message)
     if not parsed_message:
+      # Not recorded as processed: parsing a redelivered message again is
+      # cheap, and most notifications of a store are ignored, so recording
+      # them would evict the MG instances and journal every notification.
       _logger.info('Ignoring new message: %s', image_instance_path)
-      message.ack()
+      self._Ack(message, metrics.IGNORED_OUTCOME)
       return
 
     _logger.info('Processing instance: %s', image_instance_path)
 
-    # Retrieve instance from DICOM API in JPEG format.
-    image_jpeg_bytes = _WadoRs(image_instance_path)
-    # Retrieve study level information
-    qido_study_url = ('%s/studies?StudyInstanceUID=%s&includefield=all' %
-                      (parsed_message.dicomweb_url, parsed_message.study_uid))
-    study_json = _QidoRs(qido_study_url)[0]
-    # Get the predicted score and class from the inference model in Cloud ML or
-    # AutoML.
-    try:
-      predicted_class, predicted_score = self._predictor.Predict(
-          image_jpeg_bytes)
-    except PermissionDenied as e:
-      _logger.error('Permission error running prediction service: %s',
-                    e.message)
-      message.nack()
+    # Retrieve instance from DICOM API in JPEG format, and the study level
+    # information, concurrently.
+    wado_future = self._fetch_stage.Submit(metrics.Timed, metrics.WADO_STAGE,
+                                           self._GetImage, image_instance_path)
+    study_future = self._fetch_stage.Submit(
+        metrics.Timed, metrics.STUDY_QIDO_STAGE, self._GetCachedStudyJson,
+        parsed_message)
+    image_jpeg_bytes = wado_future.result()
+    study_json = study_future.result()
+    metrics.PAYLOAD_BYTES.labels(metrics.IMAGE_PAYLOAD).observe(
+        len(image_jpeg_bytes))
+    # Get the predicted score and class from every model in Cloud ML, AutoML or
+    # locally, concurrently.
+    prediction_futures = [
+        self._predict_stage.Submit(metrics.Timed, metrics.PREDICT_STAGE,
+                                   model.predictor.Predict, image_jpeg_bytes)
+        for model in self._models
+    ]
+    live_predictions = []
+    shadow_predictions = []
+    for model, prediction_future in zip(self._models, prediction_futures):
+      try:
+        predicted_class, predicted_score = prediction_future.result()
+      except Exception as e:  # pylint: disable=broad-except
+        if model.shadow:
+          # A failing shadow model must not affect the live models' reports.
+          _logger.error('Error running prediction for shadow model %s: %s',
+                        model.name, e)
+          continue
+        if not isinstance(e, (PermissionDenied, InvalidArgument)):
+          raise
+        _logger.error('Error running prediction service for model %s: %s',
+                      model.name, e.message)
+        self._Nack(message)
+        return
+      metrics.PREDICTIONS.labels(model.name, predicted_class).inc()
+      prediction = (model.name if len(self._models) > 1 else None,
+                    predicted_class, predicted_score)
+      if model.shadow:
+        shadow_predictions.append((model, prediction))
+      else:
+        live_predictions.append((model, prediction))
+
+    # Print the predictions.
+    _logger.info(
+        _PredictionText(image_instance_path, [
+            prediction
+            for _, prediction in live_predictions + shadow_predictions
+        ]))
+
+    # If user requested destination DICOM store for inference, create DICOM
+    # structured reports that store the predictions.
+    if self._dicom_store_path:
+      # Store the DICOM structured reports in different series using Healthcare
+      # API. The message is acked or nacked once the live reports are stored.
+      # Their UIDs are derived from the instance and the model(s), so that a
+      # redelivered message stores the same reports.
+      if self._per_model_reports or len(live_predictions) == 1:
+        live_reports = [
+            (ProcessedKey(image_instance_path, model.version), [prediction])
+            for model, prediction in live_predictions
+        ]
+      else:
+        live_reports = [(processed_key,
+                         [prediction for _, prediction in live_predictions])]
+      stow_futures = []
+      sr_uids = []
+      for report_key, predictions in live_reports:
+        sr_series_uid, sr_instance_uid, stow_future = self._StoreReport(
+            image_instance_path, report_key, predictions, study_json)
+        stow_futures.append(stow_future)
+        sr_uids.append((sr_series_uid, sr_instance_uid))
+      for model, prediction in shadow_predictions:
+        _, sr_instance_uid, stow_future = self._StoreReport(
+            image_instance_path,
+            ProcessedKey(image_instance_path, model.version), [prediction],
+            study_json)
+        stow_future.add_done_callback(
+            functools.partial(self._OnShadowReportStored, sr_instance_uid))
+      metrics.STAGE_IN_FLIGHT.labels(metrics.STOW_STAGE).inc()
+      _AllDone(stow_futures).add_done_callback(
+          functools.partial(self._OnStructuredReportsStored, message,
+                            processed_key, parsed_message.study_uid, sr_uids,
+                            time.time()))
       return
-    except InvalidArgument as e:
-      _logger.error('Invalid arguments when running prediction service: %s',
-                    e.message)
-      message.nack()
+    # Ack the message (successful or invalid message).
+    self._Ack(message)
+    self._MarkProcessed(processed_key)
+    self._IncrementSuccessCount()
+
+  def _StoreReport(self, image_instance_path, report_key, predictions,
+                   study_json):
+    # type: (str, str, List[(str, str, str)], Dict) -> (str, str, futures.Future)
+    """Builds a structured report, and hands it to the StowRsWriter.
+
+    Args:
+      image_instance_path: Path of the instance the predictions were made for.
+      report_key: ProcessedKey the report's UIDs are derived from.
+      predictions: Predictions stored in the report, see _PredictionText.
+      study_json: Dict of study level information of the instance. It is not
+        modified, since it may be shared with the study cache.
+
+    Returns:
+      (series_uid, instance_uid, future) tuple, where future is returned by
+      StowRsWriter.Write for the report.
+    """
+    sr_series_uid, sr_instance_uid, dicom_sr = BuildPredictionSR(
+        image_instance_path, report_key, predictions, copy.deepcopy(study_json))
+    metrics.PAYLOAD_BYTES.labels(metrics.STRUCTURED_REPORT_PAYLOAD).observe(
+        len(dicom_sr))
+    study_path = os.path.join(self._dicom_store_path, 'dicomWeb', 'studies')
+    return sr_series_uid, sr_instance_uid, self._stow_writer.Write(
+        study_path, sr_instance_uid, dicom_sr)
+
+  def _OnShadowReportStored(self, sr_instance_uid, stow_future):
+    # type: (str, futures.Future) -> None
+    """Logs the outcome of storing the report of a shadow model."""
+    try:
+      stow_future.result()
+    except RuntimeError as e:
+      _logger.error('Error storing shadow DICOM in API: %s', e.message)
       return
+    _logger.info('Stored shadow structured report: %s', sr_instance_uid)
 
-    # Print the prediction.
-    text = 'Base path: %s\nPredicted class: %s\nPredicted score: %s' % (
-        image_instance_path, predicted_class, predicted_score)
-    _logger.info(text)
+  def _OnStructuredReportsStored(self, message, processed_key, study_uid,
+                                 sr_uids, stow_start_time, stow_future):
+    # type: (pubsub_v1.Message, str, str, List[(str, str)], float, futures.Future) -> None
+    """Publishes the stored structured reports, then acks the message.
 
-    # If user requested destination DICOM store for inference, create a DICOM
-    # structured report that stores the prediction.
-    if self._dicom_store_path:
-      # Generate series uid and instance uid for the structured report.
-      sr_instance_uid = _GenerateUID()
-      sr_series_uid = _GenerateUID()
+    This runs once the StowRsWriter completed the STOW-RS requests of all live
+    reports of the message. The message is nacked if a report could not be
+    stored. As in PubsubCallback, any unexpected exception leads to the message
+    being acked.
 
-      # Store the DICOM structured report in a different series using Healthcare
-      # API.
-      dicom_sr = _BuildJSONSR(text, sr_series_uid, sr_instance_uid, study_json)
+    Args:
+      message: Pubsub message the structured reports were created for.
+      processed_key: Key of the message's instance in the processed set.
+      study_uid: Study UID of the instance and the structured reports.
+      sr_uids: List of (series UID, instance UID) of the structured reports.
+      stow_start_time: Time the reports were handed to the StowRsWriter.
+      stow_future: Future that completes once all reports are stored, see
+        _AllDone.
+    """
+    metrics.STAGE_IN_FLIGHT.labels(metrics.STOW_STAGE).dec()
+    metrics.STAGE_LATENCY.labels(metrics.STOW_STAGE).observe(time.time() -
+                                                             stow_start_time)
+    try:
       study_path = os.path.join(self._dicom_store_path, 'dicomWeb', 'studies')
       try:
-        _StowRs(study_path, dicom_sr)
-      except RuntimeError as e:
-        _logger.error('Error storing DICOM in API: %s', e.message)
-        message.nack()
+        stow_future.result()
+      except Exception as e:  # pylint: disable=broad-except
+        # No report was stored, so the message must be processed again.
+        _logger.error('Error storing DICOM in API: %s', e)
+        self._Nack(message)
         return
 
       # If user requested that new structured reports be published to a channel,
-      # publish the instance path of the Structured Report
-      structured_report_path = os.path.join(
-          study_path, parsed_message.study_uid, 'series', sr_series_uid,
-          'instances', sr_instance_uid)
-      self._PublishInferenceResultsReady(structured_report_path)
-      _logger.info('Published structured report with path: %s',
-                   structured_report_path)
-    # Ack the message (successful or invalid message).
+      # publish the instance path of each Structured Report
+      for sr_series_uid, sr_instance_uid in sr_uids:
+        structured_report_path = os.path.join(study_path, study_uid, 'series',
+                                              sr_series_uid, 'instances',
+                                              sr_instance_uid)
+        self._PublishInferenceResultsReady(structured_report_path)
+        _logger.info('Published structured report with path: %s',
+                     structured_report_path)
+      self._Ack(message)
+      self._MarkProcessed(processed_key)
+      self._IncrementSuccessCount()
+    except Exception as e:  # pylint: disable=broad-except
+      _logger.error(e)
+      traceback.print_exc()
+      _logger.error('Unexpected exception...acking message')
+      self._Ack(message)
+
+  def _MarkProcessed(self, processed_key):
+    # type: str -> None
+    """Adds an instance to the processed set, logging any error.
+
+    The message is acked either way, and is only processed again if it is
+    redelivered.
+    """
+    try:
+      self._processed_set.Add(processed_key)
+    except Exception as e:  # pylint: disable=broad-except
+      _logger.error('Failed to record processed instance %s: %s',
+                    processed_key, e)
+
+  def _Ack(self, message, outcome=metrics.ACK_OUTCOME):
+    # type: (pubsub_v1.Message, str) -> None
+    """Acks a Pubsub message and records its outcome."""
+    if not self._Settle(message):
+      return
     message.ack()
-    self._success_count += 1
+    metrics.MESSAGES.labels(outcome).inc()
+
+  def _Nack(self, message):
+    # type: pubsub_v1.Message -> None
+    """Nacks a Pubsub message so that it is redelivered."""
+    if not self._Settle(message):
+      return
+    message.nack()
+    metrics.MESSAGES.labels(metrics.NACK_OUTCOME).inc()
+
+  def _Settle(self, message):
+    # type: pubsub_v1.Message -> bool
+    """Records that a message in flight is being acked or nacked.
+
+    Args:
+      message: Pubsub message in flight.
+
+    Returns:
+      False if the message was already acked or nacked, in which case it must
+      not be acked or nacked again.
+    """
+    with self._in_flight_condition:
+      if self._unsettled.pop(id(message), None) is None:
+        _logger.warning('Message already acked or nacked: %s', message.data)
+        return False
+      self._in_flight -= 1
+      if self._in_flight == 0:
+        self._in_flight_condition.notify_all()
+    metrics.MESSAGES_IN_FLIGHT.dec()
+    return True
+
+  def Drain(self, timeout):
+    # type: float -> bool
+    """Stops processing new messages and waits for those in flight.
+
+    Messages received from now on, which the subscriber had already pulled,
+    are held without being acked or nacked. Since they keep their slots in the
+    subscriber's flow control, no more messages are pulled. Once the messages
+    in flight are done, the held messages are nacked, so that Pub/Sub
+    redelivers them to other subscribers. The subscription should then be
+    closed: messages received after that are neither processed nor nacked,
+    and are redelivered once their lease expires. It is not closed before,
+    since acks sent after the subscription is closed are dropped.
+
+    The structured reports buffered by the StowRsWriter are sent right away
+    instead of waiting for their batch to fill up.
+
+    Messages still in flight after the timeout are redelivered once their
+    lease expires. Since the UIDs of their structured reports are derived from
+    the instance, storing them again does not create a second report.
+
+    Args:
+      timeout: Maximum number of seconds to wait.
+
+    Returns:
+      True if all messages in flight were acked or nacked within the timeout.
+    """
+    deadline = time.time() + timeout
+    with self._in_flight_condition:
+      self._draining = True
+    self._stow_writer.Flush(timeout=0)
+    with self._in_flight_condition:
+      while self._in_flight > 0:
+        remaining_secs = deadline - time.time()
+        if remaining_secs <= 0:
+          break
+        self._in_flight_condition.wait(remaining_secs)
+      in_flight = self._in_flight
+      held = self._held
+      self._held = []
+    if in_flight:
+      _logger.warning('%d messages still in flight after draining', in_flight)
+    for message in held:
+      message.nack()
+      metrics.MESSAGES.labels(metrics.NACK_OUTCOME).inc()
+    _logger.info('Nacked %d messages received while draining', len(held))
+    return in_flight == 0
+
+  def _IncrementSuccessCount(self):
+    # type: None -> None
+    """Records a successfully processed Pubsub message."""
+    with self._success_count_lock:
+      self._success_count += 1
 
   def GetSuccessCount(self):
     # type: None -> int
@@ -599,30 +1566,144 @@ class PubsubMessageHandler(object):
     return self._success_count
 
 
-def main():
-  if FLAGS.prediction_service == 'CMLE':
-    predictor = CMLEPredictor(FLAGS.model_path)
-  elif FLAGS.prediction_service == 'AutoML':
-    predictor = AutoMLPredictor(FLAGS.model_path)
-  else:
-    raise ValueError('FLAGS.prediction_service must be CMLE or AutoML.')
+def _CreateModelFromFlag(model_flag, shadow):
+  # type: (str, bool) -> Model
+  """Creates a Model from a --model or --shadow_model flag.
+
+  Args:
+    model_flag: Flag value, formatted as NAME=SERVICE:MODEL_PATH.
+    shadow: Whether the model is a shadow model.
+
+  Returns:
+    The Model, whose predictor batches like the primary model's. Its
+    predictions are not cached, since it has no explicit version.
+
+  Raises:
+    ValueError: If the flag value is malformed.
+  """
+  match = re.match(r'([^=]+)=(CMLE|AutoML|Local):(.+)$', model_flag)
+  if match is None:
+    raise ValueError('Model must be formatted as NAME=SERVICE:MODEL_PATH, '
+                     'where SERVICE is CMLE, AutoML or Local: %s' % model_flag)
+  name, prediction_service, model_path = match.groups()
+  predictor = CreatePredictor(
+      prediction_service,
+      model_path,
+      batch_size=FLAGS.prediction_batch_size,
+      batch_latency_secs=FLAGS.prediction_batch_latency_ms / 1000)
+  return Model(
+      name=name, predictor=predictor, version=model_path, shadow=shadow)
+
 
-  handler = PubsubMessageHandler(predictor, FLAGS.dicom_store_path)
+def main():
+  if FLAGS.metrics_port:
+    metrics.StartServer(FLAGS.metrics_port)
+    _logger.info('Serving metrics on port %d', FLAGS.metrics_port)
+
+  model_version = FLAGS.model_version or FLAGS.model_path
+  predictor = CreatePredictor(
+      FLAGS.prediction_service,
+      FLAGS.model_path,
+      model_version=FLAGS.model_version,
+      batch_size=FLAGS.prediction_batch_size,
+      batch_latency_secs=FLAGS.prediction_batch_latency_ms / 1000,
+      cache_size=FLAGS.prediction_cache_size,
+      cache_dir=FLAGS.prediction_cache_dir)
+  additional_models = [
+      _CreateModelFromFlag(model_flag, shadow=False)
+      for model_flag in FLAGS.model or []
+  ] + [
+      _CreateModelFromFlag(model_flag, shadow=True)
+      for model_flag in FLAGS.shadow_model or []
+  ]
+  start_time = time.time()
+  predictor.WarmUp()
+  for model in additional_models:
+    model.predictor.WarmUp()
+  _logger.info('Predictor warm-up took %.1f ms',
+               (time.time() - start_time) * 1000)
+
+  credentials = GoogleCredentials.get_application_default().create_scoped(
+      [_CLOUD_PLATFORM_SCOPE])
+  dicomweb_client = dicomweb.DicomWebClient(
+      credentials,
+      max_connections=FLAGS.max_dicomweb_connections,
+      spool_max_bytes=FLAGS.wado_spool_max_bytes)
+  handler = PubsubMessageHandler(
+      predictor,
+      FLAGS.dicom_store_path,
+      dicomweb_client,
+      publisher_topic_path=FLAGS.publisher_topic_path,
+      fetch_concurrency=FLAGS.fetch_concurrency,
+      predict_concurrency=FLAGS.predict_concurrency,
+      stow_writer=dicomweb.StowRsWriter(
+          dicomweb_client,
+          max_batch_size=FLAGS.stow_batch_size,
+          max_batch_bytes=FLAGS.stow_batch_max_bytes,
+          max_latency_secs=FLAGS.stow_batch_latency_ms / 1000,
+          max_concurrency=FLAGS.stow_concurrency),
+      study_cache_size=FLAGS.study_cache_size,
+      study_cache_ttl_secs=FLAGS.study_cache_ttl_secs,
+      modality_cache_size=FLAGS.modality_cache_size,
+      modality_attribute=FLAGS.modality_attribute,
+      modality_from_study=FLAGS.modality_from_study,
+      model_version=model_version,
+      processed_set=dedup.ProcessedSet(FLAGS.processed_set_size,
+                                       FLAGS.processed_journal_path),
+      rendered_viewport=FLAGS.rendered_viewport,
+      downscale_size=FLAGS.downscale_size,
+      additional_models=additional_models,
+      per_model_reports=FLAGS.per_model_reports)
+  # The subscriber extends the lease of each message in flight based on the
+  # 99th percentile of the observed processing times, up to max_lease_duration.
+  flow_control = pubsub_v1.types.FlowControl(
+      max_messages=FLAGS.max_outstanding_messages,
+      max_bytes=FLAGS.max_outstanding_bytes,
+      max_lease_duration=FLAGS.max_lease_duration_secs)
+  callback_scheduler = scheduler.ThreadScheduler(
+      futures.ThreadPoolExecutor(max_workers=FLAGS.callback_threads))
   subscriber = pubsub_v1.SubscriberClient()
-  future = subscriber.subscribe(FLAGS.subscription_path, handler.PubsubCallback)
+  future = subscriber.subscribe(
+      FLAGS.subscription_path,
+      handler.PubsubCallback,
+      flow_control=flow_control,
+      scheduler=callback_scheduler)
+
+  stop_requested = threading.Event()
+  signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+  deadline = None
+  if FLAGS.pubsub_timeout is not None:
+    deadline = time.time() + FLAGS.pubsub_timeout
+  timed_out = False
   try:
     # If timeout is set, wait for FLAGS.pubsub_timeout seconds until messages
-    # are processed on the pubsub channel.
-    future.result(timeout=FLAGS.pubsub_timeout)
+    # are processed on the pubsub channel. Event.wait is only interrupted by
+    # signals when it is given a timeout.
+    while not (stop_requested.is_set() or future.done()):
+      if deadline is not None and time.time() >= deadline:
+        timed_out = True
+        break
+      stop_requested.wait(1)
   except KeyboardInterrupt:
     # User exits the script early.
-    future.cancel()
     _logger.info('Received keyboard interrupt, exiting...')
-  except pubsub_v1.exceptions.TimeoutError:
+  if stop_requested.is_set():
+    _logger.info('Received SIGTERM, draining...')
+
+  # Finish the messages in flight before closing the subscription, which drops
+  # the callbacks that have not started and any acks not yet sent.
+  handler.Drain(FLAGS.drain_timeout_secs)
+  future.cancel()
+  predictor.Close()
+  for model in additional_models:
+    model.predictor.Close()
+  if timed_out:
     # No messages are processed in FLAGS.pubsub_timeout seconds.
-    future.cancel()
     assert (handler.GetSuccessCount() >
             0), 'Timeout but no pubsub messages successfully processed'
+  elif future.done() and not future.cancelled():
+    # The subscription failed.
+    future.result()
 
 
 if __name__ == '__main__':
@@ -648,7 +1729,8 @@ if __name__ == '__main__':
       '--model_path',
       type=str,
       required=True,
-      help='Path of Cloud ML Engine model used for inference.')
+      help='Path of model used for inference. For --prediction_service=Local '
+      'this is the SavedModel directory exported by trainer/model.py.')
   parser.add_argument(
       '--dicom_store_path',
       type=str,
@@ -660,7 +1742,211 @@ if __name__ == '__main__':
       '--prediction_service',
       type=str,
       default='CMLE',
-      help='Service to call for prediction, either "CMLE" or "AutoML"')
+      choices=['CMLE', 'AutoML', 'Local'],
+      help='Service to call for prediction, either "CMLE", "AutoML" or '
+      '"Local". "Local" runs the SavedModel in this process with TensorFlow.')
+  parser.add_argument(
+      '--model',
+      type=str,
+      action='append',
+      help='Additional model that each instance is scored with, formatted as '
+      'NAME=SERVICE:MODEL_PATH, e.g. candidate=CMLE:projects/p/models/m. May '
+      'be repeated. The image is retrieved once for all models.')
+  parser.add_argument(
+      '--shadow_model',
+      type=str,
+      action='append',
+      help='Like --model, but the predictions of the model are stored in '
+      'their own structured report, which is not published, and its failures '
+      'are only logged. May be repeated.')
+  parser.add_argument(
+      '--per_model_reports',
+      default=False,
+      action='store_true',
+      help='Store the prediction of each model in its own structured report, '
+      'rather than those of all models in one report.')
+  parser.add_argument(
+      '--prediction_batch_size',
+      type=int,
+      default=1,
+      help='Maximum number of images sent to the prediction service in one '
+      'request. Images from concurrently processed Pub/Sub messages are '
+      'grouped into batches of up to this size. Batching is disabled if 1.')
+  parser.add_argument(
+      '--prediction_batch_latency_ms',
+      type=int,
+      default=50,
+      help='Maximum number of milliseconds an image waits for its prediction '
+      'batch to fill up. Only used if --prediction_batch_size is above 1.')
+  parser.add_argument(
+      '--prediction_cache_size',
+      type=int,
+      default=0,
+      help='Maximum number of predictions of the primary model cached in '
+      'memory, by image content and model version. Caching is disabled if 0 '
+      'and --prediction_cache_dir is not set. Requires --model_version.')
+  parser.add_argument(
+      '--prediction_cache_dir',
+      type=str,
+      default=None,
+      help='If set, directory in which all predictions of the primary model '
+      'are cached, by image content and model version, so that they are kept '
+      'across restarts. Requires --model_version.')
+  parser.add_argument(
+      '--fetch_concurrency',
+      type=int,
+      default=_DEFAULT_FETCH_CONCURRENCY,
+      help='Maximum number of concurrent WADO-RS and study QIDO-RS requests.')
+  parser.add_argument(
+      '--predict_concurrency',
+      type=int,
+      default=_DEFAULT_PREDICT_CONCURRENCY,
+      help='Maximum number of concurrent predictions. Should be at least '
+      '--prediction_batch_size for batches to fill up.')
+  parser.add_argument(
+      '--stow_concurrency',
+      type=int,
+      default=dicomweb.DEFAULT_STOW_CONCURRENCY,
+      help='Maximum number of concurrent STOW-RS requests for structured '
+      'reports.')
+  parser.add_argument(
+      '--stow_batch_size',
+      type=int,
+      default=dicomweb.DEFAULT_STOW_BATCH_SIZE,
+      help='Maximum number of structured reports stored with one STOW-RS '
+      'request. Reports for the same DICOM store are batched.')
+  parser.add_argument(
+      '--stow_batch_max_bytes',
+      type=int,
+      default=dicomweb.DEFAULT_STOW_BATCH_BYTES,
+      help='Maximum total size of the structured reports in one STOW-RS '
+      'request.')
+  parser.add_argument(
+      '--stow_batch_latency_ms',
+      type=int,
+      default=int(dicomweb.DEFAULT_STOW_BATCH_LATENCY_SECS * 1000),
+      help='Maximum number of milliseconds a structured report waits for its '
+      'STOW-RS batch to fill up.')
+  parser.add_argument(
+      '--study_cache_size',
+      type=int,
+      default=_DEFAULT_STUDY_CACHE_SIZE,
+      help='Maximum number of studies whose study-level QIDO-RS response is '
+      'cached. Caching is disabled if 0.')
+  parser.add_argument(
+      '--study_cache_ttl_secs',
+      type=int,
+      default=_DEFAULT_STUDY_CACHE_TTL_SECS,
+      help='Number of seconds a cached study-level QIDO-RS response is used '
+      'before it is fetched again.')
+  parser.add_argument(
+      '--modality_cache_size',
+      type=int,
+      default=_DEFAULT_MODALITY_CACHE_SIZE,
+      help='Maximum number of series whose modality is cached, so that only '
+      'the first instance of a series needs a QIDO-RS request to filter out '
+      'non-MG instances.')
+  parser.add_argument(
+      '--modality_attribute',
+      type=str,
+      default=None,
+      help='Name of the Pub/Sub message attribute holding the modality of the '
+      'instance, if the notifications carry it. When present, no QIDO-RS '
+      'request is needed to filter out non-MG instances.')
+  parser.add_argument(
+      '--modality_from_study',
+      default=False,
+      action='store_true',
+      help='Skip the instance QIDO-RS request for instances of studies whose '
+      '(cached) study-level QIDO-RS response lists no MG modality.')
+  parser.add_argument(
+      '--model_version',
+      type=str,
+      default=None,
+      help='Version of the model, used to recognize instances that were '
+      'already processed with the same model. Defaults to --model_path. Must '
+      'be set, and changed whenever the model is redeployed, for predictions '
+      'to be cached.')
+  parser.add_argument(
+      '--processed_set_size',
+      type=int,
+      default=_DEFAULT_PROCESSED_SET_SIZE,
+      help='Number of processed instances remembered in memory, so that '
+      'redelivered Pub/Sub messages are acked without being processed again.')
+  parser.add_argument(
+      '--processed_journal_path',
+      type=str,
+      default=None,
+      help='Path of a SQLite database recording the processed instances, so '
+      'that they are remembered across restarts. If not set, processed '
+      'instances are only remembered in memory.')
+  parser.add_argument(
+      '--rendered_viewport',
+      type=str,
+      default=None,
+      help='If set, e.g. "299,299", images are retrieved from the rendered '
+      'resource of the instance, scaled by the Healthcare API to fit in this '
+      'width,height viewport, instead of at full resolution with WADO-RS.')
+  parser.add_argument(
+      '--downscale_size',
+      type=int,
+      default=None,
+      help='If set, e.g. 299, images are scaled down by 1/2, 1/4 or 1/8 while '
+      'being decoded, keeping their smaller side at least this many pixels, '
+      'before being sent to the prediction service. Requires Pillow.')
+  parser.add_argument(
+      '--max_dicomweb_connections',
+      type=int,
+      default=10,
+      help='Maximum number of concurrent connections to the Healthcare API. '
+      'Connections are kept alive and shared by all DICOMweb requests.')
+  parser.add_argument(
+      '--wado_spool_max_bytes',
+      type=int,
+      default=32 * 1024 * 1024,
+      help='WADO-RS responses are decoded while they are received. Parts '
+      'larger than this many bytes are spooled to a temporary file instead of '
+      'memory.')
+  parser.add_argument(
+      '--metrics_port',
+      type=int,
+      default=0,
+      help='Port of the local HTTP endpoint serving Prometheus metrics (e.g. '
+      'per-stage latency histograms and message counters) on /metrics. '
+      'Metrics are not served if 0.')
+  parser.add_argument(
+      '--max_outstanding_messages',
+      type=int,
+      default=100,
+      help='Maximum number of Pub/Sub messages received but not acked or '
+      'nacked yet. The subscriber stops pulling messages at this limit.')
+  parser.add_argument(
+      '--max_outstanding_bytes',
+      type=int,
+      default=100 * 1024 * 1024,
+      help='Maximum total size of the Pub/Sub messages received but not acked '
+      'or nacked yet.')
+  parser.add_argument(
+      '--callback_threads',
+      type=int,
+      default=10,
+      help='Number of threads running the Pub/Sub callback. Each thread '
+      'processes one message at a time, until its structured report is handed '
+      'to the STOW-RS writer.')
+  parser.add_argument(
+      '--max_lease_duration_secs',
+      type=int,
+      default=2 * 60 * 60,
+      help='Maximum number of seconds the lease of a message is extended, '
+      'after which it is redelivered. Leases are extended based on the 99th '
+      'percentile of the observed processing times.')
+  parser.add_argument(
+      '--drain_timeout_secs',
+      type=int,
+      default=25,
+      help='On SIGTERM, number of seconds to wait for the messages in flight '
+      'to be processed before exiting. Should be below the grace period of '
+      'the container, which is 30 seconds by default on Kubernetes.')
   parser.add_argument(
       '--pubsub_timeout',
       type=int,
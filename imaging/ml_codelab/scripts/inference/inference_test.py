@@ -0,0 +1,999 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for inference.PubsubMessageHandler and its dicomweb dependencies.
+
+Run from this directory with: python -m unittest inference_test
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent import futures
+import dicomweb
+import inference
+import requests
+import tags
+
+_STUDY_PATH = ('projects/p/locations/l/datasets/d/dicomStores/s/dicomWeb/'
+               'studies')
+
+_INSTANCE_PATH = ('projects/p/locations/l/datasets/d/dicomStores/s/dicomWeb/'
+                  'studies/1.2.3/series/1.2.3.4/instances/%d')
+
+# Name of the message attribute holding the modality, so that no QIDO-RS
+# request is needed to find it.
+_MODALITY_ATTRIBUTE = 'modality'
+
+# Number of seconds a test waits for a thread before failing.
+_TIMEOUT_SECS = 10
+
+# Content-Type of a multipart WADO-RS response, with boundary "b".
+_WADO_RS_CONTENT_TYPE = 'multipart/related; type="image/jpeg"; boundary=b'
+
+# STOW-RS failure reason of an instance that could not be processed.
+_PROCESSING_FAILURE_REASON = 0x0110
+
+
+class _FakeMessage(object):
+  """Pub/Sub message recording whether it was acked or nacked."""
+
+  def __init__(self, data, on_done=None):
+    self.data = data
+    self.attributes = {_MODALITY_ATTRIBUTE: 'MG'}
+    self.acks = 0
+    self.nacks = 0
+    self._on_done = on_done
+
+  def ack(self):  # pylint: disable=invalid-name
+    self.acks += 1
+    if self._on_done:
+      self._on_done(self, acked=True)
+
+  def nack(self):  # pylint: disable=invalid-name
+    self.nacks += 1
+    if self._on_done:
+      self._on_done(self, acked=False)
+
+
+class _FakeSubscriber(object):
+  """Streaming pull delivering messages to a callback, with flow control.
+
+  As in the Pub/Sub subscriber, each message is delivered on its own thread,
+  no more messages are delivered while max_messages messages are neither acked
+  nor nacked, and a nacked message is delivered again right away.
+
+  Attributes:
+    nacked: Messages nacked, in order, with repetitions.
+  """
+
+  def __init__(self, callback, num_messages, max_messages):
+    self._callback = callback
+    self._max_messages = max_messages
+    self._condition = threading.Condition()
+    self._queue = collections.deque(
+        _FakeMessage(_INSTANCE_PATH % i, self._OnDone)
+        for i in range(num_messages))
+    self._outstanding = 0
+    self._cancelled = False
+    self.nacked = []
+    thread = threading.Thread(target=self._Deliver)
+    thread.daemon = True
+    thread.start()
+
+  def _Deliver(self):
+    while True:
+      with self._condition:
+        while not self._cancelled and (not self._queue or
+                                       self._outstanding >= self._max_messages):
+          self._condition.wait()
+        if self._cancelled:
+          return
+        message = self._queue.popleft()
+        self._outstanding += 1
+      thread = threading.Thread(target=self._callback, args=(message,))
+      thread.daemon = True
+      thread.start()
+
+  def _OnDone(self, message, acked):
+    with self._condition:
+      self._outstanding -= 1
+      if not acked:
+        self.nacked.append(message)
+        self._queue.appendleft(message)
+      self._condition.notify_all()
+
+  def cancel(self):  # pylint: disable=invalid-name
+    with self._condition:
+      self._cancelled = True
+      self._condition.notify_all()
+
+
+class _FakeDicomWebClient(object):
+  """DicomWebClient returning the same image and study for all instances."""
+
+  url_prefix = 'https://healthcare.googleapis.com/v1beta1'
+
+  def WadoRs(self, unused_path):
+    return 'jpeg'
+
+  def QidoRs(self, unused_url):
+    return [{}]
+
+
+class _FakeStowWriter(object):
+  """StowRsWriter that stores every report right away, or fails to."""
+
+  def __init__(self, on_flush=None, exception=None):
+    self.written = []
+    self._on_flush = on_flush
+    self._exception = exception
+
+  def Write(self, unused_study_path, sop_instance_uid, unused_jsonstr):
+    self.written.append(sop_instance_uid)
+    future = futures.Future()
+    if self._exception:
+      future.set_exception(self._exception)
+    else:
+      future.set_result(None)
+    return future
+
+  def Flush(self, timeout=None):  # pylint: disable=unused-argument
+    if self._on_flush:
+      self._on_flush()
+    return True
+
+
+class _FakePredictor(inference.Predictor):
+  """Predictor returning a fixed prediction, optionally once a gate opens."""
+
+  def __init__(self, gate=None):
+    self._gate = gate
+    self._condition = threading.Condition()
+    self._started = 0
+
+  def Predict(self, unused_image_jpeg_bytes):
+    with self._condition:
+      self._started += 1
+      self._condition.notify_all()
+    if self._gate:
+      self._gate.wait(_TIMEOUT_SECS)
+    return '2', '0.9'
+
+  def WaitForPredictions(self, count):
+    """Waits until count predictions have started."""
+    with self._condition:
+      while self._started < count:
+        self._condition.wait(_TIMEOUT_SECS)
+
+
+class _FailingPredictor(inference.Predictor):
+  """Predictor failing like a CMLE model returning an error."""
+
+  def Predict(self, unused_image_jpeg_bytes):
+    raise RuntimeError('Prediction failed')
+
+
+class _BatchPredictor(inference.Predictor):
+  """Predictor recording its batches, whose class is the image bytes.
+
+  Attributes:
+    batches: Batches predicted, in order.
+    closed: Whether the predictor was closed.
+  """
+
+  def __init__(self, exception=None):
+    self.batches = []
+    self.closed = False
+    self._exception = exception
+
+  def Predict(self, image_jpeg_bytes):
+    return self.PredictBatch([image_jpeg_bytes])[0]
+
+  def PredictBatch(self, images_jpeg_bytes):
+    self.batches.append(list(images_jpeg_bytes))
+    if self._exception:
+      raise self._exception
+    return [(image, '0.9') for image in images_jpeg_bytes]
+
+  def Close(self):
+    self.closed = True
+
+
+class _RecordingProcessedSet(object):
+  """ProcessedSet recording the keys added, which are never contained."""
+
+  def __init__(self):
+    self.added = []
+
+  def __contains__(self, key):
+    return False
+
+  def Add(self, key):
+    self.added.append(key)
+
+
+class _FakeStowClient(object):
+  """DicomWebClient recording STOW-RS requests, and failing some instances.
+
+  Attributes:
+    requests: List of (study path, SOP Instance UIDs) tuples, one per request.
+  """
+
+  def __init__(self, failures_fn=None, exception=None):
+    """Constructor.
+
+    Args:
+      failures_fn: Function returning the failures of a request, see
+        DicomWebClient.StowRs, given its SOP Instance UIDs.
+      exception: Exception raised by every request.
+    """
+    self.requests = []
+    self._failures_fn = failures_fn
+    self._exception = exception
+    self._lock = threading.Lock()
+
+  def StowRs(self, study_path, jsonstrs):
+    sop_instance_uids = [
+        json.loads(jsonstr)[0][tags.SOP_INSTANCE_UID.number]['Value'][0]
+        for jsonstr in jsonstrs
+    ]
+    with self._lock:
+      self.requests.append((study_path, sop_instance_uids))
+    if self._exception:
+      raise self._exception
+    if self._failures_fn:
+      return self._failures_fn(sop_instance_uids)
+    return {}
+
+
+class _FakeResponse(object):
+  """requests.Response with a status code, and content or streamed chunks.
+
+  Attributes:
+    closed: Whether the response was closed.
+  """
+
+  def __init__(self, status_code, content='', headers=None, chunks=()):
+    self.status_code = status_code
+    self.content = content
+    self.headers = headers or {}
+    self.closed = False
+    self._chunks = chunks
+
+  def iter_content(self, chunk_size):  # pylint: disable=invalid-name
+    del chunk_size  # Chunks are returned as given.
+    for chunk in self._chunks:
+      if isinstance(chunk, Exception):
+        raise chunk
+      yield chunk
+
+  def close(self):  # pylint: disable=invalid-name
+    self.closed = True
+
+
+def _InstanceJson(sop_instance_uid):
+  """Returns a DICOM JSON instance, in the form of BuildPredictionSR."""
+  return json.dumps([{
+      tags.SOP_INSTANCE_UID.number: {
+          'vr': tags.SOP_INSTANCE_UID.vr,
+          'Value': [sop_instance_uid]
+      }
+  }])
+
+
+def _StowResponse(failures):
+  """Returns the DICOM JSON STOW-RS response listing failed instances."""
+  return json.dumps({
+      tags.FAILED_SOP_SEQUENCE.number: {
+          'vr':
+              tags.FAILED_SOP_SEQUENCE.vr,
+          'Value': [{
+              tags.REFERENCED_SOP_INSTANCE_UID.number: {
+                  'vr': tags.REFERENCED_SOP_INSTANCE_UID.vr,
+                  'Value': [uid]
+              },
+              tags.FAILURE_REASON.number: {
+                  'vr': tags.FAILURE_REASON.vr,
+                  'Value': [reason]
+              },
+          } for uid, reason in sorted(failures.items())]
+      }
+  })
+
+
+def _ReadMultipartRelated(body, content_type):
+  """Returns the (headers, body) tuples of the parts of a multipart body."""
+  boundary = content_type.split('boundary=')[1]
+  return [(headers, part.read()) for headers, part in
+          dicomweb._IterMultipartParts([body], boundary, spool_max_bytes=1024)]
+
+
+def _CreateHandler(predictor, **kwargs):
+  return inference.PubsubMessageHandler(
+      predictor,
+      'projects/p/locations/l/datasets/d/dicomStores/results',
+      _FakeDicomWebClient(),
+      modality_attribute=_MODALITY_ATTRIBUTE,
+      model_version='v1',
+      **kwargs)
+
+
+class MultipartRelatedTest(unittest.TestCase):
+
+  def test_encode(self):
+    body, content_type = dicomweb._EncodeMultipartRelated(['{"a": 1}', '{}'],
+                                                          'application/json')
+
+    boundary = content_type.split('boundary=')[1]
+    self.assertEqual(content_type,
+                     'multipart/related; type="application/json"; boundary=%s' %
+                     boundary)
+    self.assertEqual(
+        body, '--{0}\r\nContent-Type: application/json\r\n\r\n{{"a": 1}}\r\n'
+        '--{0}\r\nContent-Type: application/json\r\n\r\n{{}}\r\n'
+        '--{0}--\r\n'.format(boundary))
+
+  def test_encode_and_decode(self):
+    parts = ['{"a": 1}', '', 'x' * 100]
+
+    body, content_type = dicomweb._EncodeMultipartRelated(parts, 'text/plain')
+
+    self.assertEqual(
+        _ReadMultipartRelated(body, content_type),
+        [({'content-type': 'text/plain'}, part) for part in parts])
+
+
+class IterMultipartPartsTest(unittest.TestCase):
+
+  _BODY = ('preamble\r\n--b\r\nContent-Type: image/jpeg\r\n'
+           'Content-Location: 1\r\n\r\nfirst\r\n--b\r\n'
+           'Content-Type: image/jpeg\r\n\r\n\r\n--b\r\n'
+           'Content-Type: image/jpeg\r\n\r\nthird\r\n--b--\r\nepilogue')
+
+  _PARTS = [({'content-type': 'image/jpeg', 'content-location': '1'}, 'first'),
+            ({'content-type': 'image/jpeg'}, ''),
+            ({'content-type': 'image/jpeg'}, 'third')]
+
+  def _ReadParts(self, chunks, spool_max_bytes=1024):
+    return [(headers, body.read()) for headers, body in
+            dicomweb._IterMultipartParts(chunks, 'b', spool_max_bytes)]
+
+  def test_skips_preamble_and_epilogue(self):
+    self.assertEqual(self._ReadParts([self._BODY]), self._PARTS)
+
+  def test_body_without_preamble(self):
+    body = self._BODY[len('preamble\r\n'):]
+
+    self.assertEqual(self._ReadParts([body]), self._PARTS)
+
+  def test_delimiters_split_across_chunks(self):
+    for chunk_size in range(1, 12):
+      chunks = [
+          self._BODY[i:i + chunk_size]
+          for i in range(0, len(self._BODY), chunk_size)
+      ]
+      # Empty chunks, as sent by a keep-alive, are skipped.
+      chunks.insert(1, '')
+
+      self.assertEqual(self._ReadParts(chunks), self._PARTS, chunk_size)
+
+  def test_spools_large_parts_to_disk(self):
+    body = ('--b\r\n\r\n' + 'x' * 100 + '\r\n--b\r\n\r\nsmall\r\n'
+            '--b--\r\n')
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+    # pylint: disable=protected-access
+    spooled = [(part.read(), part._rolled) for _, part in
+               dicomweb._IterMultipartParts(chunks, 'b', spool_max_bytes=10)]
+
+    self.assertEqual(spooled, [('x' * 100, True), ('small', False)])
+
+  def test_body_without_boundary_raises(self):
+    with self.assertRaisesRegexp(RuntimeError, 'no boundary'):
+      self._ReadParts(['preamble', 'without boundary'])
+
+  def test_truncated_headers_raise(self):
+    with self.assertRaisesRegexp(RuntimeError, 'Truncated'):
+      self._ReadParts(['--b\r\nContent-Type: image/jpeg\r\n'])
+
+  def test_truncated_body_raises(self):
+    body = self._BODY[:self._BODY.index('third') + 2]
+
+    with self.assertRaisesRegexp(RuntimeError, 'without closing boundary'):
+      self._ReadParts([body])
+
+
+class ParseStowFailuresTest(unittest.TestCase):
+
+  def test_parses_failed_instances(self):
+    content = _StowResponse({'1.1': _PROCESSING_FAILURE_REASON, '1.2': 0x0111})
+
+    failures = dicomweb._ParseStowFailures(content)
+
+    self.assertEqual(failures, {'1.1': _PROCESSING_FAILURE_REASON,
+                                '1.2': 0x0111})
+
+  def test_parses_response_in_list(self):
+    content = '[%s]' % _StowResponse({'1.1': _PROCESSING_FAILURE_REASON})
+
+    failures = dicomweb._ParseStowFailures(content)
+
+    self.assertEqual(failures, {'1.1': _PROCESSING_FAILURE_REASON})
+
+  def test_no_failed_instances(self):
+    self.assertEqual(dicomweb._ParseStowFailures('{}'), {})
+    self.assertEqual(dicomweb._ParseStowFailures('[]'), {})
+
+  def test_invalid_response(self):
+    self.assertIsNone(dicomweb._ParseStowFailures('Internal error'))
+
+
+class DicomWebClientTest(unittest.TestCase):
+
+  def _CreateClient(self, response):
+    """Returns a client getting response to every request, and its requests."""
+    client = dicomweb.DicomWebClient(None, url_prefix='https://dicomweb')
+    requests_made = []
+
+    def _Request(method, url, headers=None, data=None, stream=False):
+      requests_made.append((method, url, headers, data, stream))
+      return response
+
+    client._Request = _Request
+    return client, requests_made
+
+  def test_stow_rs_sends_instances_in_one_request(self):
+    client, requests_made = self._CreateClient(_FakeResponse(200))
+    jsonstrs = [_InstanceJson('1.1'), _InstanceJson('1.2')]
+
+    failures = client.StowRs(_STUDY_PATH, jsonstrs)
+
+    self.assertEqual(failures, {})
+    self.assertEqual(len(requests_made), 1)
+    method, url, headers, data, _ = requests_made[0]
+    self.assertEqual(method, 'POST')
+    self.assertEqual(url, 'https://dicomweb/' + _STUDY_PATH)
+    self.assertEqual(headers['accept'], 'application/dicom+json')
+    parts = _ReadMultipartRelated(data, headers['content-type'])
+    self.assertEqual([part for _, part in parts], jsonstrs)
+
+  def test_stow_rs_returns_failures_of_conflict(self):
+    failures = {'1.2': _PROCESSING_FAILURE_REASON}
+    client, _ = self._CreateClient(_FakeResponse(409, _StowResponse(failures)))
+
+    jsonstrs = [_InstanceJson('1.1'), _InstanceJson('1.2')]
+
+    self.assertEqual(client.StowRs(_STUDY_PATH, jsonstrs), failures)
+
+  def test_stow_rs_conflict_without_failures_raises(self):
+    for content in ('{}', 'Conflict'):
+      client, _ = self._CreateClient(_FakeResponse(409, content))
+
+      with self.assertRaises(RuntimeError):
+        client.StowRs(_STUDY_PATH, [_InstanceJson('1.1')])
+
+  def test_stow_rs_returns_failures_of_accepted(self):
+    failures = {'1.2': _PROCESSING_FAILURE_REASON}
+    client, _ = self._CreateClient(_FakeResponse(202, _StowResponse(failures)))
+
+    jsonstrs = [_InstanceJson('1.1'), _InstanceJson('1.2')]
+
+    self.assertEqual(client.StowRs(_STUDY_PATH, jsonstrs), failures)
+
+  def test_stow_rs_accepted_with_warnings_only(self):
+    client, _ = self._CreateClient(_FakeResponse(202, '{}'))
+
+    self.assertEqual(client.StowRs(_STUDY_PATH, [_InstanceJson('1.1')]), {})
+
+  def test_stow_rs_unparseable_accepted_raises(self):
+    client, _ = self._CreateClient(_FakeResponse(202, 'Accepted'))
+
+    with self.assertRaises(RuntimeError):
+      client.StowRs(_STUDY_PATH, [_InstanceJson('1.1')])
+
+  def test_stow_rs_error_raises(self):
+    client, _ = self._CreateClient(_FakeResponse(500, 'Internal error'))
+
+    with self.assertRaises(RuntimeError):
+      client.StowRs(_STUDY_PATH, [_InstanceJson('1.1')])
+
+  def _CreateWadoRsClient(self, chunks, content_type=_WADO_RS_CONTENT_TYPE):
+    return self._CreateClient(
+        _FakeResponse(
+            200, headers={'content-type': content_type}, chunks=chunks))
+
+  def test_iter_wado_rs_parts(self):
+    body = ('--b\r\nContent-Type: image/jpeg\r\n\r\nfirst\r\n'
+            '--b\r\nContent-Type: image/jpeg\r\n\r\nsecond\r\n--b--\r\n')
+    client, requests_made = self._CreateWadoRsClient(
+        [body[i:i + 5] for i in range(0, len(body), 5)])
+
+    parts = [(headers, part.read())
+             for headers, part in client.IterWadoRsParts(_INSTANCE_PATH % 1)]
+
+    self.assertEqual(parts, [({'content-type': 'image/jpeg'}, 'first'),
+                             ({'content-type': 'image/jpeg'}, 'second')])
+    method, url, _, _, stream = requests_made[0]
+    self.assertEqual((method, url, stream),
+                     ('GET', 'https://dicomweb/' + _INSTANCE_PATH % 1, True))
+
+  def test_iter_wado_rs_parts_closes_response(self):
+    response = _FakeResponse(
+        200,
+        headers={'content-type': _WADO_RS_CONTENT_TYPE},
+        chunks=['--b\r\n\r\nfirst\r\n--b\r\n\r\nsecond\r\n--b--\r\n'])
+    client, _ = self._CreateClient(response)
+
+    # Stops before the end of the response.
+    for _ in client.IterWadoRsParts(_INSTANCE_PATH % 1):
+      break
+
+    self.assertTrue(response.closed)
+
+  def test_iter_wado_rs_parts_not_multipart_raises(self):
+    client, _ = self._CreateWadoRsClient(['jpeg'], content_type='image/jpeg')
+
+    with self.assertRaisesRegexp(RuntimeError, 'not multipart'):
+      list(client.IterWadoRsParts(_INSTANCE_PATH % 1))
+
+  def test_iter_wado_rs_parts_truncated_response_raises(self):
+    client, _ = self._CreateWadoRsClient(['--b\r\n\r\nfir'])
+
+    with self.assertRaisesRegexp(RuntimeError, 'without closing boundary'):
+      list(client.IterWadoRsParts(_INSTANCE_PATH % 1))
+
+  def test_iter_wado_rs_parts_connection_error_raises_runtime_error(self):
+    client, _ = self._CreateWadoRsClient([
+        '--b\r\n\r\nfir',
+        requests.exceptions.ChunkedEncodingError('Connection broken')
+    ])
+
+    with self.assertRaises(RuntimeError):
+      list(client.IterWadoRsParts(_INSTANCE_PATH % 1))
+
+  def test_wado_rs(self):
+    client, _ = self._CreateWadoRsClient(
+        ['--b\r\nContent-Type: image/jpeg\r\n\r\njpeg\r\n--b--\r\n'])
+
+    self.assertEqual(client.WadoRs(_INSTANCE_PATH % 1), 'jpeg')
+
+  def test_wado_rs_with_several_parts_raises(self):
+    client, _ = self._CreateWadoRsClient(
+        ['--b\r\n\r\nfirst\r\n--b\r\n\r\nsecond\r\n--b--\r\n'])
+
+    with self.assertRaisesRegexp(RuntimeError, 'number of WADO-RS'):
+      client.WadoRs(_INSTANCE_PATH % 1)
+
+  def test_connection_error_raises_runtime_error(self):
+    # Nothing listens on the discard port.
+    client = dicomweb.DicomWebClient(None, url_prefix='http://127.0.0.1:9')
+
+    with self.assertRaises(RuntimeError):
+      client.StowRs('projects/p/locations/l/datasets/d/dicomStores/s/dicomWeb/'
+                    'studies', ['{}'])
+
+
+class StowRsWriterTest(unittest.TestCase):
+
+  def _Write(self, stow_writer, sop_instance_uid, study_path=_STUDY_PATH):
+    return stow_writer.Write(study_path, sop_instance_uid,
+                             _InstanceJson(sop_instance_uid))
+
+  def test_sends_batch_when_full(self):
+    client = _FakeStowClient()
+    stow_writer = dicomweb.StowRsWriter(
+        client, max_batch_size=2, max_latency_secs=_TIMEOUT_SECS * 10)
+
+    first = self._Write(stow_writer, '1.1')
+    self.assertEqual(client.requests, [])
+    second = self._Write(stow_writer, '1.2')
+    first.result(_TIMEOUT_SECS)
+    second.result(_TIMEOUT_SECS)
+
+    self.assertEqual(client.requests, [(_STUDY_PATH, ['1.1', '1.2'])])
+
+  def test_sends_batch_when_bytes_exceeded(self):
+    client = _FakeStowClient()
+    stow_writer = dicomweb.StowRsWriter(
+        client,
+        max_batch_size=10,
+        max_batch_bytes=len(_InstanceJson('1.1')) + 1,
+        max_latency_secs=_TIMEOUT_SECS * 10)
+
+    self._Write(stow_writer, '1.1')
+    self._Write(stow_writer, '1.2').result(_TIMEOUT_SECS)
+
+    self.assertEqual(client.requests, [(_STUDY_PATH, ['1.1', '1.2'])])
+
+  def test_sends_partial_batch_when_latency_is_up(self):
+    client = _FakeStowClient()
+    stow_writer = dicomweb.StowRsWriter(
+        client, max_batch_size=10, max_latency_secs=0.01)
+
+    self._Write(stow_writer, '1.1').result(_TIMEOUT_SECS)
+    self._Write(stow_writer, '1.2').result(_TIMEOUT_SECS)
+
+    self.assertEqual(client.requests, [(_STUDY_PATH, ['1.1']),
+                                       (_STUDY_PATH, ['1.2'])])
+
+  def test_batches_per_study_path(self):
+    other_study_path = _STUDY_PATH.replace('dicomStores/s', 'dicomStores/t')
+    client = _FakeStowClient()
+    stow_writer = dicomweb.StowRsWriter(
+        client, max_batch_size=2, max_latency_secs=_TIMEOUT_SECS * 10)
+
+    self._Write(stow_writer, '1.1')
+    self._Write(stow_writer, '2.1', study_path=other_study_path)
+    self._Write(stow_writer, '1.2').result(_TIMEOUT_SECS)
+
+    self.assertEqual(client.requests, [(_STUDY_PATH, ['1.1', '1.2'])])
+
+  def test_flush_sends_pending_batches(self):
+    client = _FakeStowClient()
+    stow_writer = dicomweb.StowRsWriter(
+        client, max_batch_size=10, max_latency_secs=_TIMEOUT_SECS * 10)
+    future = self._Write(stow_writer, '1.1')
+
+    flushed = stow_writer.Flush(_TIMEOUT_SECS)
+
+    self.assertTrue(flushed)
+    self.assertTrue(future.done())
+    self.assertEqual(client.requests, [(_STUDY_PATH, ['1.1'])])
+
+  def test_fails_only_failed_instances(self):
+    client = _FakeStowClient(
+        failures_fn=lambda _: {'1.2': _PROCESSING_FAILURE_REASON})
+    stow_writer = dicomweb.StowRsWriter(client, max_batch_size=3)
+
+    results = [self._Write(stow_writer, uid) for uid in ('1.1', '1.2', '1.3')]
+
+    self.assertIsNone(results[0].result(_TIMEOUT_SECS))
+    self.assertIsInstance(results[1].exception(_TIMEOUT_SECS), RuntimeError)
+    self.assertIsNone(results[2].result(_TIMEOUT_SECS))
+
+  def test_duplicate_instance_counts_as_stored(self):
+    client = _FakeStowClient(failures_fn=lambda _: {'1.1': 0x0111})
+    stow_writer = dicomweb.StowRsWriter(client)
+
+    future = self._Write(stow_writer, '1.1')
+
+    self.assertIsNone(future.result(_TIMEOUT_SECS))
+
+  def test_failed_request_fails_all_instances(self):
+    client = _FakeStowClient(exception=RuntimeError('Service unavailable'))
+    stow_writer = dicomweb.StowRsWriter(client, max_batch_size=2)
+
+    results = [self._Write(stow_writer, uid) for uid in ('1.1', '1.2')]
+
+    for future in results:
+      self.assertIsInstance(future.exception(_TIMEOUT_SECS), RuntimeError)
+
+
+class BatchingPredictorTest(unittest.TestCase):
+
+  def _PredictConcurrently(self, predictor, images):
+    """Calls Predict for each image on its own thread.
+
+    Returns:
+      List of the result of each call, or the exception it raised.
+    """
+    results = [None] * len(images)
+
+    def _Predict(i):
+      try:
+        results[i] = predictor.Predict(images[i])
+      except Exception as e:  # pylint: disable=broad-except
+        results[i] = e
+
+    threads = [
+        threading.Thread(target=_Predict, args=(i,))
+        for i in range(len(images))
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(_TIMEOUT_SECS)
+    return results
+
+  def _WaitForQueuedImages(self, predictor, count):
+    """Waits until count images were queued, whether or not they are taken."""
+    # Queue.get does not decrement unfinished_tasks, only task_done would.
+    while predictor._queue.unfinished_tasks < count:
+      time.sleep(0.001)
+
+  def test_returns_results_by_position(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.BatchingPredictor(
+        batch_predictor, max_batch_size=3, max_latency_secs=_TIMEOUT_SECS * 10)
+    images = ['a', 'b', 'c']
+
+    results = self._PredictConcurrently(predictor, images)
+
+    self.assertEqual(results, [(image, '0.9') for image in images])
+    self.assertEqual(len(batch_predictor.batches), 1)
+    self.assertEqual(sorted(batch_predictor.batches[0]), images)
+
+  def test_batch_exception_raised_in_every_caller(self):
+    exception = RuntimeError('Prediction failed')
+    batch_predictor = _BatchPredictor(exception=exception)
+    predictor = inference.BatchingPredictor(
+        batch_predictor, max_batch_size=2, max_latency_secs=_TIMEOUT_SECS * 10)
+
+    results = self._PredictConcurrently(predictor, ['a', 'b'])
+
+    self.assertEqual(results, [exception, exception])
+    self.assertEqual(len(batch_predictor.batches), 1)
+
+  def test_sends_partial_batch_when_latency_is_up(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.BatchingPredictor(
+        batch_predictor, max_batch_size=10, max_latency_secs=0.01)
+
+    result = predictor.Predict('a')
+
+    self.assertEqual(result, ('a', '0.9'))
+    self.assertEqual(batch_predictor.batches, [['a']])
+
+  def test_close_sends_queued_images(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.BatchingPredictor(
+        batch_predictor, max_batch_size=10, max_latency_secs=_TIMEOUT_SECS * 10)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(predictor.Predict('a')))
+    thread.start()
+    self._WaitForQueuedImages(predictor, 1)
+
+    predictor.Close()
+    thread.join(_TIMEOUT_SECS)
+
+    self.assertEqual(results, [('a', '0.9')])
+    self.assertEqual(batch_predictor.batches, [['a']])
+    self.assertFalse(predictor._collector.is_alive())
+    self.assertTrue(batch_predictor.closed)
+
+  def test_predict_after_close_raises(self):
+    predictor = inference.BatchingPredictor(
+        _BatchPredictor(), max_batch_size=10, max_latency_secs=0.01)
+
+    predictor.Close()
+    predictor.Close()
+
+    self.assertFalse(predictor._collector.is_alive())
+    with self.assertRaises(RuntimeError):
+      predictor.Predict('a')
+
+
+class CachingPredictorTest(unittest.TestCase):
+
+  def setUp(self):
+    self._cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._cache_dir)
+
+  def test_predict_caches_prediction(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=10)
+
+    results = [predictor.Predict('a'), predictor.Predict('a')]
+
+    self.assertEqual(results, [('a', '0.9')] * 2)
+    self.assertEqual(batch_predictor.batches, [['a']])
+
+  def test_predict_batch_only_predicts_missing_images(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=10)
+    predictor.Predict('b')
+
+    results = predictor.PredictBatch(['a', 'b', 'c', 'b'])
+
+    self.assertEqual(results, [('a', '0.9'), ('b', '0.9'), ('c', '0.9'),
+                               ('b', '0.9')])
+    self.assertEqual(batch_predictor.batches, [['b'], ['a', 'c']])
+
+  def test_predict_batch_with_all_images_cached(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=10)
+    predictor.PredictBatch(['a', 'b'])
+
+    results = predictor.PredictBatch(['b', 'a'])
+
+    self.assertEqual(results, [('b', '0.9'), ('a', '0.9')])
+    self.assertEqual(batch_predictor.batches, [['a', 'b']])
+
+  def test_evicts_least_recently_used_predictions(self):
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=1)
+
+    for image in ('a', 'b', 'a'):
+      predictor.Predict(image)
+
+    self.assertEqual(batch_predictor.batches, [['a'], ['b'], ['a']])
+
+  def test_predictions_read_from_disk(self):
+    inference.CachingPredictor(
+        _BatchPredictor(), model_version='v1', max_size=10,
+        cache_dir=self._cache_dir).PredictBatch(['a', 'b'])
+    batch_predictor = _BatchPredictor()
+    # Without an in-memory cache, e.g. in another process.
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=0,
+        cache_dir=self._cache_dir)
+
+    results = [predictor.Predict('a')] + predictor.PredictBatch(['b', 'c'])
+
+    self.assertEqual(results, [('a', '0.9'), ('b', '0.9'), ('c', '0.9')])
+    self.assertEqual(batch_predictor.batches, [['c']])
+
+  def test_unreadable_disk_entry_is_predicted_again(self):
+    predictor = inference.CachingPredictor(
+        _BatchPredictor(), model_version='v1', max_size=0,
+        cache_dir=self._cache_dir)
+    predictor.Predict('a')
+    for directory, _, filenames in os.walk(self._cache_dir):
+      for filename in filenames:
+        with open(os.path.join(directory, filename), 'w') as f:
+          f.write('[')
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v1', max_size=0,
+        cache_dir=self._cache_dir)
+
+    self.assertEqual(predictor.Predict('a'), ('a', '0.9'))
+    self.assertEqual(batch_predictor.batches, [['a']])
+
+  def test_model_versions_do_not_share_predictions(self):
+    inference.CachingPredictor(
+        _BatchPredictor(), model_version='v1', max_size=10,
+        cache_dir=self._cache_dir).Predict('a')
+    batch_predictor = _BatchPredictor()
+    predictor = inference.CachingPredictor(
+        batch_predictor, model_version='v2', max_size=10,
+        cache_dir=self._cache_dir)
+
+    predictor.Predict('a')
+
+    self.assertEqual(batch_predictor.batches, [['a']])
+
+  def test_key_separates_model_version_from_image(self):
+    predictor = inference.CachingPredictor(
+        _BatchPredictor(), model_version='v1', max_size=10)
+    other_predictor = inference.CachingPredictor(
+        _BatchPredictor(), model_version='v', max_size=10)
+
+    self.assertNotEqual(predictor._Key('a'), other_predictor._Key('1a'))
+
+
+class PubsubMessageHandlerTest(unittest.TestCase):
+
+  def test_failing_shadow_model_stores_live_report(self):
+    stow_writer = _FakeStowWriter()
+    handler = _CreateHandler(
+        _FakePredictor(),
+        stow_writer=stow_writer,
+        additional_models=[
+            inference.Model(
+                name='shadow',
+                predictor=_FailingPredictor(),
+                version='v2',
+                shadow=True)
+        ])
+    message = _FakeMessage(_INSTANCE_PATH % 1)
+
+    handler.PubsubCallback(message)
+
+    self.assertEqual(len(stow_writer.written), 1)
+    self.assertEqual(message.acks, 1)
+    self.assertEqual(message.nacks, 0)
+    self.assertEqual(handler.GetSuccessCount(), 1)
+
+  def test_records_processed_instance(self):
+    processed_set = _RecordingProcessedSet()
+    handler = _CreateHandler(
+        _FakePredictor(),
+        stow_writer=_FakeStowWriter(),
+        processed_set=processed_set)
+    message = _FakeMessage(_INSTANCE_PATH % 1)
+
+    handler.PubsubCallback(message)
+
+    self.assertEqual(message.acks, 1)
+    self.assertEqual(len(processed_set.added), 1)
+
+  def test_does_not_record_ignored_instance(self):
+    processed_set = _RecordingProcessedSet()
+    stow_writer = _FakeStowWriter()
+    handler = _CreateHandler(
+        _FakePredictor(), stow_writer=stow_writer, processed_set=processed_set)
+    message = _FakeMessage(_INSTANCE_PATH % 1)
+    message.attributes[_MODALITY_ATTRIBUTE] = 'CT'
+
+    handler.PubsubCallback(message)
+
+    self.assertEqual(message.acks, 1)
+    self.assertEqual(stow_writer.written, [])
+    self.assertEqual(processed_set.added, [])
+
+  def test_nacks_message_when_report_not_stored(self):
+    handler = _CreateHandler(
+        _FakePredictor(),
+        stow_writer=_FakeStowWriter(
+            exception=requests.exceptions.ConnectionError('Connection reset')))
+    message = _FakeMessage(_INSTANCE_PATH % 1)
+
+    handler.PubsubCallback(message)
+
+    self.assertEqual(message.acks, 0)
+    self.assertEqual(message.nacks, 1)
+    self.assertEqual(handler.GetSuccessCount(), 0)
+
+  def test_nacks_only_messages_whose_report_failed(self):
+    # Fails the report stored first in each request.
+    client = _FakeStowClient(
+        failures_fn=lambda uids: {uids[0]: _PROCESSING_FAILURE_REASON})
+    stow_writer = dicomweb.StowRsWriter(
+        client, max_batch_size=2, max_latency_secs=_TIMEOUT_SECS * 10)
+    handler = _CreateHandler(_FakePredictor(), stow_writer=stow_writer)
+    failed_message = _FakeMessage(_INSTANCE_PATH % 1)
+    stored_message = _FakeMessage(_INSTANCE_PATH % 2)
+
+    handler.PubsubCallback(failed_message)
+    handler.PubsubCallback(stored_message)
+    stow_writer.Flush(_TIMEOUT_SECS)
+
+    self.assertEqual(len(client.requests), 1)
+    self.assertEqual((failed_message.acks, failed_message.nacks), (0, 1))
+    self.assertEqual((stored_message.acks, stored_message.nacks), (1, 0))
+    self.assertEqual(handler.GetSuccessCount(), 1)
+
+  def test_drain_does_not_redeliver_messages(self):
+    max_messages = 3
+    gate = threading.Event()
+    predictor = _FakePredictor(gate)
+    # Drain flushes the StowRsWriter once it stopped processing new messages,
+    # which lets the messages in flight complete.
+    handler = _CreateHandler(
+        predictor, stow_writer=_FakeStowWriter(on_flush=gate.set))
+    subscriber = _FakeSubscriber(
+        handler.PubsubCallback, num_messages=10, max_messages=max_messages)
+    predictor.WaitForPredictions(max_messages)
+
+    drained = handler.Drain(_TIMEOUT_SECS)
+    subscriber.cancel()
+
+    self.assertTrue(drained)
+    self.assertEqual(handler.GetSuccessCount(), max_messages)
+    # Only the messages delivered while the first ones were in flight are
+    # nacked, and each of them once.
+    self.assertLessEqual(len(subscriber.nacked), max_messages)
+    self.assertEqual(len(set(subscriber.nacked)), len(subscriber.nacked))
+
+
+if __name__ == '__main__':
+  unittest.main()
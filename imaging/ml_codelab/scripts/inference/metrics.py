@@ -0,0 +1,89 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prometheus metrics of the inference module.
+
+The metrics are exported on a local HTTP endpoint by calling StartServer, e.g.
+http://localhost:8000/metrics, where they can be scraped by Prometheus.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import prometheus_client
+
+# Stages of message processing whose latency is recorded.
+PARSE_STAGE = 'parse'
+WADO_STAGE = 'wado'
+STUDY_QIDO_STAGE = 'study_qido'
+PREDICT_STAGE = 'predict'
+STOW_STAGE = 'stow'
+PUBLISH_STAGE = 'publish'
+
+# Outcomes of a Pub/Sub message.
+ACK_OUTCOME = 'ack'
+NACK_OUTCOME = 'nack'
+IGNORED_OUTCOME = 'ignored'
+DUPLICATE_OUTCOME = 'duplicate'
+
+# Payloads whose size is recorded.
+IMAGE_PAYLOAD = 'image'
+STRUCTURED_REPORT_PAYLOAD = 'structured_report'
+
+# Latency buckets, in seconds, from 5ms to 60s.
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# Size buckets, in bytes, from 1KiB to 64MiB.
+_SIZE_BUCKETS = tuple(1024 * 4**i for i in range(9))
+
+STAGE_LATENCY = prometheus_client.Histogram(
+    'inference_stage_latency_seconds',
+    'Latency of each stage of Pub/Sub message processing.', ['stage'],
+    buckets=_LATENCY_BUCKETS)
+
+STAGE_IN_FLIGHT = prometheus_client.Gauge(
+    'inference_stage_in_flight', 'Number of tasks running in each stage.',
+    ['stage'])
+
+MESSAGES_IN_FLIGHT = prometheus_client.Gauge(
+    'inference_messages_in_flight',
+    'Number of Pub/Sub messages received but not acked or nacked yet.')
+
+MESSAGES = prometheus_client.Counter(
+    'inference_messages_total', 'Number of Pub/Sub messages, by outcome.',
+    ['outcome'])
+
+PREDICTIONS = prometheus_client.Counter(
+    'inference_predictions_total',
+    'Number of predictions, by model and predicted class.',
+    ['model', 'predicted_class'])
+
+PAYLOAD_BYTES = prometheus_client.Histogram(
+    'inference_payload_bytes', 'Size of the payloads handled, by payload.',
+    ['payload'],
+    buckets=_SIZE_BUCKETS)
+
+
+def Timed(stage, fn, *args):
+  # type: (str, Callable, ...) -> Any
+  """Calls fn(*args), recording its latency and in-flight count for stage."""
+  with STAGE_IN_FLIGHT.labels(stage).track_inprogress():
+    with STAGE_LATENCY.labels(stage).time():
+      return fn(*args)
+
+
+def StartServer(port):
+  # type: int -> None
+  """Serves the metrics on http://localhost:port/metrics."""
+  prometheus_client.start_http_server(port)
@@ -15,7 +15,7 @@ from setuptools import find_packages
 from setuptools import setup
 
 REQUIRED_PACKAGES = [
-    'requests-toolbelt',
+    'requests',
     'google-api-python-client',
     'google-api-core',
     # Pin googleapis-common-proto until issue is resolved.
@@ -25,7 +25,9 @@ REQUIRED_PACKAGES = [
     'httplib2',
     'oauth2client',
     'google-cloud-automl',
-    'attrs'
+    'attrs',
+    'futures',
+    'prometheus_client',
 ]
 
 setup(
@@ -30,3 +30,7 @@ TEXT_VALUE = DicomTag(number='0040A160', vr='UT')
 CONTENT_SEQUENCE = DicomTag(number='0040A730', vr='SQ')
 SPECIFIC_CHARACTER_SET = DicomTag(number='00080005', vr='CS')
 MODALITY_TAG = DicomTag(number='00080060', vr='CS')
+MODALITIES_IN_STUDY = DicomTag(number='00080061', vr='CS')
+REFERENCED_SOP_INSTANCE_UID = DicomTag(number='00081155', vr='UI')
+FAILURE_REASON = DicomTag(number='00081197', vr='US')
+FAILED_SOP_SEQUENCE = DicomTag(number='00081198', vr='SQ')
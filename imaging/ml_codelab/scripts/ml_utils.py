@@ -23,7 +23,32 @@ import tensorflow_hub
 # URL to the trained neural net, which gets feature vectors from images. It is a
 # checkpoint of Inception V3 model trained on ImageNet with the few last
 # classification layers stripped.
-_FEATURE_VECTORS_MODULE_URL = 'https://tfhub.dev/google/imagenet/inception_v3/feature_vector/1'
+FEATURE_VECTORS_MODULE_URL = 'https://tfhub.dev/google/imagenet/inception_v3/feature_vector/1'
+
+
+def _decode_and_resize_jpeg(input_jpeg_str, input_height, input_width,
+                            input_depth):
+  # type: (tf.Tensor, int, int, int) -> tf.Tensor
+  """Decodes a JPEG string tensor and resizes it to the model input size.
+
+  Args:
+    input_jpeg_str: Tensor for input JPEG image.
+    input_height: Height of the model input.
+    input_width: Width of the model input.
+    input_depth: Number of channels of the model input.
+
+  Returns:
+    Float Tensor of shape [input_height, input_width, input_depth].
+  """
+  decoded_image = tf.image.decode_jpeg(input_jpeg_str, channels=input_depth)
+  decoded_image_as_float = tf.image.convert_image_dtype(decoded_image,
+                                                        tf.float32)
+  decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
+  resize_shape = tf.stack([input_height, input_width])
+  resize_shape_as_int = tf.cast(resize_shape, dtype=tf.int32)
+  resized_image_4d = tf.image.resize_bilinear(decoded_image_4d,
+                                              resize_shape_as_int)
+  return tf.squeeze(resized_image_4d, [0])
 
 
 def get_bottleneck_tensor(input_jpeg_str):
@@ -40,18 +65,42 @@ def get_bottleneck_tensor(input_jpeg_str):
   Returns:
     bottleneck_tensor: Tensor for output bottleneck Tensor.
   """
-  module_spec = tensorflow_hub.load_module_spec(_FEATURE_VECTORS_MODULE_URL)
+  module_spec = tensorflow_hub.load_module_spec(FEATURE_VECTORS_MODULE_URL)
   input_height, input_width = tensorflow_hub.get_expected_image_size(
       module_spec)
   input_depth = tensorflow_hub.get_num_image_channels(module_spec)
-  decoded_image = tf.image.decode_jpeg(input_jpeg_str, channels=input_depth)
-  decoded_image_as_float = tf.image.convert_image_dtype(decoded_image,
-                                                        tf.float32)
-  decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
-  resize_shape = tf.stack([input_height, input_width])
-  resize_shape_as_int = tf.cast(resize_shape, dtype=tf.int32)
-  resized_image_4d = tf.image.resize_bilinear(decoded_image_4d,
-                                              resize_shape_as_int)
+  resized_image_4d = tf.expand_dims(
+      _decode_and_resize_jpeg(input_jpeg_str, input_height, input_width,
+                              input_depth), 0)
   m = tensorflow_hub.Module(module_spec)
   bottleneck_tensor = m(resized_image_4d)
   return bottleneck_tensor
+
+
+def get_bottleneck_tensor_batch(input_jpeg_strs):
+  # type: tf.Tensor -> tf.Tensor
+  """Calculates the bottleneck tensor for a batch of JPEG string tensors.
+
+  Each image is decoded and resized on its own, since the images may have
+  different sizes. The resized images are then run through the InceptionV3
+  checkpoint as one batch, which is much faster than one image at a time.
+
+  Args:
+    input_jpeg_strs: 1-D Tensor of input JPEG images.
+
+  Returns:
+    bottleneck_tensor: Tensor of shape [batch size, bottleneck size].
+  """
+  module_spec = tensorflow_hub.load_module_spec(FEATURE_VECTORS_MODULE_URL)
+  input_height, input_width = tensorflow_hub.get_expected_image_size(
+      module_spec)
+  input_depth = tensorflow_hub.get_num_image_channels(module_spec)
+  resized_images_4d = tf.map_fn(
+      lambda input_jpeg_str: _decode_and_resize_jpeg(
+          input_jpeg_str, input_height, input_width, input_depth),
+      input_jpeg_strs,
+      back_prop=False,
+      dtype=tf.float32)
+  m = tensorflow_hub.Module(module_spec)
+  bottleneck_tensor = m(resized_images_4d)
+  return bottleneck_tensor
@@ -0,0 +1,266 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Manifest index mapping each study_uid to the path of its image in GCS.
+
+Listing all images of the input bucket with a recursive glob gets slower as
+the bucket grows. Instead, this script writes a manifest of the images once,
+which the preprocess.py pipeline then reads when passed --manifest_path.
+
+The manifest is a set of shards named manifest-SSSSS-of-NNNNN in the
+manifest directory. Each line of a shard is "<study_uid>\t<image path>", and
+the lines are sorted by study_uid across all shards.
+
+The study directories to list are grouped by the prefix of their study_uid,
+and the images are listed with one listing per prefix, up to --parallelism
+prefixes, running concurrently. On GCS, a listing only returns the objects
+whose name starts with its prefix. When a manifest already exists, only the
+new studies, i.e. the studies missing from it, are listed and added to it, so
+that the studies already in the manifest keep the same image across runs.
+Images added to studies already in the manifest are only picked up with
+--relist_studies, which replaces the manifest with a complete listing.
+
+Example usage:
+python -m scripts.preprocess.manifest --input_path=gs://<bucket_name> \
+  --manifest_path=gs://<bucket_name>-manifest
+"""
+
+import warnings
+import argparse
+import logging
+from multiprocessing import pool as multiprocessing_pool
+import os
+import sys
+
+# TODO(b/112609807): Remove when Tensorflow library is updated.
+warnings.filterwarnings('ignore')
+from apache_beam.io.filesystems import FileSystems
+from tensorflow.python.lib.io import file_io
+
+# Default number of study_uid prefixes listed, or shards read, concurrently.
+DEFAULT_PARALLELISM = 32
+
+# Default number of shards the manifest is written to.
+_DEFAULT_NUM_SHARDS = 16
+
+# Name of the manifest shards, relative to the manifest directory.
+_SHARD_PATTERN = 'manifest-%05d-of-%05d'
+_SHARD_GLOB = 'manifest-*-of-*'
+
+
+def _map_concurrently(fn, items, parallelism):
+  # type: (Callable, List, int) -> List
+  """Returns [fn(item) for item in items], running up to parallelism at once."""
+  if not items:
+    return []
+  threads = multiprocessing_pool.ThreadPool(min(parallelism, len(items)))
+  try:
+    return threads.map(fn, items)
+  finally:
+    threads.close()
+
+
+def file_pattern(manifest_path):
+  # type: str -> str
+  """Returns the file pattern matching the shards of a manifest."""
+  return os.path.join(manifest_path, _SHARD_GLOB)
+
+
+def parse_line(line):
+  # type: str -> (str, str)
+  """Returns the (study_uid, image path) of a line of a manifest shard."""
+  study_uid, image_path = line.split('\t', 1)
+  return study_uid, image_path
+
+
+def exists(manifest_path):
+  # type: str -> bool
+  """Returns whether a manifest was written to manifest_path."""
+  # Matching files in a local directory that does not exist fails.
+  return file_io.file_exists(manifest_path) and bool(
+      file_io.get_matching_files(file_pattern(manifest_path)))
+
+
+def read(manifest_path, parallelism=DEFAULT_PARALLELISM):
+  # type: (str, int) -> Dict[str, str]
+  """Reads a manifest.
+
+  Args:
+    manifest_path: Directory of the manifest.
+    parallelism: Number of shards read concurrently.
+
+  Returns:
+    Dictionary mapping study_uid to image path.
+  """
+  shard_paths = file_io.get_matching_files(file_pattern(manifest_path))
+  study_uid_to_image_path = {}
+  for content in _map_concurrently(file_io.read_file_to_string, shard_paths,
+                                   parallelism):
+    study_uid_to_image_path.update(
+        parse_line(line) for line in content.splitlines())
+  return study_uid_to_image_path
+
+
+def write(manifest_path,
+          study_uid_to_image_path,
+          num_shards=_DEFAULT_NUM_SHARDS):
+  # type: (str, Dict[str, str], int) -> None
+  """Writes a manifest, replacing the shards of any previous one.
+
+  Args:
+    manifest_path: Directory of the manifest.
+    study_uid_to_image_path: Dictionary mapping study_uid to image path.
+    num_shards: Number of shards the manifest is written to.
+  """
+  lines = [
+      '%s\t%s\n' % (study_uid, image_path)
+      for study_uid, image_path in sorted(study_uid_to_image_path.iteritems())
+  ]
+  file_io.recursive_create_dir(manifest_path)
+  old_shard_paths = set(
+      file_io.get_matching_files(file_pattern(manifest_path)))
+  shard_size = (len(lines) + num_shards - 1) // num_shards
+  for shard in range(num_shards):
+    shard_path = os.path.join(manifest_path, _SHARD_PATTERN % (shard,
+                                                               num_shards))
+    file_io.write_string_to_file(
+        shard_path,
+        ''.join(lines[shard * shard_size:(shard + 1) * shard_size]))
+    old_shard_paths.discard(shard_path)
+  # Shards of a previous manifest with another number of shards.
+  for shard_path in old_shard_paths:
+    file_io.delete_file(shard_path)
+
+
+def _study_uid_prefixes(study_uids, max_prefixes):
+  # type: (List[str], int) -> List[str]
+  """Returns prefixes that together match all study UIDs.
+
+  The prefixes are the longest ones such that there are at most max_prefixes
+  of them, although there is at least one character past the prefix common to
+  all study UIDs.
+
+  Args:
+    study_uids: Study UIDs to match, not empty.
+    max_prefixes: Maximum number of prefixes, unless that is less than the
+      number of values of the first character past the common prefix.
+
+  Returns:
+    Sorted list of prefixes.
+  """
+  length = len(os.path.commonprefix(study_uids)) + 1
+  prefixes = sorted({study_uid[:length] for study_uid in study_uids})
+  while length < max(len(study_uid) for study_uid in study_uids):
+    longer_prefixes = sorted(
+        {study_uid[:length + 1] for study_uid in study_uids})
+    if len(longer_prefixes) > max_prefixes:
+      break
+    length += 1
+    prefixes = longer_prefixes
+  return prefixes
+
+
+def list_images(input_path, parallelism=DEFAULT_PARALLELISM,
+                known_study_uids=()):
+  # type: (str, int, Container[str]) -> Dict[str, str]
+  """Lists the images of the input directory, a few study_uid prefixes at once.
+
+  Listing each study directory separately takes one request per study. The
+  study directories are listed once instead, and the ones not in
+  known_study_uids are grouped by the prefix of their study_uid, so that
+  their images are listed with one listing per prefix. On GCS, the listing
+  of a prefix is a listing of the object names starting with
+  <input_path>/<prefix>, which only returns the objects of its studies, and
+  of the few known studies sharing the prefix.
+
+  Args:
+    input_path: Input directory of images, holding
+      <study_uid>/<series_uid>/<instance_uid>.jpg files.
+    parallelism: Maximum number of prefixes, all listed concurrently.
+    known_study_uids: Study UIDs that are not listed.
+
+  Returns:
+    Dictionary mapping study_uid to image path, for the studies that are not
+    in known_study_uids.
+  """
+  study_uids = set(
+      entry.rstrip('/') for entry in file_io.list_directory(input_path)
+  ).difference(known_study_uids)
+  if not study_uids:
+    return {}
+  prefixes = _study_uid_prefixes(sorted(study_uids), parallelism)
+  logging.info('Listing the images of %d studies with %d prefixes',
+               len(study_uids), len(prefixes))
+
+  def _list_prefix(prefix):
+    pattern = os.path.join(input_path, prefix + '*', '*', '*')
+    return [
+        metadata.path
+        for metadata in FileSystems.match([pattern])[0].metadata_list
+    ]
+
+  input_dir = input_path.rstrip('/') + '/'
+  study_uid_to_image_path = {}
+  for image_paths in _map_concurrently(_list_prefix, prefixes, parallelism):
+    for image_path in sorted(image_paths):
+      study_uid = image_path[len(input_dir):].split('/', 1)[0]
+      if study_uid in study_uids:
+        study_uid_to_image_path[study_uid] = image_path
+  return study_uid_to_image_path
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--input_path',
+      required=True,
+      help='Path to input directory of images, with format '
+      'gs://<bucket_name>/<study_uid>/<series_uid>/<instance_uid>.jpg')
+  parser.add_argument(
+      '--manifest_path',
+      required=True,
+      help='Directory the manifest is written to. If it already holds a '
+      'manifest, only the studies missing from it are added, unless '
+      '--relist_studies is set.')
+  parser.add_argument(
+      '--relist_studies',
+      action='store_true',
+      help='Replace an existing manifest with a complete listing, so that '
+      'images added to the studies already in it are picked up.')
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=_DEFAULT_NUM_SHARDS,
+      help='Number of shards the manifest is written to.')
+  parser.add_argument(
+      '--parallelism',
+      type=int,
+      default=DEFAULT_PARALLELISM,
+      help='Maximum number of study_uid prefixes, all listed concurrently, and '
+      'number of manifest shards read concurrently.')
+  args = parser.parse_args(argv)
+
+  study_uid_to_image_path = {}
+  if exists(args.manifest_path) and not args.relist_studies:
+    study_uid_to_image_path = read(args.manifest_path, args.parallelism)
+  new_images = list_images(args.input_path, args.parallelism,
+                           study_uid_to_image_path)
+  logging.info('Adding %d studies to the %d studies of the manifest',
+               len(new_images), len(study_uid_to_image_path))
+  study_uid_to_image_path.update(new_images)
+  write(args.manifest_path, study_uid_to_image_path, args.num_shards)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main(sys.argv[1:])
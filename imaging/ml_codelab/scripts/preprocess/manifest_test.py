@@ -0,0 +1,138 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for scripts.preprocess.manifest.
+
+Run from the ml_codelab directory with:
+python -m unittest scripts.preprocess.manifest_test
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import scripts.preprocess.manifest as manifest
+
+_STUDY_UID_ROOT = '1.3.6.1.4.1.9590.100.1.2.'
+
+
+class StudyUidPrefixesTest(unittest.TestCase):
+
+  def _assert_prefixes_match(self, prefixes, study_uids):
+    for study_uid in study_uids:
+      self.assertTrue(
+          any(study_uid.startswith(prefix) for prefix in prefixes), study_uid)
+
+  def test_extends_common_prefix(self):
+    study_uids = [_STUDY_UID_ROOT + str(i) for i in range(1000, 1100)]
+
+    prefixes = manifest._study_uid_prefixes(study_uids, 32)
+
+    # 100 prefixes of one more character would be too many.
+    self.assertEqual(prefixes,
+                     [_STUDY_UID_ROOT + str(i) for i in range(100, 110)])
+
+  def test_at_most_max_prefixes(self):
+    study_uids = [_STUDY_UID_ROOT + str(i) for i in range(1000, 3000)]
+
+    prefixes = manifest._study_uid_prefixes(study_uids, 32)
+
+    self.assertEqual(prefixes,
+                     [_STUDY_UID_ROOT + str(i) for i in range(10, 30)])
+    self._assert_prefixes_match(prefixes, study_uids)
+
+  def test_few_study_uids_get_full_prefixes(self):
+    study_uids = [_STUDY_UID_ROOT + '12345', _STUDY_UID_ROOT + '67890']
+
+    prefixes = manifest._study_uid_prefixes(study_uids, 32)
+
+    self.assertEqual(prefixes, study_uids)
+
+  def test_first_character_past_common_prefix(self):
+    study_uids = ['1.1', '1.2', '1.3']
+
+    prefixes = manifest._study_uid_prefixes(study_uids, 2)
+
+    self.assertEqual(prefixes, study_uids)
+
+
+class ListImagesTest(unittest.TestCase):
+
+  def setUp(self):
+    self._input_path = tempfile.mkdtemp()
+    self._study_uids = [_STUDY_UID_ROOT + str(i) for i in range(100, 150)]
+    for study_uid in self._study_uids:
+      series_dir = os.path.join(self._input_path, study_uid, study_uid + '.1')
+      os.makedirs(series_dir)
+      open(os.path.join(series_dir, study_uid + '.1.1.jpg'), 'w').close()
+
+  def tearDown(self):
+    shutil.rmtree(self._input_path)
+
+  def _image_path(self, study_uid):
+    return os.path.join(self._input_path, study_uid, study_uid + '.1',
+                        study_uid + '.1.1.jpg')
+
+  def test_lists_all_studies(self):
+    study_uid_to_image_path = manifest.list_images(
+        self._input_path, parallelism=4)
+
+    self.assertEqual(study_uid_to_image_path, {
+        study_uid: self._image_path(study_uid)
+        for study_uid in self._study_uids
+    })
+
+  def test_skips_known_studies_before_listing(self):
+    known_study_uids = set(self._study_uids[:-1])
+    new_study_uid = self._study_uids[-1]
+
+    with mock.patch.object(
+        manifest.FileSystems, 'match',
+        wraps=manifest.FileSystems.match) as match:
+      study_uid_to_image_path = manifest.list_images(
+          self._input_path, known_study_uids=known_study_uids)
+
+    self.assertEqual(study_uid_to_image_path,
+                     {new_study_uid: self._image_path(new_study_uid)})
+    # Only the prefix of the new study is listed.
+    self.assertEqual(match.call_count, 1)
+    (pattern,), = match.call_args[0]
+    self.assertEqual(pattern,
+                     os.path.join(self._input_path, new_study_uid + '*', '*',
+                                  '*'))
+
+  def test_lists_nothing_when_all_studies_known(self):
+    with mock.patch.object(manifest.FileSystems, 'match') as match:
+      study_uid_to_image_path = manifest.list_images(
+          self._input_path, known_study_uids=self._study_uids)
+
+    self.assertEqual(study_uid_to_image_path, {})
+    self.assertFalse(match.called)
+
+  def test_write_and_read(self):
+    manifest_path = os.path.join(self._input_path, 'manifest')
+    study_uid_to_image_path = {
+        study_uid: self._image_path(study_uid)
+        for study_uid in self._study_uids
+    }
+
+    manifest.write(manifest_path, study_uid_to_image_path, num_shards=3)
+
+    self.assertTrue(manifest.exists(manifest_path))
+    self.assertEqual(manifest.read(manifest_path), study_uid_to_image_path)
+
+
+if __name__ == '__main__':
+  unittest.main()
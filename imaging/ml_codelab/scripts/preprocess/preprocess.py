@@ -32,17 +32,24 @@ the output of the feature extraction part of the model.
 
 import warnings
 import argparse
+import collections
 import csv
+import hashlib
+import json
 import logging
 import os
-import random
 import StringIO
 import sys
 import threading
+import time
+from concurrent import futures
 import apache_beam as beam
+from apache_beam.metrics import Metrics
 from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.transforms import window
 import httplib2
 import scripts.constants as constants
+import scripts.preprocess.manifest as manifest
 import scripts.tcia_utils as tcia_utils
 import numpy as np
 
@@ -55,6 +62,33 @@ from tensorflow.python.lib.io import file_io
 _BREAST_DENSITY_2_LABEL = '2'
 _BREAST_DENSITY_3_LABEL = '3'
 
+# Default number of images whose bottlenecks are calculated together.
+_DEFAULT_BOTTLENECK_BATCH_SIZE = 32
+
+# Default number of images read concurrently, and number of batches read ahead
+# of the batch whose bottlenecks are calculated.
+_DEFAULT_READ_PARALLELISM = 16
+_DEFAULT_PREFETCH_BATCHES = 1
+
+# Name of the file, in the output path, holding the statistics of the output.
+_STATS_FILE = 'stats.json'
+
+# Subdirectory of the output path holding the columnar bottlenecks, and the
+# one they are written to before the pipeline succeeds.
+_COLUMNAR_DIR = 'columnar'
+_COLUMNAR_TEMP_DIR = 'columnar.tmp'
+
+# Maximum number of rows of a shard of columnar bottlenecks.
+_COLUMNAR_SHARD_SIZE = 10000
+
+# Number of hex characters of a bottleneck cache key used as subdirectory name.
+_BOTTLENECK_CACHE_PREFIX_LENGTH = 2
+
+# Extension of the files of the bottleneck cache, which hold the raw float32
+# values of a bottleneck, and their size in bytes for Inception V3.
+_BOTTLENECK_CACHE_EXTENSION = '.f32'
+_BOTTLENECK_CACHE_FILE_SIZE = 2048 * np.dtype(np.float32).itemsize
+
 
 class PreprocessGraph(object):
   """ Creates a TF graph to preprocess an image and to calculate bottlenecks.
@@ -62,9 +96,9 @@ class PreprocessGraph(object):
   # Create the Tensorflow graph.
   preprocess_graph = PreprocessGraph(sess)
 
-  # Calculate bottlenecks for an input image.
-  bottleneck = preprocess_graph.calculate_bottleneck(input_image)
-  return bottleneck
+  # Calculate bottlenecks for a batch of input images.
+  bottlenecks = preprocess_graph.calculate_bottlenecks(input_images)
+  return bottlenecks
   """
 
   def __init__(self):
@@ -79,30 +113,35 @@ class PreprocessGraph(object):
     """Builds the processing graph.
 
     Returns:
-      (input_jpeg_str, bottleneck_tensor) tuple.
+      (input_jpeg_strs, bottleneck_tensor) tuple.
 
-      input_jpeg_str is a Tensor for input JPEG image.
-      bottleneck_tensor is a Tensor for output bottleneck Tensor.
+      input_jpeg_strs is a Tensor for a batch of input JPEG images.
+      bottleneck_tensor is a Tensor for the output bottleneck of each image.
     """
 
-    input_jpeg_str = tf.placeholder(tf.string)
+    input_jpeg_strs = tf.placeholder(tf.string, shape=[None])
     # Make ml_utils a local import. This means that ml_utils does not have
     # to be installed on machine that starts the workers, it only needs to be
     # installed on the workers themselves. This makes dependency management a
     # bit easier.
     # https://cloud.google.com/dataflow/faq
     import scripts.ml_utils as ml_utils
-    bottleneck_tensor = ml_utils.get_bottleneck_tensor(input_jpeg_str)
-    return input_jpeg_str, bottleneck_tensor
+    bottleneck_tensor = ml_utils.get_bottleneck_tensor_batch(input_jpeg_strs)
+    return input_jpeg_strs, bottleneck_tensor
+
+  def calculate_bottlenecks(self, images_bytes):
+    # type: List[str] -> np.ndarray
+    """Returns the bottlenecks for a batch of images, one row per image."""
+
+    return self._tf_session.run(
+        self._bottleneck_tensor,
+        feed_dict={self._input_jpeg_tensor: images_bytes})
 
   def calculate_bottleneck(self, image_bytes):
     # type: str -> np.ndarray
     """Returns the bottleneck for an image."""
 
-    bottleneck = self._tf_session.run(
-        self._bottleneck_tensor,
-        feed_dict={self._input_jpeg_tensor: image_bytes})
-    return np.squeeze(bottleneck)
+    return self.calculate_bottlenecks([image_bytes])[0]
 
 
 def _to_tfrecord(dataset, image_path, label, bottleneck):
@@ -136,6 +175,31 @@ def _to_tfrecord(dataset, image_path, label, bottleneck):
   return example
 
 
+def _bottleneck_cache_key(image_path):
+  # type: str -> str
+  """Returns the key of the bottleneck of an image in the bottleneck cache.
+
+  The key identifies the image content by its path, size and modification time,
+  which change whenever the image is overwritten, and the model by the URL of
+  its TF-Hub module. Stating the image is much cheaper than reading and hashing
+  it.
+
+  Args:
+    image_path: Path of input image in GCS.
+
+  Returns:
+    Hex SHA-256 digest of the image and model identifiers.
+  """
+  # Local import, see PreprocessGraph._build_graph.
+  import scripts.ml_utils as ml_utils
+  stat = file_io.stat(image_path)
+  return hashlib.sha256('\0'.join([
+      image_path,
+      str(stat.length),
+      str(stat.mtime_nsec), ml_utils.FEATURE_VECTORS_MODULE_URL
+  ])).hexdigest()
+
+
 class PreprocessImage(beam.DoFn):
   """Workflow step to preprocess input images.
 
@@ -143,8 +207,56 @@ class PreprocessImage(beam.DoFn):
   1) Reads input image from GCS
   2) Resize and encodes the image as required by Inception V3 model.
   3) Calculate Inception V3 bottleneck and stores it as a TFRecord.
+
+  The images are read by a pool of read_parallelism threads as soon as they
+  arrive, and their bottlenecks are calculated in batches of batch_size
+  images, since Inception V3 runs much faster on a batch than on one image at
+  a time. A batch is only calculated once prefetch_batches more batches of
+  images are being read, so that reading from GCS overlaps with TensorFlow
+  computation. The images left at the end of a bundle are calculated in
+  finish_bundle.
+
+  If a bottleneck cache path is given, the bottleneck of each image is looked
+  up there first, and only the images missing from it are read and
+  calculated. The calculated bottlenecks are added to the cache, so that
+  running the pipeline again, e.g. with other split percentages, only
+  calculates the bottlenecks of new or modified images.
+
+  The time spent waiting for reads and calculating bottlenecks are reported
+  as the io_wait_msecs and compute_msecs Beam counters.
+
+  Args:
+    batch_size: Number of images whose bottlenecks are calculated together.
+    read_parallelism: Number of images read concurrently.
+    prefetch_batches: Number of batches read ahead of the batch calculated.
+    bottleneck_cache_path: Directory of the bottleneck cache, or None to
+      calculate all bottlenecks.
   """
 
+  def __init__(self,
+               batch_size=_DEFAULT_BOTTLENECK_BATCH_SIZE,
+               read_parallelism=_DEFAULT_READ_PARALLELISM,
+               prefetch_batches=_DEFAULT_PREFETCH_BATCHES,
+               bottleneck_cache_path=None):
+    super(PreprocessImage, self).__init__()
+    self._batch_size = batch_size
+    self._read_parallelism = read_parallelism
+    self._prefetch_batches = prefetch_batches
+    self._bottleneck_cache_path = bottleneck_cache_path
+    self._read_executor = None
+    # (dataset, image_path, label, future of (cache_path, cached bottleneck,
+    # image bytes)) of the images read but not processed yet, in order of
+    # arrival.
+    self._pending = collections.deque()
+    self._io_wait_msecs = Metrics.counter(self.__class__, 'io_wait_msecs')
+    self._compute_msecs = Metrics.counter(self.__class__, 'compute_msecs')
+    self._read_msecs = Metrics.counter(self.__class__, 'read_msecs')
+    self._images_read = Metrics.counter(self.__class__, 'images_read')
+    self._cache_hits = Metrics.counter(self.__class__,
+                                       'bottleneck_cache_hits')
+    self._cache_misses = Metrics.counter(self.__class__,
+                                         'bottleneck_cache_misses')
+
   # Synchronization for Beam variables that can be called from multiple threads.
   # https://groups.google.com/a/google.com/forum/#!msg/dataflow-beam-portability/MQ4UqpDhwyg/Cal4yAniAgAJ
   _preprocess_graph_lock = threading.Lock()
@@ -160,44 +272,353 @@ class PreprocessImage(beam.DoFn):
     with self._preprocess_graph_lock:
       if self._preprocess_graph is None:
         self._preprocess_graph = PreprocessGraph()
+    self._read_executor = futures.ThreadPoolExecutor(
+        max_workers=self._read_parallelism)
+    self._pending = collections.deque()
+
+  def _read_image(self, image_path):
+    # type: str -> (Optional[str], Optional[np.ndarray], Optional[str])
+    """Reads the cached bottleneck, or the bytes, of an image.
+
+    Runs on the read thread pool.
+
+    Args:
+      image_path: Path of input image in GCS.
+
+    Returns:
+      (cache_path, bottleneck, image_data) tuple. cache_path is the path of the
+      bottleneck in the cache, or None if there is no cache. Either bottleneck
+      is the cached bottleneck, or image_data the bytes of the image if the
+      bottleneck is not cached or its cache file does not have the expected
+      size.
+    """
+    start_time = time.time()
+    cache_path = None
+    if self._bottleneck_cache_path:
+      key = _bottleneck_cache_key(image_path)
+      cache_path = os.path.join(self._bottleneck_cache_path,
+                                key[:_BOTTLENECK_CACHE_PREFIX_LENGTH],
+                                key + _BOTTLENECK_CACHE_EXTENSION)
+      if file_io.file_exists(cache_path):
+        data = file_io.FileIO(cache_path, 'rb').read()
+        if len(data) == _BOTTLENECK_CACHE_FILE_SIZE:
+          self._read_msecs.inc(int((time.time() - start_time) * 1000))
+          self._cache_hits.inc()
+          return cache_path, np.frombuffer(data, dtype=np.float32), None
+        # Calculated again, and overwritten in the cache.
+        logging.warning('Ignoring cached bottleneck %s of %d bytes', cache_path,
+                        len(data))
+      self._cache_misses.inc()
+    image_data = file_io.FileIO(image_path, 'rb').read()
+    self._read_msecs.inc(int((time.time() - start_time) * 1000))
+    self._images_read.inc()
+    return cache_path, None, image_data
+
+  def _write_cached_bottleneck(self, cache_path, bottleneck):
+    # type: (str, np.ndarray) -> None
+    """Adds a bottleneck to the cache. Runs on the read thread pool.
+
+    The bottleneck is written to a temporary file first, so that a bottleneck
+    is never read back partially written.
+    """
+    try:
+      file_io.recursive_create_dir(os.path.dirname(cache_path))
+      tmp_path = '%s.tmp-%s' % (cache_path, os.urandom(8).encode('hex'))
+      file_io.write_string_to_file(
+          tmp_path,
+          np.asarray(bottleneck, dtype=np.float32).tostring())
+      file_io.rename(tmp_path, cache_path, overwrite=True)
+    except tf.errors.OpError as e:
+      logging.warning('Could not cache bottleneck %s: %s', cache_path, e)
 
   def process(self, element):
     # type: beam.PCollection -> Iterable[tensorflow.TFRecord]
-    """Calculates the bottleneck for an image.
+    """Starts reading an image, and calculates the bottlenecks of a batch.
 
     Args:
       element: A beam.PCollection holding the (dataset, image_path, label).
 
     Yields:
-      TFRecord holding (image_path, label, bottleneck).
+      TFRecord holding (image_path, label, bottleneck), for each image of the
+      oldest batch once enough images are being read.
+    """
+    (dataset, image_path, label) = element
+    self._pending.append((dataset, image_path, label,
+                          self._read_executor.submit(self._read_image,
+                                                     image_path)))
+    if len(self._pending) >= self._batch_size * (1 + self._prefetch_batches):
+      for tfrecord in self._process_batch():
+        yield tfrecord
+
+  def finish_bundle(self):
+    # type: None -> Iterable[WindowedValue]
+    """Calculates the bottlenecks of the images left.
+
+    Yields:
+      TFRecord holding (image_path, label, bottleneck), for each image left,
+      in the global window like the input images.
+    """
+    while self._pending:
+      for tfrecord in self._process_batch():
+        yield window.GlobalWindows.windowed_value(tfrecord)
+    self._read_executor.shutdown()
+
+  def _process_batch(self):
+    # type: None -> List[tensorflow.TFRecord]
+    """Calculates the bottlenecks of the oldest batch of pending images.
+
+    Returns:
+      TFRecord holding (image_path, label, bottleneck) for each image.
 
     Raises:
       RuntimeError: If _preprocess_graph is not initialized.
     """
-    (dataset, image_path, label) = element
-    image_data = file_io.FileIO(image_path, 'rb').read()
+    batch = [
+        self._pending.popleft()
+        for _ in range(min(self._batch_size, len(self._pending)))
+    ]
     if self._preprocess_graph is None:
       raise RuntimeError('self._preprocess_graph not initialized')
-    bottleneck = self._preprocess_graph.calculate_bottleneck(image_data)
-    yield _to_tfrecord(dataset, image_path, label, bottleneck)
+    start_time = time.time()
+    reads = [image_future.result() for _, _, _, image_future in batch]
+    compute_start_time = time.time()
+    self._io_wait_msecs.inc(int((compute_start_time - start_time) * 1000))
+    bottlenecks = [bottleneck for _, bottleneck, _ in reads]
+    missing = [
+        i for i, bottleneck in enumerate(bottlenecks) if bottleneck is None
+    ]
+    if missing:
+      calculated = self._preprocess_graph.calculate_bottlenecks(
+          [reads[i][2] for i in missing])
+      self._compute_msecs.inc(int((time.time() - compute_start_time) * 1000))
+      for i, bottleneck in zip(missing, calculated):
+        bottlenecks[i] = bottleneck
+        cache_path = reads[i][0]
+        if cache_path:
+          # Waited for when the executor is shut down in finish_bundle.
+          self._read_executor.submit(self._write_cached_bottleneck, cache_path,
+                                     bottleneck)
+    return [
+        _to_tfrecord(dataset, image_path, label, bottleneck)
+        for (dataset, image_path, label, _), bottleneck in zip(
+            batch, bottlenecks)
+    ]
+
+
+def _read_study_uids_and_image_paths(p, input_path, manifest_path=None):
+  # type: (apache_beam.Pipeline, str, Optional[str]) -> beam.PCollection
+  """Reads the study_uid and path of each input image.
 
+  Args:
+    p: Pipeline the images are read in.
+    input_path: Input path of images.
+    manifest_path: Directory of a manifest of the input images, written by
+      scripts.preprocess.manifest. If None or if there is no manifest, the
+      images are listed by the launcher, see manifest.list_images.
 
-def _get_study_uid_to_image_path_map(input_path):
-  # type: str -> Dict[str, str]
-  """Helper to run a map of study_uid to image path.
+  Returns:
+    PCollection of (study_uid, image_path).
+  """
+  if manifest_path and manifest.exists(manifest_path):
+    return (p
+            # The paths are written to TFRecords as bytes, not unicode.
+            | 'Read Manifest' >> beam.io.ReadFromText(
+                manifest.file_pattern(manifest_path),
+                coder=beam.coders.BytesCoder())
+            | 'Parse Manifest' >> beam.Map(manifest.parse_line))
+  logging.warning('No manifest found, listing the images of %s', input_path)
+  return p | 'List Images' >> beam.Create(
+      manifest.list_images(input_path).items())
+
+
+def _assign_dataset(study_uid, validation_percentage, testing_percentage):
+  # type: (str, int, int) -> str
+  """Returns the dataset of a study, as a function of its study_uid only.
+
+  A study stays in the same dataset across runs, and when other studies are
+  added, as long as the percentages are the same.
 
   Args:
-    input_path: Input path of images.
+    study_uid: Study UID of the image.
+    validation_percentage: Percentage of studies in the validation dataset.
+    testing_percentage: Percentage of studies in the testing dataset.
 
   Returns:
-    study_uid_to_file_paths: Dictionary mapping study_uid to image path.
+    Training, validation or testing dataset.
   """
-  path_list = file_io.get_matching_files(os.path.join(input_path, '*/*/*'))
-  study_uid_to_file_paths = {}
-  for path in path_list:
-    split_path = path.split('/')
-    study_uid_to_file_paths[split_path[3]] = path
-  return study_uid_to_file_paths
+  # Percentage in [0, 100), with a 0.01 resolution.
+  percentage = int(hashlib.sha1(study_uid).hexdigest(), 16) % 10000 / 100.0
+  if percentage < testing_percentage:
+    return constants.TESTING_DATASET
+  if percentage < testing_percentage + validation_percentage:
+    return constants.VALIDATION_DATASET
+  return constants.TRAINING_DATASET
+
+
+def _label_and_split(element, study_uid_to_label, validation_percentage,
+                     testing_percentage):
+  # type: ((str, str), Dict[str, str], int, int) -> Iterable[(str, str, str)]
+  """Labels an image and assigns it to a dataset.
+
+  Args:
+    element: (study_uid, image_path) of the image.
+    study_uid_to_label: Dictionary mapping study_uid to label.
+    validation_percentage: Percentage of studies in the validation dataset.
+    testing_percentage: Percentage of studies in the testing dataset.
+
+  Yields:
+    (dataset, image_path, label), if the study of the image has a label.
+  """
+  study_uid, image_path = element
+  label = study_uid_to_label.get(study_uid)
+  if label is None:
+    Metrics.counter('preprocess', 'unlabeled_images').inc()
+    return
+  dataset = _assign_dataset(study_uid, validation_percentage,
+                            testing_percentage)
+  Metrics.counter('preprocess', dataset + '_images').inc()
+  yield dataset, image_path, label
+
+
+class WriteColumnarShards(beam.DoFn):
+  """Workflow step to write the bottlenecks in columnar format.
+
+  The bottlenecks of each dataset are written as shards of at most shard_size
+  rows, so that no worker holds more than a shard of each dataset in memory.
+  A shard is a matrix written to <temp_dir>/<dataset>-<id>.npy, which can be
+  loaded, or memory-mapped, with numpy.load, and the image path and label of
+  each row are written to the tab-separated <dataset>-<id>.tsv, in the same
+  order.
+
+  The shards are written to a temporary directory, and the name of each shard
+  is output once it is written. Only the shards output by successful bundles
+  are moved to the columnar directory by _commit_columnar_shards, so that a
+  retried bundle does not leave duplicate rows behind.
+
+  Args:
+    temp_dir: Directory the shards are written to.
+    dtype: Numpy type of the matrices, e.g. 'float32' or 'float16'.
+    shard_size: Maximum number of rows of a shard.
+  """
+
+  def __init__(self, temp_dir, dtype, shard_size=_COLUMNAR_SHARD_SIZE):
+    super(WriteColumnarShards, self).__init__()
+    self._temp_dir = temp_dir
+    self._dtype = dtype
+    self._shard_size = shard_size
+    # Dataset to the (image_path, label, bottleneck) rows not written yet.
+    self._rows = collections.defaultdict(list)
+
+  def start_bundle(self):
+    # type: None -> None
+    self._rows = collections.defaultdict(list)
+
+  def process(self, element):
+    # type: tensorflow.train.Example -> Iterable[str]
+    """Adds the bottleneck of an image to the shard of its dataset.
+
+    Args:
+      element: TFRecord holding (dataset, image_path, label, bottleneck).
+
+    Yields:
+      Name of the shard of the dataset, once it is full and written.
+    """
+    feature = element.features.feature
+    dataset = feature['dataset'].bytes_list.value[0]
+    rows = self._rows[dataset]
+    rows.append((feature['image_path'].bytes_list.value[0],
+                 feature['label'].bytes_list.value[0],
+                 feature['bottleneck'].float_list.value))
+    if len(rows) >= self._shard_size:
+      yield self._write_shard(dataset)
+
+  def finish_bundle(self):
+    # type: None -> Iterable[WindowedValue]
+    """Writes the shards left.
+
+    Yields:
+      Name of each shard left, in the global window like the input TFRecords.
+    """
+    for dataset in sorted(self._rows):
+      if self._rows[dataset]:
+        yield window.GlobalWindows.windowed_value(self._write_shard(dataset))
+
+  def _write_shard(self, dataset):
+    # type: str -> str
+    """Writes the rows of a dataset to a new shard, and returns its name."""
+    rows = self._rows.pop(dataset)
+    name = '%s-%s' % (dataset, os.urandom(8).encode('hex'))
+    output_prefix = os.path.join(self._temp_dir, name)
+    file_io.recursive_create_dir(self._temp_dir)
+    with file_io.FileIO(output_prefix + '.npy', 'wb') as f:
+      np.save(f, np.array([bottleneck for _, _, bottleneck in rows],
+                          dtype=self._dtype))
+    file_io.write_string_to_file(
+        output_prefix + '.tsv',
+        ''.join('%s\t%s\n' % (image_path, label)
+                for image_path, label, _ in rows))
+    return name
+
+
+def _commit_columnar_shards(shard_names, temp_dir, columnar_dir):
+  # type: (List[str], str, str) -> None
+  """Moves the shards written by successful bundles to the columnar directory.
+
+  Args:
+    shard_names: Names of the shards output by WriteColumnarShards.
+    temp_dir: Directory the shards were written to. It is deleted, along with
+      the shards of failed bundles.
+    columnar_dir: Directory the shards are moved to.
+  """
+  file_io.recursive_create_dir(columnar_dir)
+  for name in shard_names:
+    for extension in ('.npy', '.tsv'):
+      file_io.rename(
+          os.path.join(temp_dir, name + extension),
+          os.path.join(columnar_dir, name + extension),
+          overwrite=True)
+  if file_io.file_exists(temp_dir):
+    file_io.delete_recursively(temp_dir)
+
+
+def _stats_key(example):
+  # type: tensorflow.train.Example -> (str, str, int)
+  """Returns the (dataset, label, bottleneck size) of a TFRecord."""
+  feature = example.features.feature
+  return (feature['dataset'].bytes_list.value[0],
+          feature['label'].bytes_list.value[0],
+          len(feature['bottleneck'].float_list.value))
+
+
+def _write_stats(key_counts, output_path, columnar):
+  # type: (List[((str, str, int), int)], str, bool) -> None
+  """Writes the statistics of the output, so the trainer does not scan it.
+
+  The statistics are written to <output_path>/stats.json, as a JSON object
+  with the number of images per dataset and label in "counts", the sorted
+  labels in "labels", the size of the bottlenecks in "bottleneck_size", and
+  whether this run wrote columnar bottlenecks in "columnar".
+
+  Args:
+    key_counts: Number of images of each (dataset, label, bottleneck size).
+    output_path: Output directory of the TFRecords.
+    columnar: Whether the bottlenecks are also written in columnar format.
+  """
+  counts = collections.defaultdict(dict)
+  bottleneck_sizes = set()
+  for (dataset, label, bottleneck_size), count in key_counts:
+    counts[dataset][label] = counts[dataset].get(label, 0) + count
+    bottleneck_sizes.add(bottleneck_size)
+  if len(bottleneck_sizes) > 1:
+    raise ValueError('Bottlenecks have different sizes: %s' % bottleneck_sizes)
+  file_io.write_string_to_file(
+      os.path.join(output_path, _STATS_FILE),
+      json.dumps({
+          'counts': counts,
+          'labels': sorted({label for c in counts.values() for label in c}),
+          'bottleneck_size': bottleneck_sizes.pop() if bottleneck_sizes else 0,
+          'columnar': columnar
+      }, indent=2, sort_keys=True))
 
 
 def _partition_fn(element, unused_num_partitions):
@@ -215,44 +636,60 @@ def configure_pipeline(p, opt):
   # Create a map of study_uid to label.
   study_uid_to_label = tcia_utils.GetStudyUIDToLabelMap()
 
-  # Create a map of study_uid -> path of images in GCS
-  study_uid_to_image_path = _get_study_uid_to_image_path_map(opt.input_path)
-
-  # Create a map of study_uid -> (GCS path, label)
-  # Split dataset into training, validation and test.
-  paths_and_labels = []
-  dataset_size = len(study_uid_to_label)
-  training_size = dataset_size * (
-      100 - opt.testing_percentage - opt.validation_percentage) / 100
-  validation_size = dataset_size * opt.validation_percentage / 100
-  testing_size = dataset_size * opt.testing_percentage / 100
-  logging.info('Number of images in training dataset: %s', training_size)
-  logging.info('Number of images in validation dataset: %s', validation_size)
-  logging.info('Number of images in testing dataset: %s', testing_size)
-
-  count = 0
-  for k, v in study_uid_to_label.iteritems():
-    if k not in study_uid_to_image_path:
-      logging.warning('Could not find image with study_uid %s in GCS', k)
-      continue
-    if count < training_size:
-      dataset = constants.TRAINING_DATASET
-    elif count >= training_size and count < (training_size + validation_size):
-      dataset = constants.VALIDATION_DATASET
-    else:
-      dataset = constants.TESTING_DATASET
-    count += 1
-    paths_and_labels.append((dataset, study_uid_to_image_path[k], v))
-
-  # Shuffle the input
-  random.shuffle(paths_and_labels)
+  # Label each image in GCS, and split the labeled images into training,
+  # validation and test datasets.
+  logging.info('Percentage of images in training dataset: %s',
+               100 - opt.testing_percentage - opt.validation_percentage)
+  logging.info('Percentage of images in validation dataset: %s',
+               opt.validation_percentage)
+  logging.info('Percentage of images in testing dataset: %s',
+               opt.testing_percentage)
+  labels = beam.pvalue.AsDict(
+      p | 'Download Labels' >> beam.Create(study_uid_to_label.items()))
+  paths_and_labels = (
+      _read_study_uids_and_image_paths(p, opt.input_path, opt.manifest_path)
+      | 'Label and Split' >> beam.FlatMap(
+          _label_and_split, labels, opt.validation_percentage,
+          opt.testing_percentage)
+      # Prevents fusion with reading the image paths, so that the images are
+      # spread over all workers.
+      | 'Redistribute Images' >> beam.Reshuffle())
+
+  tfrecords = (
+      paths_and_labels
+      | 'Preprocess Image' >> beam.ParDo(
+          PreprocessImage(opt.bottleneck_batch_size, opt.read_parallelism,
+                          opt.prefetch_batches, opt.bottleneck_cache_path)))
   parts = (
-      p
-      | 'Download Labels' >> beam.Create(paths_and_labels)
-      | 'Preprocess Image' >> beam.ParDo(PreprocessImage())
+      tfrecords
       | 'Split into Training-Validation-Testing' >> beam.Partition(
           _partition_fn, 3))
 
+  # Count the images per dataset and label, for the trainer.
+  _ = (
+      tfrecords
+      | 'Get Stats Keys' >> beam.Map(_stats_key)
+      | 'Count Stats Keys' >> beam.combiners.Count.PerElement()
+      | 'Collect Stats' >> beam.combiners.ToList()
+      | 'Save Stats' >> beam.Map(_write_stats, opt.output_path,
+                                 bool(opt.columnar_dtype)))
+
+  # Columnar bottlenecks of a previous run must not be mixed with the ones of
+  # this run, or used by the trainer if this run does not write any.
+  columnar_dir = os.path.join(opt.output_path, _COLUMNAR_DIR)
+  columnar_temp_dir = os.path.join(opt.output_path, _COLUMNAR_TEMP_DIR)
+  for path in (columnar_dir, columnar_temp_dir):
+    if file_io.file_exists(path):
+      file_io.delete_recursively(path)
+  if opt.columnar_dtype:
+    _ = (
+        tfrecords
+        | 'Save Columnar Shards' >> beam.ParDo(
+            WriteColumnarShards(columnar_temp_dir, opt.columnar_dtype))
+        | 'Collect Columnar Shards' >> beam.combiners.ToList()
+        | 'Commit Columnar Shards' >> beam.Map(
+            _commit_columnar_shards, columnar_temp_dir, columnar_dir))
+
   # Branch into workflows that serialize training/validation/testing TFRecords.
   for idx, path_suffix in enumerate([
       constants.TRAINING_DATASET, constants.VALIDATION_DATASET,
@@ -296,6 +733,12 @@ def default_args(argv):
       help=
       'Path to input directory of images. The images are expected to be in a GCS bucket with format gs://<bucket_name>/<study_uid>/<series_uid>/<instance_uid>.jpg'
   )
+  parser.add_argument(
+      '--manifest_path',
+      default=None,
+      help='Directory of a manifest of the input images, written by '
+      'scripts.preprocess.manifest. Reading it is much faster than listing the '
+      'input images when there are many of them.')
   parser.add_argument(
       '--output_path',
       required=True,
@@ -323,6 +766,42 @@ def default_args(argv):
       default=10,
       help='What percentage of images to use as a validation set.')
 
+  parser.add_argument(
+      '--bottleneck_batch_size',
+      type=int,
+      default=_DEFAULT_BOTTLENECK_BATCH_SIZE,
+      help='Number of images whose bottlenecks are calculated together. '
+      'Inception V3 runs much faster on batches than on single images.')
+
+  parser.add_argument(
+      '--read_parallelism',
+      type=int,
+      default=_DEFAULT_READ_PARALLELISM,
+      help='Number of images each worker thread reads from GCS concurrently.')
+  parser.add_argument(
+      '--prefetch_batches',
+      type=int,
+      default=_DEFAULT_PREFETCH_BATCHES,
+      help='Number of batches of images read ahead of the batch whose '
+      'bottlenecks are calculated, so that reads overlap with computation.')
+
+  parser.add_argument(
+      '--bottleneck_cache_path',
+      default=None,
+      help='Directory where calculated bottlenecks are cached, e.g. '
+      'gs://<bucket_name>/bottlenecks. When set, only the bottlenecks of images '
+      'that are new or modified since a previous run, or calculated by another '
+      'version of the model, are calculated.')
+
+  parser.add_argument(
+      '--columnar_dtype',
+      default=None,
+      choices=['float32', 'float16'],
+      help='If set, the bottlenecks of each dataset are also written to '
+      '<output_path>/columnar/<dataset>-*.npy shards as matrices of this type, '
+      'with the image path and label of each row in the matching .tsv file. '
+      'The trainer loads them much faster than TFRecords.')
+
   parser.add_argument('--cloud', default=True, action='store_true')
   parser.add_argument(
       '--runner',
@@ -0,0 +1,77 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for scripts.preprocess.preprocess.
+
+Run from the ml_codelab directory with:
+python -m unittest scripts.preprocess.preprocess_test
+"""
+
+import collections
+import unittest
+
+import scripts.constants as constants
+import scripts.preprocess.preprocess as preprocess
+
+_STUDY_UID_ROOT = '1.3.6.1.4.1.9590.100.1.2.'
+
+# Number of synthetic study UIDs whose split is checked.
+_NUM_STUDIES = 20000
+
+
+class AssignDatasetTest(unittest.TestCase):
+
+  def setUp(self):
+    self._study_uids = [_STUDY_UID_ROOT + str(i) for i in range(_NUM_STUDIES)]
+
+  def _assign_datasets(self, validation_percentage, testing_percentage):
+    return {
+        study_uid: preprocess._assign_dataset(
+            study_uid, validation_percentage, testing_percentage)
+        for study_uid in self._study_uids
+    }
+
+  def test_study_always_in_same_dataset(self):
+    datasets = self._assign_datasets(10, 20)
+
+    for study_uid in reversed(self._study_uids):
+      self.assertEqual(
+          preprocess._assign_dataset(study_uid, 10, 20), datasets[study_uid])
+
+  def test_fractions_approach_percentages(self):
+    datasets = self._assign_datasets(10, 20)
+
+    counts = collections.Counter(datasets.values())
+    for dataset, fraction in ((constants.TRAINING_DATASET, 0.7),
+                              (constants.VALIDATION_DATASET, 0.1),
+                              (constants.TESTING_DATASET, 0.2)):
+      self.assertAlmostEqual(
+          counts[dataset] / float(_NUM_STUDIES), fraction, delta=0.01)
+
+  def test_all_training_without_percentages(self):
+    datasets = self._assign_datasets(0, 0)
+
+    self.assertEqual(set(datasets.values()), {constants.TRAINING_DATASET})
+
+  def test_testing_dataset_does_not_depend_on_validation_percentage(self):
+    datasets = self._assign_datasets(10, 20)
+    other_datasets = self._assign_datasets(30, 20)
+
+    for study_uid in self._study_uids:
+      self.assertEqual(
+          datasets[study_uid] == constants.TESTING_DATASET,
+          other_datasets[study_uid] == constants.TESTING_DATASET)
+
+
+if __name__ == '__main__':
+  unittest.main()
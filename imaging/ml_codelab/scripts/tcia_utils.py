@@ -14,7 +14,14 @@
 """Utility functions for dealing with TCIA data."""
 
 import csv
+import hashlib
+import json
+import logging
+from multiprocessing import pool as multiprocessing_pool
+import os
 import StringIO
+import tempfile
+import threading
 import httplib2
 
 # Labels files that contain breast density labels and UIDs.
@@ -27,6 +34,15 @@ _LABEL_PATHS = [
 _BREAST_DENSITY_COLUMN = {"breast_density", "breast density"}
 _IMAGE_FILE_PATH_COLUMN = {"image file path"}
 
+# Directory where the rows parsed from each label file are cached, together
+# with the ETag and Last-Modified headers used to revalidate them.
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "tcia_utils")
+
+# Label files already loaded by this process, by URL. Guarded by _loaded_lock.
+_loaded_rows = {}
+_loaded_lock = threading.Lock()
+
 # Blacklist a set of study UIDs for training. These have duplicate images that
 # cause warnings in AutoML.
 _BLACKLISTED_STUDY_UIDS = {
@@ -43,11 +59,107 @@ _BLACKLISTED_STUDY_UIDS = {
 }
 
 
-def _GetStudyUIDMaps(has_study_uid=None):
+def _ParseLabelFile(path, content):
+  """Returns the breast density 2 and 3 rows of a label file.
+
+  Args:
+   path: URL of the label file, used in error messages.
+   content: CSV content of the label file.
+
+  Returns:
+   A List of [Study UID, Series UID, label] rows.
+  """
+  r = csv.reader(StringIO.StringIO(content), delimiter=",")
+  header = r.next()
+  breast_density_column = -1
+  image_file_path_column = -1
+  for idx, h in enumerate(header):
+    if h in _BREAST_DENSITY_COLUMN:
+      breast_density_column = idx
+    if h in _IMAGE_FILE_PATH_COLUMN:
+      image_file_path_column = idx
+  assert breast_density_column != -1, (
+      "breast_density column not found in " + path)
+  assert image_file_path_column != -1, (
+      "image file path column not found in " + path)
+  rows = []
+  for row in r:
+    density = row[breast_density_column]
+    if density != "2" and density != "3":
+      continue
+    dicom_uids = row[image_file_path_column].split("/")
+    rows.append([dicom_uids[1], dicom_uids[2], density])
+  return rows
+
+
+def _LoadLabelFile(path, cache_dir):
+  """Downloads and parses a label file, revalidating its cached rows.
+
+  If the label file was cached by a previous download, it is requested with
+  If-None-Match and If-Modified-Since headers, and the cached rows are used if
+  the server replies that the label file was not modified.
+
+  Args:
+   path: URL of the label file.
+   cache_dir: Directory of the cache, or None to always download.
+
+  Returns:
+   A List of [Study UID, Series UID, label] rows.
+  """
+  cache_path = None
+  cached = None
+  headers = {}
+  if cache_dir:
+    cache_path = os.path.join(cache_dir,
+                              hashlib.sha1(path).hexdigest() + ".json")
+    try:
+      with open(cache_path) as f:
+        cached = json.load(f)
+    except (IOError, ValueError):
+      cached = None
+    if cached:
+      if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+      if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+  # httplib2.Http is not thread-safe, so each label file uses its own.
+  http = httplib2.Http(timeout=60, disable_ssl_certificate_validation=True)
+  resp, content = http.request(path, method="GET", headers=headers)
+  if resp.status == 304 and cached:
+    # JSON decodes the UIDs and labels as unicode, but they are used as str.
+    return [[str(value) for value in row] for row in cached["rows"]]
+  assert resp.status == 200, "Failed to download label files from: " + path
+  rows = _ParseLabelFile(path, content)
+  if cache_path and (resp.get("etag") or resp.get("last-modified")):
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      # Write to a temporary file first, so that a concurrent reader never
+      # sees a partially written cache file.
+      fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+      with os.fdopen(fd, "w") as f:
+        json.dump({
+            "etag": resp.get("etag"),
+            "last_modified": resp.get("last-modified"),
+            "rows": rows
+        }, f)
+      os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+      logging.warning("Failed to cache label file %s: %s", path, e)
+  return rows
+
+
+def GetStudyUIDMaps(has_study_uid=None, cache_dir=_DEFAULT_CACHE_DIR):
   """Returns a map of Study UID to Series UID and Study UID to label.
 
+  The label files are downloaded concurrently, once per process. They are
+  cached in cache_dir, and only downloaded again if they changed since.
+
   Args:
    has_study_uid: If set, it only returns instances that match this Study UID.
+   cache_dir: Directory where the label files are cached, or None to download
+     them every time.
 
   Returns:
    A Dict of Study UID -> Series UID.
@@ -55,29 +167,22 @@ def _GetStudyUIDMaps(has_study_uid=None):
   """
 
   # Download UIDs for breast density 2 and 3.
-  http = httplib2.Http(timeout=60, disable_ssl_certificate_validation=True)
+  with _loaded_lock:
+    missing_paths = [path for path in _LABEL_PATHS if path not in _loaded_rows]
+    if missing_paths:
+      threads = multiprocessing_pool.ThreadPool(len(missing_paths))
+      try:
+        loaded = threads.map(lambda path: _LoadLabelFile(path, cache_dir),
+                             missing_paths)
+      finally:
+        threads.close()
+      _loaded_rows.update(zip(missing_paths, loaded))
+    rows_per_path = [_loaded_rows[path] for path in _LABEL_PATHS]
+
   study_uid_to_series_uid = {}
   study_uid_to_label = {}
-  for path in _LABEL_PATHS:
-    resp, content = http.request(path, method="GET")
-    assert resp.status == 200, "Failed to download label files from: " + path
-    r = csv.reader(StringIO.StringIO(content), delimiter=",")
-    header = r.next()
-    breast_density_column = -1
-    image_file_path_column = -1
-    for idx, h in enumerate(header):
-      if h in _BREAST_DENSITY_COLUMN:
-        breast_density_column = idx
-      if h in _IMAGE_FILE_PATH_COLUMN:
-        image_file_path_column = idx
-    assert breast_density_column != -1, "breast_density column not found"
-    assert image_file_path_column != -1, "image file path column not found"
-    for row in r:
-      density = row[breast_density_column]
-      if density != "2" and density != "3":
-        continue
-      dicom_uids = row[image_file_path_column].split("/")
-      study_instance_uid, series_instance_uid = dicom_uids[1], dicom_uids[2]
+  for rows in rows_per_path:
+    for study_instance_uid, series_instance_uid, density in rows:
       if study_instance_uid in _BLACKLISTED_STUDY_UIDS:
         continue
       if has_study_uid and has_study_uid != study_instance_uid:
@@ -96,7 +201,7 @@ def GetStudyUIDToSeriesUIDMap(has_study_uid=None):
   Returns:
    A Dict of Study UID -> Series UID.
   """
-  return _GetStudyUIDMaps(has_study_uid)[0]
+  return GetStudyUIDMaps(has_study_uid)[0]
 
 
 def GetStudyUIDToLabelMap(has_study_uid=None):
@@ -108,4 +213,4 @@ def GetStudyUIDToLabelMap(has_study_uid=None):
   Returns:
    A Dict of Study UID -> label.
   """
-  return _GetStudyUIDMaps(has_study_uid)[1]
+  return GetStudyUIDMaps(has_study_uid)[1]
@@ -21,7 +21,9 @@ This script roughly does the following:
 1) Reads bottleneck values (in TFRecord format).
 
    This will read all the bottlenecks found in --bottleneck_dir. The bottlenecks
-   consist of a list of (image_path, label, bottleneck) tuples.
+   consist of a list of (image_path, label, bottleneck) tuples. If preprocess.py
+   also wrote the bottlenecks in columnar format (with --columnar_dtype), they
+   are loaded from the columnar files instead, which requires no parsing.
 
 2) Split dataset into training-validation-test.
 
@@ -65,11 +67,14 @@ from __future__ import print_function
 
 import argparse
 from collections import defaultdict
-from collections import OrderedDict
 from datetime import datetime
+import io
+import json
 import logging
+from multiprocessing import pool as multiprocessing_pool
 import os
 import sys
+import numpy as np
 import scripts.constants as constants
 import scripts.ml_utils as ml_utils
 import tensorflow as tf
@@ -87,6 +92,117 @@ INCEPTION_V3_BOTTLENECK_SIZE = 2048
 # dense layer.
 _CHECKPOINT_FILE = '/tmp/model.ckpt'
 
+# Statistics of the bottlenecks written by preprocess.py.
+_STATS_FILE = 'stats.json'
+
+# Maximum number of threads scanning bottleneck files when there are no
+# statistics. Threads rather than processes, since forking after TensorFlow and
+# file_io started their threads is unsafe, and file_io releases the GIL while
+# reading.
+_SCAN_PARALLELISM = 16
+
+# Subdirectory of the bottleneck directory holding the columnar bottlenecks.
+_COLUMNAR_DIR = 'columnar'
+
+
+def _read_stats(bottleneck_dir):
+  # type: str -> Optional[Dict]
+  """Returns the statistics written by preprocess.py, or None if there are none."""
+  stats_path = os.path.join(bottleneck_dir, _STATS_FILE)
+  if not file_io.file_exists(stats_path):
+    return None
+  return json.loads(file_io.read_file_to_string(stats_path))
+
+
+def _has_columnar_bottlenecks(bottleneck_dir):
+  # type: str -> bool
+  """Returns whether the last preprocess.py run wrote columnar bottlenecks.
+
+  A columnar directory is only used when the statistics of the run that wrote
+  the TFRecords record it, so that columnar bottlenecks left over by another
+  run are never mixed with the TFRecords.
+  """
+  stats = _read_stats(bottleneck_dir)
+  return bool(stats and stats.get('columnar'))
+
+
+def _get_columnar_shards(bottleneck_dir, dataset):
+  # type: (str, str) -> List[str]
+  """Returns the paths of the columnar shards of a dataset, without extension."""
+  return [
+      path[:-len('.npy')] for path in sorted(
+          file_io.get_matching_files(
+              os.path.join(bottleneck_dir, _COLUMNAR_DIR, dataset + '-*.npy')))
+  ]
+
+
+def _read_columnar_image_labels(shard_prefix):
+  # type: str -> (List[str], List[str])
+  """Reads the image path and label of each row of a columnar shard.
+
+  Args:
+    shard_prefix: Path of the shard, without extension.
+
+  Returns:
+    (image_paths, labels) tuple, in the order of the rows of the matrix.
+  """
+  image_paths = []
+  labels = []
+  path = shard_prefix + '.tsv'
+  for line in file_io.read_file_to_string(path).splitlines():
+    image_path, label = line.split('\t')
+    image_paths.append(image_path)
+    labels.append(label)
+  return image_paths, labels
+
+
+def _load_columnar_bottlenecks(shard_prefix):
+  # type: str -> np.ndarray
+  """Loads the matrix of bottlenecks of a columnar shard, one row per image.
+
+  Local shards are memory-mapped rather than read, and shards on GCS are read
+  into memory one at a time.
+  """
+  path = shard_prefix + '.npy'
+  if '://' in path:
+    bottlenecks = np.load(io.BytesIO(file_io.FileIO(path, 'rb').read()))
+  else:
+    bottlenecks = np.load(path, mmap_mode='r')
+  # Bottlenecks may be stored as float16, and an empty matrix has no columns.
+  return bottlenecks.astype(np.float32, copy=False).reshape(
+      -1, INCEPTION_V3_BOTTLENECK_SIZE)
+
+
+def _read_columnar_shards(shard_prefixes):
+  # type: List[str] -> Iterable[(List[str], List[str], np.ndarray)]
+  """Yields the (image paths, labels, bottlenecks) of each columnar shard."""
+  for shard_prefix in shard_prefixes:
+    image_paths, labels = _read_columnar_image_labels(shard_prefix)
+    yield image_paths, labels, _load_columnar_bottlenecks(shard_prefix)
+
+
+def _scan_bottleneck_file(bottleneck_file):
+  # type: str -> (Dict[str, int], List[str])
+  """Counts the images per dataset and collects the labels of a TFRecord file.
+
+  Args:
+    bottleneck_file: Path of the bottleneck TFRecord file.
+
+  Returns:
+    dataset_to_image_count: Number of images per dataset in the file.
+    label_list: List of labels found in the file.
+  """
+  labels = set()
+  dataset_to_image_count = defaultdict(int)
+  for it in tf.compat.v1.io.tf_record_iterator(bottleneck_file):
+    example = tf.train.Example()
+    example.ParseFromString(it)
+    label = example.features.feature['label'].bytes_list.value[0]
+    labels.add(label)
+    dataset = example.features.feature['dataset'].bytes_list.value[0]
+    dataset_to_image_count[dataset] += 1
+  return dataset_to_image_count, list(labels)
+
 
 def _get_image_label_info(bottleneck_dir):
   # type: str -> (int, List[str])
@@ -97,27 +213,43 @@ def _get_image_label_info(bottleneck_dir):
 
   Returns:
     image_count: Total number of images in dataset.
-    label_list: List of labels found in dataset.
-  This function will parse the TFRecords found in bottleneck dir and will
-  only return the labels.
+    label_list: Sorted list of labels found in dataset.
+  This function will read the statistics written by preprocess.py in
+  bottleneck dir. If there are none, it will parse the TFRecords found in
+  bottleneck dir in parallel threads, and will only return the labels.
+  The labels are sorted, so that label indices do not depend on the order
+  in which images were written or scanned.
   """
-  labels = OrderedDict()
+  labels = set()
   dataset_to_image_count = defaultdict(int)
+  stats = _read_stats(bottleneck_dir)
+  if stats:
+    assert stats['bottleneck_size'] in (0, INCEPTION_V3_BOTTLENECK_SIZE), (
+        'unexpected bottleneck size %s' % stats['bottleneck_size'])
+    for dataset, label_to_image_count in stats['counts'].iteritems():
+      dataset_to_image_count[str(dataset)] = sum(label_to_image_count.values())
+    return dataset_to_image_count, sorted(
+        str(label) for label in stats['labels'])
+
+  logging.info('No %s in %s, scanning the bottlenecks', _STATS_FILE,
+               bottleneck_dir)
   bottleneck_files = file_io.get_matching_files(
-      os.path.join(bottleneck_dir, '*'))
-  for bottleneck_file in bottleneck_files:
-    for it in tf.compat.v1.io.tf_record_iterator(bottleneck_file):
-      example = tf.train.Example()
-      example.ParseFromString(it)
-      label = example.features.feature['label'].bytes_list.value[0]
-      labels[label] = True
-      dataset = example.features.feature['dataset'].bytes_list.value[0]
-      dataset_to_image_count[dataset] += 1
-
-  label_list = []
-  for key in labels:
-    label_list.append(key)
-  return dataset_to_image_count, label_list
+      os.path.join(bottleneck_dir, '*.tfrecord'))
+  if not bottleneck_files:
+    return dataset_to_image_count, []
+  threads = multiprocessing_pool.ThreadPool(
+      min(_SCAN_PARALLELISM, len(bottleneck_files)))
+  try:
+    file_infos = threads.map(_scan_bottleneck_file, bottleneck_files)
+  finally:
+    threads.close()
+    threads.join()
+  for file_dataset_to_image_count, file_labels in file_infos:
+    for dataset, count in file_dataset_to_image_count.iteritems():
+      dataset_to_image_count[dataset] += count
+    labels.update(file_labels)
+
+  return dataset_to_image_count, sorted(labels)
 
 
 def _get_training_validation_testing_dataset(bottleneck_dir, label_table,
@@ -152,6 +284,34 @@ def _get_training_validation_testing_dataset(bottleneck_dir, label_table,
     label_index = label_table.lookup(example['label'])
     return example['image_path'], label_index, example['bottleneck']
 
+  if _has_columnar_bottlenecks(bottleneck_dir):
+
+    def _columnar_dataset(dataset):
+      """Returns a Dataset of the (image, label index, bottleneck) rows.
+
+      The shards are read one at a time as the Dataset is iterated, instead of
+      being embedded in the graph.
+      """
+      shard_prefixes = _get_columnar_shards(bottleneck_dir, dataset)
+      shards = tf.data.Dataset.from_generator(
+          lambda: _read_columnar_shards(shard_prefixes),
+          output_types=(tf.string, tf.string, tf.float32),
+          output_shapes=([None], [None], [None, INCEPTION_V3_BOTTLENECK_SIZE]))
+      rows = shards.flat_map(
+          lambda image_paths, labels, bottlenecks: tf.data.Dataset.
+          from_tensor_slices((image_paths, labels, bottlenecks)))
+      return rows.map(lambda image_path, label, bottleneck: (
+          image_path, label_table.lookup(label), bottleneck))
+
+    training_dataset = _columnar_dataset(
+        constants.TRAINING_DATASET).repeat().batch(FLAGS.train_batch_size)
+    validation_dataset = _columnar_dataset(
+        constants.VALIDATION_DATASET).repeat().batch(
+            FLAGS.validation_batch_size)
+    testing_dataset = _columnar_dataset(constants.TESTING_DATASET).batch(
+        testing_dataset_size)
+    return training_dataset, validation_dataset, testing_dataset
+
   training_bottleneck_files = file_io.get_matching_files(
       os.path.join(bottleneck_dir, constants.TRAINING_DATASET + '*'))
   training_dataset = tf.data.TFRecordDataset(training_bottleneck_files).map(
@@ -325,8 +485,9 @@ def _create_inference_graph(index_to_label_table, class_count):
       bottleneck_tensor, class_count)
   # Get the prediction (label) for a given tensor index.
   prediction = index_to_label_table.lookup(prediction_index)
-  # Get the score for the predicted class.
-  score = tf.squeeze(tf.gather(normalized_tensor, prediction_index, axis=1))
+  # Get the score for the predicted class. This is the highest score of each
+  # instance, so that batched requests get one score per instance.
+  score = tf.reduce_max(normalized_tensor, axis=1)
   return input_jpeg_str, prediction, score
 
 
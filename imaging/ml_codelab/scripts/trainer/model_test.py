@@ -0,0 +1,130 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests reading the output of scripts.preprocess.preprocess in the trainer.
+
+Run from the ml_codelab directory with:
+python -m unittest scripts.trainer.model_test
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scripts.constants as constants
+import scripts.preprocess.preprocess as preprocess
+import scripts.trainer.model as model
+import tensorflow as tf
+
+
+def _create_example(dataset, image_path, label, bottleneck):
+  # type: (str, str, str, List[float]) -> tf.train.Example
+  """Returns a TFRecord like the ones written by preprocess.py."""
+  return tf.train.Example(
+      features=tf.train.Features(
+          feature={
+              'dataset':
+                  tf.train.Feature(
+                      bytes_list=tf.train.BytesList(value=[dataset])),
+              'image_path':
+                  tf.train.Feature(
+                      bytes_list=tf.train.BytesList(value=[image_path])),
+              'label':
+                  tf.train.Feature(
+                      bytes_list=tf.train.BytesList(value=[label])),
+              'bottleneck':
+                  tf.train.Feature(
+                      float_list=tf.train.FloatList(value=bottleneck)),
+          }))
+
+
+class PreprocessOutputTest(unittest.TestCase):
+
+  def setUp(self):
+    self._output_path = tempfile.mkdtemp()
+    # Rows of (dataset, image path, label, bottleneck). The bottleneck values
+    # are exact in float16.
+    self._rows = []
+    for i in range(7):
+      dataset = (constants.TRAINING_DATASET, constants.TRAINING_DATASET,
+                 constants.VALIDATION_DATASET)[i % 3]
+      bottleneck = np.full(model.INCEPTION_V3_BOTTLENECK_SIZE, i / 4.0)
+      self._rows.append((dataset, 'gs://bucket/image%d.jpg' % i, '23'[i % 2],
+                         tuple(bottleneck.tolist())))
+    self._examples = [_create_example(*row) for row in self._rows]
+
+  def tearDown(self):
+    shutil.rmtree(self._output_path)
+
+  def _write_columnar_shards(self, shard_size):
+    """Writes the examples in columnar format, like a single bundle."""
+    temp_dir = os.path.join(self._output_path, preprocess._COLUMNAR_TEMP_DIR)
+    write_shards = preprocess.WriteColumnarShards(
+        temp_dir, 'float16', shard_size=shard_size)
+    write_shards.start_bundle()
+    shard_names = []
+    for example in self._examples:
+      shard_names.extend(write_shards.process(example))
+    shard_names.extend(
+        windowed_value.value for windowed_value in write_shards.finish_bundle())
+    preprocess._commit_columnar_shards(
+        shard_names, temp_dir,
+        os.path.join(self._output_path, preprocess._COLUMNAR_DIR))
+
+  def _write_stats(self, columnar):
+    key_counts = collections.Counter(
+        preprocess._stats_key(example) for example in self._examples)
+    preprocess._write_stats(key_counts.items(), self._output_path, columnar)
+
+  def test_image_label_info_from_stats(self):
+    self._write_stats(columnar=False)
+
+    dataset_to_image_count, labels = model._get_image_label_info(
+        self._output_path)
+
+    self.assertEqual(dataset_to_image_count, {
+        constants.TRAINING_DATASET: 5,
+        constants.VALIDATION_DATASET: 2
+    })
+    self.assertEqual(labels, ['2', '3'])
+    self.assertFalse(model._has_columnar_bottlenecks(self._output_path))
+
+  def test_read_columnar_shards(self):
+    self._write_columnar_shards(shard_size=2)
+    self._write_stats(columnar=True)
+
+    self.assertTrue(model._has_columnar_bottlenecks(self._output_path))
+    self.assertFalse(
+        os.path.exists(
+            os.path.join(self._output_path, preprocess._COLUMNAR_TEMP_DIR)))
+    for dataset in (constants.TRAINING_DATASET, constants.VALIDATION_DATASET,
+                    constants.TESTING_DATASET):
+      rows = []
+      shard_prefixes = model._get_columnar_shards(self._output_path, dataset)
+      for image_paths, labels, bottlenecks in model._read_columnar_shards(
+          shard_prefixes):
+        self.assertEqual(bottlenecks.dtype, np.float32)
+        self.assertLessEqual(len(image_paths), 2)
+        rows.extend(
+            (dataset, image_path, label, tuple(bottleneck.tolist()))
+            for image_path, label, bottleneck in zip(image_paths, labels,
+                                                     bottlenecks))
+      self.assertEqual(
+          sorted(rows), sorted(row for row in self._rows if row[0] == dataset))
+
+
+if __name__ == '__main__':
+  unittest.main()